@@ -0,0 +1,38 @@
+import sys
+import time
+import warnings
+import numpy as np
+from snail.utils.GPLightCurve import GP_Interpolator, GP_Interpolator_Batch, GP_FIT_CACHE
+
+# * Benchmark of the GP light-curve interpolation: sklearn vs the native engine (single & batched)
+#   usage: python benchmarks/bench_gp.py [number of light curves]
+
+def main(argv):
+    N = int(argv[0]) if argv else 64
+    rng = np.random.default_rng(0)
+    X_q = np.linspace(-10, 45, 100)
+    DATA = []
+    for k in range(N):
+        n = rng.integers(8, 40)
+        X = np.sort(rng.uniform(-15, 50, n))
+        DATA.append((X, 0.5*np.sin(X/12.) + 0.02*X + rng.normal(0, 0.05, n), rng.uniform(0.02, 0.1, n)))
+
+    RESULTS = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for engine in ['sklearn', 'native']:
+            GP_FIT_CACHE.clear()
+            t0 = time.time()
+            RESULTS[engine] = np.array([GP_Interpolator(X, Y.copy(), eY.copy(), X_q, engine=engine)[0] \
+                for X, Y, eY in DATA])
+            print('%-14s %8.3f s (%d light curves)' %(engine, time.time() - t0, N))
+        
+        t0 = time.time()
+        RESULTS['native-batch'] = GP_Interpolator_Batch(*[list(A) for A in zip(*DATA)], X_q)[0]
+        print('%-14s %8.3f s (%d light curves)' %('native-batch', time.time() - t0, N))
+    
+    for engine in ['native', 'native-batch']:
+        print('max |%s - sklearn| = %.2e mag' %(engine, np.max(np.abs(RESULTS[engine] - RESULTS['sklearn']))))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+import sys
+import time
+import numpy as np
+from snail.SpecProc import HomogenizeSpec, HS_OPERATOR_CACHE, HS_GRID_SEEN
+
+# * Benchmark of the spectral homogenization (HS_Core) per spectrum:
+#   the upsampling path vs the sparse operator (cold: first use of a grid, cached) and method='auto',
+#   on a batch of spectra sharing the same wavelength grid (e.g., the same instrument setup).
+#   usage: python benchmarks/bench_homogenize.py [number of spectra]
+
+def main(argv):
+    N = int(argv[0]) if argv else 200
+    rng = np.random.default_rng(0)
+    Wave = np.arange(3500., 7600., 2.5)
+    FLUX_2D = [1.0 + 0.3*np.sin(Wave / rng.uniform(50, 300)) + 0.02*rng.normal(size=len(Wave)) for k in range(N)]
+
+    def run(method):
+        t0 = time.time()
+        FLUX_HOMO = np.array([HomogenizeSpec.HS_Core(Wave, Flux, deredshift=False, method=method)[0] for Flux in FLUX_2D])
+        return FLUX_HOMO, (time.time() - t0) / N * 1e3
+
+    RESULTS = {}
+    RESULTS['upsample'], dt = run('upsample')
+    print('%-18s %8.3f ms per spectrum' %('upsample', dt))
+
+    HS_OPERATOR_CACHE.clear()
+    t0 = time.time()
+    HomogenizeSpec.HS_Core(Wave, FLUX_2D[0], deredshift=False, method='operator')
+    print('%-18s %8.3f ms (first spectrum, builds the operator)' %('operator (cold)', (time.time() - t0) * 1e3))
+    RESULTS['operator'], dt = run('operator')
+    print('%-18s %8.3f ms per spectrum' %('operator (cached)', dt))
+
+    HS_OPERATOR_CACHE.clear()
+    HS_GRID_SEEN.clear()
+    RESULTS['auto'], dt = run('auto')
+    print('%-18s %8.3f ms per spectrum (including the cold start)' %('auto', dt))
+
+    for method in ['operator', 'auto']:
+        err = np.max(np.abs(RESULTS[method] - RESULTS['upsample']))
+        print('max |%s - upsample| = %.2e' %(method, err))
+        assert err < 1e-12
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
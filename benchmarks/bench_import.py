@@ -0,0 +1,46 @@
+import os
+import sys
+import shutil
+import subprocess
+import numpy as np
+import os.path as pa
+from tempfile import mkdtemp
+from snail.utils.HelperCache import HDIR
+
+# * Benchmark of the import time & the helper-asset cache (see snail.utils.HelperCache)
+#   > import snail, from snail import AccessDB (fresh interpreters, median of repeats)
+#   > loading the helper tables, cold (text parse & writing the .npy cache) vs warm (memory-mapped .npy)
+#   usage: python benchmarks/bench_import.py [number of repeats]
+
+def timed(code, setup='pass', env=None):
+    # NOTE: wall time (ms) of the code (after the setup) in a fresh interpreter, measured inside it
+    code = 'import time; %s; t0 = time.perf_counter(); %s; print((time.perf_counter() - t0) * 1e3)' %(setup, code)
+    return float(subprocess.check_output([sys.executable, '-c', code], env=env).decode().split()[-1])
+
+# NOTE: tag -> (setup, loader, source file), only the loader call is timed
+LOADERS = {'fpca_basis': ('from snail.utils.SpecFPCA import Load_FPCA_Model', 'Load_FPCA_Model()', 'fpca_basis'), 
+           'transmission_curves': ('from snail.utils.SyntheticPhot import Load_TCDICT', 'Load_TCDICT()', 'transmission_curves'), 
+           'hsiao_template': ('from snail.utils.SyntheticPhot import Load_HsiaoArray', 'Load_HsiaoArray()', 'HsiaoTemplate.csv')}
+
+def main(argv):
+    R = int(argv[0]) if argv else 5
+    for label, code in [('import numpy', 'import numpy'), ('import snail', 'import snail'), \
+        ('from snail import AccessDB', 'from snail import AccessDB')]:
+        print('%-30s %8.1f ms' %(label, np.median([timed(code) for r in range(R)])))
+
+    CDIR = mkdtemp(prefix='snail-bench-cache-')
+    env = dict(os.environ, SNAIL_CACHE_DIR=CDIR)
+    try:
+        for tag, (setup, code, source) in LOADERS.items():
+            if not pa.exists(pa.join(HDIR, source)):
+                print('%-30s skipped (%s not found)' %(tag, source))
+                continue
+            shutil.rmtree(CDIR, ignore_errors=True)
+            cold = timed(code, setup=setup, env=env)
+            warm = np.median([timed(code, setup=setup, env=env) for r in range(R)])
+            print('%-30s %8.1f ms (cold, text) | %8.1f ms (warm, mmap)' %(tag, cold, warm))
+    finally:
+        shutil.rmtree(CDIR, ignore_errors=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,26 +1,252 @@
+import os
 import sys
 import numpy as np 
 import os.path as pa
 from astropy.io import fits
 from astropy.table import Table
 
+class CSD_Catalog:
+
+    # NOTE: the master catalogs (ObjectMaster.csv & SpecMaster.csv) of a database directory,
+    #       loaded once per process and shared by all AccessDB instances (see CSD_Catalog.Load),
+    #       with hash indexes on SN_name & (SN_name, Spec_ID), and per-SN row indexes sorted by phase.
+    #       NOTE: the catalogs are reloaded if the files are modified.
+
+    CATALOGS = {}   # realpath of DBDir -> CSD_Catalog
+
+    def __init__(self, DBDir):
+        
+        self.DBDir = DBDir
+        self.Stamp = CSD_Catalog.FileStamp(DBDir)
+        self.AstObjMa = Table.read(DBDir + '/ObjectMaster.csv', format='ascii.csv')
+        self.AstSpecMa = Table.read(DBDir + '/SpecMaster.csv', format='ascii.csv')
+        
+        # ** hash index on SN_name (the first row if duplicated)
+        self.ObjIndex = {}
+        for idx, SN_name in enumerate(self.AstObjMa['SN_name']):
+            self.ObjIndex.setdefault(SN_name, idx)
+
+        # ** hash index on (SN_name, Spec_ID) & sorted phase index of each SN
+        self.SpecIndex = {}
+        _SpecRows = {}
+        for idx, (SN_name, Spec_ID) in enumerate(zip(self.AstSpecMa['SN_name'], self.AstSpecMa['Spec_ID'])):
+            self.SpecIndex.setdefault((SN_name, Spec_ID), idx)
+            _SpecRows.setdefault(SN_name, []).append(idx)
+        
+        PHASE = np.array(self.AstSpecMa['Phase'])
+        self.SpecRows, self.SpecPhases = {}, {}
+        for SN_name in _SpecRows:
+            rows = np.array(_SpecRows[SN_name])
+            rows = rows[np.argsort(PHASE[rows])]     # sorted by phase
+            self.SpecRows[SN_name] = rows
+            self.SpecPhases[SN_name] = PHASE[rows]
+    
+    @staticmethod
+    def FileStamp(DBDir):
+        return tuple((os.stat(pa.join(DBDir, file)).st_size, os.stat(pa.join(DBDir, file)).st_mtime_ns) \
+            for file in ['ObjectMaster.csv', 'SpecMaster.csv'])
+    
+    @staticmethod
+    def Load(DBDir):
+        key = pa.realpath(DBDir)
+        Catalog = CSD_Catalog.CATALOGS.get(key, None)
+        if Catalog is None or Catalog.Stamp != CSD_Catalog.FileStamp(DBDir):
+            Catalog = CSD_Catalog(DBDir)
+            CSD_Catalog.CATALOGS[key] = Catalog
+        return Catalog
+    
+    def Spec_RowIndices(self, SN_name, PhaseRange=None):
+        
+        # NOTE: row indices in SpecMaster of the given SN (sorted by phase), 
+        #       optionally within the (closed) PhaseRange via binary search on the sorted phases.
+        rows = self.SpecRows.get(SN_name, np.array([]).astype(int))
+        if PhaseRange is not None:
+            pmin, pmax = PhaseRange
+            phases = self.SpecPhases.get(SN_name, np.array([]))
+            rows = rows[np.searchsorted(phases, pmin, side='left'): np.searchsorted(phases, pmax, side='right')]
+        return rows
+
+class CSD_SpecStore:
+
+    # NOTE: bulk store of the spectra in the database directory, converted once from the ASCII files
+    #       (see CSD_SpecStore.Build) into .npy files in StoreDir (default: DBDir/Observations/SpecStore),
+    #       which are loaded by memory-mapping once per process (see CSD_SpecStore.Load).
+    #       > 'Homogenized' & 'Corrected': a (N_spec, 1700) array on the standard wavelength.
+    #       > 'Raw': a ragged store, i.e., concatenated wavelength & flux with offsets of shape (N_spec+1,).
+    #       the spectra of each SN occupy consecutive rows (sorted by phase), 
+    #       and the row index is a hash index on (SN_name, Spec_ID).
+    #       NOTE: the store is stamped with (size, mtime) of SpecMaster.csv and of each spectrum file,
+    #             a spectrum is only read from the store if both are unchanged (see Is_Current), 
+    #             otherwise from its ASCII file (see Read). please rebuild the store after updating the database.
+
+    STORES = {}     # (realpath of StoreDir, data_type) -> CSD_SpecStore
+    FILE_PATTERNS = {'Raw': '%d.%s.ascii', 'Homogenized': '%d.%s.st.ascii', 'Corrected': '%d.%s.stcal.ascii'}
+
+    def __init__(self, StoreDir, data_type, mmap_mode='r'):
+
+        self.data_type = data_type
+        self.Stamp = CSD_SpecStore.StoreStamp(StoreDir, data_type)
+        load = lambda key: np.load(pa.join(StoreDir, '%s.%s.npy' %(data_type, key)), mmap_mode=mmap_mode)
+        self.SN_NAME, self.SPEC_ID = np.load(pa.join(StoreDir, '%s.SN_name.npy' %data_type)), \
+            np.load(pa.join(StoreDir, '%s.Spec_ID.npy' %data_type))
+        self.WAVE, self.FLUX = load('wavelength'), load('flux')
+        if data_type == 'Raw': self.OFFSETS = load('offsets')
+        self.MASTER_STAMP, self.FILE_STAMP = None, None     # NOTE: stores built without stamps are never current
+        if pa.exists(pa.join(StoreDir, '%s.file_stamp.npy' %data_type)):
+            self.MASTER_STAMP, self.FILE_STAMP = load('master_stamp'), load('file_stamp')
+        self.Index = {(SN_name, Spec_ID): idx for idx, (SN_name, Spec_ID) in enumerate(zip(self.SN_NAME, self.SPEC_ID))}
+
+    @staticmethod
+    def Default_StoreDir(DBDir):
+        return pa.join(DBDir, 'Observations', 'SpecStore')
+
+    @staticmethod
+    def SpecFile(DBDir, data_type, SN_name, Spec_ID):
+        return pa.join(DBDir, 'Observations', data_type, CSD_SpecStore.FILE_PATTERNS[data_type] %(Spec_ID, SN_name))
+
+    @staticmethod
+    def FileStamp(FILE):
+        return (os.stat(FILE).st_size, os.stat(FILE).st_mtime_ns)
+
+    @staticmethod
+    def StoreStamp(StoreDir, data_type):
+        return CSD_SpecStore.FileStamp(pa.join(StoreDir, '%s.flux.npy' %data_type))
+
+    @staticmethod
+    def Build(DBDir, data_type, StoreDir=None, dtype=np.float64):
+
+        # NOTE: one-time conversion of all spectra (of the given data type) listed in SpecMaster.
+        assert data_type in ['Raw', 'Homogenized', 'Corrected']
+        if StoreDir is None: StoreDir = CSD_SpecStore.Default_StoreDir(DBDir)
+        os.makedirs(StoreDir, exist_ok=True)
+        Catalog = CSD_Catalog.Load(DBDir)
+        master_stamp = CSD_SpecStore.FileStamp(pa.join(DBDir, 'SpecMaster.csv'))
+
+        SN_NAME, SPEC_ID, FILE_STAMP, WAVE_LST, FLUX_LST = [], [], [], [], []
+        for SN_name in Catalog.SpecRows:
+            for Spec_ID in Catalog.AstSpecMa['Spec_ID'][Catalog.Spec_RowIndices(SN_name)]:
+                SpecFile = CSD_SpecStore.SpecFile(DBDir, data_type, SN_name, Spec_ID)
+                if not pa.exists(SpecFile): continue
+                FILE_STAMP.append(CSD_SpecStore.FileStamp(SpecFile))
+                Wave, Flux = CSD_SpecStore.Read_SpecFile(SpecFile, dtype=dtype)
+                WAVE_LST.append(Wave)
+                FLUX_LST.append(Flux)
+                SN_NAME.append(SN_name)
+                SPEC_ID.append(Spec_ID)
+        
+        ARRDICT = {'SN_name': np.array(SN_NAME).astype(str), 'Spec_ID': np.array(SPEC_ID).astype(int), \
+                   'master_stamp': np.array(master_stamp).astype(np.int64), \
+                   'file_stamp': np.array(FILE_STAMP).astype(np.int64).reshape((-1, 2))}
+        if data_type == 'Raw':
+            ARRDICT['offsets'] = np.cumsum([0] + [len(w) for w in WAVE_LST])
+            ARRDICT['wavelength'] = np.concatenate(WAVE_LST) if WAVE_LST else np.array([]).astype(dtype)
+            ARRDICT['flux'] = np.concatenate(FLUX_LST) if FLUX_LST else np.array([]).astype(dtype)
+        else:
+            RCut0, RCut1 = 3800, 7200
+            WAVE = np.arange(RCut0, RCut1, 2).astype(dtype)
+            for w in WAVE_LST: assert np.allclose(w, WAVE)
+            ARRDICT['wavelength'] = WAVE
+            ARRDICT['flux'] = np.array(FLUX_LST).reshape((-1, len(WAVE))).astype(dtype)
+        # NOTE: the flux is written last, its presence marks a complete store
+        for key in sorted(ARRDICT, key=lambda key: key == 'flux'):
+            np.save(pa.join(StoreDir, '%s.%s.npy' %(data_type, key)), ARRDICT[key])
+        CSD_SpecStore.STORES.pop((pa.realpath(StoreDir), data_type), None)
+        
+        return CSD_SpecStore.Load(DBDir, data_type, StoreDir=StoreDir)
+
+    @staticmethod
+    def Exists(DBDir, data_type, StoreDir=None):
+        if StoreDir is None: StoreDir = CSD_SpecStore.Default_StoreDir(DBDir)
+        return pa.exists(pa.join(StoreDir, '%s.flux.npy' %data_type))
+
+    @staticmethod
+    def Load(DBDir, data_type, StoreDir=None):
+        if StoreDir is None: StoreDir = CSD_SpecStore.Default_StoreDir(DBDir)
+        key = (pa.realpath(StoreDir), data_type)
+        Store = CSD_SpecStore.STORES.get(key, None)
+        if Store is None or Store.Stamp != CSD_SpecStore.StoreStamp(StoreDir, data_type):
+            Store = CSD_SpecStore(StoreDir, data_type)
+            CSD_SpecStore.STORES[key] = Store
+        return Store
+
+    @staticmethod
+    def Read_SpecFile(SpecFile, dtype=np.float64):
+        AstSpec = Table.read(SpecFile, format='ascii.csv')
+        return np.array(AstSpec.columns[0]).astype(dtype), np.array(AstSpec['flux']).astype(dtype)
+
+    def Is_Current(self, DBDir, SN_name, Spec_ID):
+
+        # NOTE: the spectrum is in the store, and neither SpecMaster.csv nor the spectrum file 
+        #       has been modified since the store was built.
+        idx = self.Index.get((SN_name, Spec_ID), None)
+        if idx is None or self.FILE_STAMP is None: return False
+        if tuple(self.MASTER_STAMP) != CSD_SpecStore.FileStamp(pa.join(DBDir, 'SpecMaster.csv')): return False
+        SpecFile = CSD_SpecStore.SpecFile(DBDir, self.data_type, SN_name, Spec_ID)
+        return pa.exists(SpecFile) and tuple(self.FILE_STAMP[idx]) == CSD_SpecStore.FileStamp(SpecFile)
+
+    @staticmethod
+    def Read(DBDir, data_type, SN_name, Spec_IDs, build_store=False):
+
+        # NOTE: the spectra (in the form of CSD_SpecStore.Get) from the store where current, 
+        #       and from the ASCII files otherwise (e.g., no store, or updated spectra).
+        #       build_store=True: (re)build the default store first if it is missing or not current.
+        Store = None
+        if CSD_SpecStore.Exists(DBDir, data_type): Store = CSD_SpecStore.Load(DBDir, data_type)
+        CURRENT = [Store is not None and Store.Is_Current(DBDir, SN_name, Spec_ID) for Spec_ID in Spec_IDs]
+        if build_store and not all(CURRENT):
+            Store = CSD_SpecStore.Build(DBDir, data_type)
+            CURRENT = [Store.Is_Current(DBDir, SN_name, Spec_ID) for Spec_ID in Spec_IDs]
+        if all(CURRENT): return Store.Get(SN_name, Spec_IDs)
+
+        SpecLst = []
+        for Spec_ID, current in zip(Spec_IDs, CURRENT):
+            if current: SpecLst.append(Store.Get(SN_name, [Spec_ID])[0])
+            else:
+                SpecFile = CSD_SpecStore.SpecFile(DBDir, data_type, SN_name, Spec_ID)
+                assert pa.exists(SpecFile), 'Spectrum file [%s] not found !' %SpecFile
+                Wave, Flux = CSD_SpecStore.Read_SpecFile(SpecFile)
+                SpecLst.append(Flux if data_type != 'Raw' else (Wave, Flux))
+        
+        if data_type != 'Raw':
+            RCut0, RCut1 = 3800, 7200
+            return np.array(SpecLst).reshape((-1, len(np.arange(RCut0, RCut1, 2))))
+        return SpecLst
+    
+    def Rows(self, SN_name, Spec_IDs):
+        
+        # NOTE: row indices of the spectra, a slice if the rows are consecutive (zero-copy access)
+        rows = np.array([self.Index[(SN_name, Spec_ID)] for Spec_ID in Spec_IDs]).astype(int)
+        if len(rows) > 0 and np.all(np.diff(rows) == 1): rows = slice(rows[0], rows[-1]+1)
+        return rows
+    
+    def Get(self, SN_name, Spec_IDs):
+        
+        # NOTE: 'Homogenized' & 'Corrected': flux array of shape (len(Spec_IDs), 1700), 
+        #       'Raw': list of (wavelength, flux) arrays, views of the memory-mapped store.
+        rows = self.Rows(SN_name, Spec_IDs)
+        if self.data_type != 'Raw':
+            return self.FLUX[rows]
+        rows = np.arange(len(self.SPEC_ID))[rows]
+        return [(self.WAVE[self.OFFSETS[r]: self.OFFSETS[r+1]], self.FLUX[self.OFFSETS[r]: self.OFFSETS[r+1]]) \
+            for r in rows]
+
 class AccessDB:
     def __init__(self, SN_name, DBDir):
 
         # ** load master catalogs in the database directory
+        #    NOTE: the catalogs are shared by all instances (loaded once per process, see CSD_Catalog),
+        #          so an AccessDB instance is a cheap view of a single SN.
         self.DBDir = DBDir
-        Astab_ObjMa = Table.read(self.DBDir + '/ObjectMaster.csv', format='ascii.csv')
-        Astab_SpecMa = Table.read(self.DBDir + '/SpecMaster.csv', format='ascii.csv')
+        self.Catalog = CSD_Catalog.Load(DBDir)
 
         if SN_name is not None:
             # ** in the scope of the given SN
             self.SN_name = SN_name
-            self.ObjRow = Astab_ObjMa[Astab_ObjMa['SN_name'] == SN_name][0]
-            AstSpecMa_SN = Astab_SpecMa[Astab_SpecMa['SN_name'] == SN_name]
-            self.AstSpecMa_SN = AstSpecMa_SN[np.argsort(AstSpecMa_SN['Phase'])]  # sorted by phase
+            self.ObjRow = self.Catalog.AstObjMa[self.Catalog.ObjIndex[SN_name]]
+            self.AstSpecMa_SN = self.Catalog.AstSpecMa[self.Catalog.Spec_RowIndices(SN_name)]  # sorted by phase
         else:
             print('WARNING: No specific SN given, show the list of SNe in CSD')
-            for row in Astab_ObjMa:
+            for row in self.Catalog.AstObjMa:
                 print('%s %s | z=%.6f NumSpec=%d' %(row['SN_name'], row['Subtype'], \
                     row['Redshift'], row['Num_Spec']))
         
@@ -45,7 +271,7 @@ class AccessDB:
     def Spec_Attributes(self, Spec_ID):
         
         SPECA_DICT = {}
-        SpecRow = self.AstSpecMa_SN[self.AstSpecMa_SN['Spec_ID'] == Spec_ID][0]
+        SpecRow = self.Catalog.AstSpecMa[self.Catalog.SpecIndex[(self.SN_name, Spec_ID)]]
         assert self.SN_name == SpecRow['SN_name']
         
         SPECA_DICT['Spec_ID'] = Spec_ID                                 # unique id for the spectrum
@@ -98,10 +324,8 @@ class AccessDB:
                         %(sid, SPECA_DICT['Phase'], SPECA_DICT['Tel_Inst']))
 
         else:
-            pmin, pmax = PhaseRange
-            Avmask = np.logical_and(self.AstSpecMa_SN['Phase'] >= pmin, \
-                self.AstSpecMa_SN['Phase'] <= pmax)
-            SID_LST = list(self.AstSpecMa_SN['Spec_ID'][Avmask])
+            SpecRows = self.Catalog.Spec_RowIndices(self.SN_name, PhaseRange=PhaseRange)
+            SID_LST = list(self.Catalog.AstSpecMa['Spec_ID'][SpecRows])
 
             if verbose:
                 for sid in SID_LST:
@@ -152,7 +376,7 @@ class AccessDB:
     
     def Retrieve_SpecObs(self, Spec_ID, data_type, deredshift_rawspec=True):
         
-        assert Spec_ID in list(self.AstSpecMa_SN['Spec_ID'])
+        assert (self.SN_name, Spec_ID) in self.Catalog.SpecIndex
         assert data_type in ['Raw', 'Homogenized', 'Corrected']
         MDIR_SO = pa.join(self.DBDir, 'Observations')
         assert pa.exists(MDIR_SO)    # make sure that the spec-obs dataset exists
@@ -181,6 +405,14 @@ class AccessDB:
                     print('WARNING: The returned Raw spectrum is probably (not for sure) in observer-frame as it is !')
                 print('WARNING: No DeRedshifting performed on the Raw spectrum !')
         
+        if data_type in ['Homogenized', 'Corrected'] and CSD_SpecStore.Exists(self.DBDir, data_type):
+            # NOTE: read from the bulk store if available & current (otherwise from the ASCII file)
+            Store = CSD_SpecStore.Load(self.DBDir, data_type)
+            if Store.Is_Current(self.DBDir, self.SN_name, Spec_ID):
+                AstSpec = Table([np.array(Store.WAVE), np.array(Store.Get(self.SN_name, [Spec_ID])[0])], \
+                    names=['wavelength', 'flux'])
+                return AstSpec
+
         if data_type == 'Homogenized':
             HomoSpecFile = pa.join(MDIR_SO, 'Homogenized', '%d.%s.st.ascii' %(Spec_ID, self.SN_name))
             assert pa.exists(HomoSpecFile)
@@ -195,7 +427,41 @@ class AccessDB:
 
         return AstSpec
     
-    def Retrieve_SpecTemplate(self, evaluate_accuracy=False):
+    def Retrieve_SpecObs_Batch(self, Spec_IDs, data_type, deredshift_rawspec=True, build_store=False):
+        
+        # NOTE: retrieve many spectra of the SN from the bulk store (see CSD_SpecStore.Read),
+        #       the spectra not (currently) in the store are read from the ASCII files,
+        #       build_store=True: (re)build the store (in DBDir/Observations/SpecStore) if needed.
+        #       > 'Homogenized' & 'Corrected': returns a dictionary with 'wavelength' of shape (1700,) 
+        #         and 'flux' of shape (len(Spec_IDs), 1700), the flux is a zero-copy view of 
+        #         the memory-mapped store if Spec_IDs are consecutive in phase order (e.g., from Search_SpecID).
+        #       > 'Raw': returns a list of dictionaries with 'wavelength' & 'flux' (one per spectrum),
+        #         deredshift_rawspec=True (default, as in Retrieve_SpecObs): force the raw spectra
+        #         into the rest frame, False: the raw spectra as they are (no print in either case).
+        
+        assert data_type in ['Raw', 'Homogenized', 'Corrected']
+        for Spec_ID in Spec_IDs: assert (self.SN_name, Spec_ID) in self.Catalog.SpecIndex
+        SPECS = CSD_SpecStore.Read(self.DBDir, data_type, self.SN_name, Spec_IDs, build_store=build_store)
+
+        if data_type != 'Raw':
+            RCut0, RCut1 = 3800, 7200
+            return {'wavelength': np.arange(RCut0, RCut1, 2).astype(float), 'flux': SPECS}
+        
+        SpecLst = []
+        z = self.SN_Attributes()['Redshift']
+        for Spec_ID, (Wave, Flux) in zip(Spec_IDs, SPECS):
+            DRT = self.Spec_Attributes(Spec_ID=Spec_ID)['RawSpec_DeRedshifted_Type']
+            if deredshift_rawspec and DRT in ['No,VI', 'No,Cfa', 'YN,VI', 'YN,VIlowz']:
+                Wave = Wave / (1.0+z)
+            SpecLst.append({'wavelength': Wave, 'flux': Flux})
+        
+        return SpecLst
+
+    def Retrieve_SpecTemplate_Array(self, memmap=True):
+        
+        # NOTE: array-native access to the spectral template of the SN, returns a dictionary with
+        #       'phase' (385,), 'wavelength' (1700,) and 'flux' (385, 1700) of the template surface,
+        #       where the flux is a (transposed) view of the memory-mapped FITS data (if memmap).
         
         # ** define template phase & wavelength resolution
         OpPcadence = 1/8.0
@@ -208,30 +474,49 @@ class AccessDB:
         assert pa.exists(MDIR_ST)   # make sure that the spec-temp dataset exists
         
         FITS_TEMP = pa.join(MDIR_ST, 'ESurface-%s.fits' %self.SN_name)
-        LstmData = fits.getdata(FITS_TEMP, ext=0).T
-
-        COL0, COL1, COL2, COL3 = [], [], [], []
-        for idx, phase in enumerate(OpPHA):
-            COL0 += [idx]*len(WAVE)
-            COL1 += [phase]*len(WAVE)
-            COL2 += list(WAVE)
-            COL3 += list(LstmData[idx, :])
+        LstmData = fits.getdata(FITS_TEMP, ext=0, memmap=memmap).T
+        assert LstmData.shape == (len(OpPHA), len(WAVE))
+        SpecTempDict = {'phase': OpPHA, 'wavelength': WAVE, 'flux': LstmData}
+
+        return SpecTempDict
+
+    def Retrieve_SpecTemplate(self, evaluate_accuracy=False):
+        
+        # NOTE: the template in long format (one row per phase & wavelength) as an astropy Table,
+        #       see Retrieve_SpecTemplate_Array for the array-native version.
+        SpecTempDict = self.Retrieve_SpecTemplate_Array()
+        OpPHA, WAVE, LstmData = SpecTempDict['phase'], SpecTempDict['wavelength'], SpecTempDict['flux']
+        
+        COL0 = np.repeat(np.arange(len(OpPHA)), len(WAVE))
+        COL1 = np.repeat(OpPHA, len(WAVE))
+        COL2 = np.tile(WAVE, len(OpPHA))
+        COL3 = np.ravel(LstmData).astype(LstmData.dtype.newbyteorder('='))
         AstSpec = Table([COL0, COL1, COL2, COL3], names=['index', 'phase', 'wavelength', 'flux'])
 
         if evaluate_accuracy:
+            MDIR_ST = pa.join(self.DBDir, 'Templates')
             CSV_TRec = pa.join(MDIR_ST, 'TrainingRecord.csv')
             AstTRec = Table.read(CSV_TRec, format='ascii.csv')
             AstTRec_SN = AstTRec[AstTRec['SN_name'] == self.SN_name]
             AstTRec_SN = AstTRec_SN[np.argsort(AstTRec_SN['Phase'])]
+            
+            # ** retreive observation data (corrected), from the bulk store if available
+            SIDs = list(AstTRec_SN['Spec_ID'])
+            if CSD_SpecStore.Exists(self.DBDir, 'Corrected'):
+                FOBS = np.array(self.Retrieve_SpecObs_Batch(Spec_IDs=SIDs, data_type='Corrected')['flux'])
+            else:
+                FOBS = np.array([np.array(self.Retrieve_SpecObs(Spec_ID=sid, data_type='Corrected')['flux']) \
+                    for sid in SIDs]).reshape((-1, len(WAVE)))
+            
+            # ** extract template data at nearest phase (batched lookup)
+            PHA_TRec = np.array(AstTRec_SN['Phase']).astype(float)
+            FTEMP = np.array(LstmData)[np.argmin(np.abs(OpPHA[None, :] - PHA_TRec[:, None]), axis=1), :]
+            
+            # ** calculate mape error
+            APE = np.abs((FOBS - FTEMP) / np.clip(np.abs(FOBS), a_min=1e-7, a_max=None))
+            MAPE = 100.0 * np.mean(APE, axis=-1)
             print('SN name | Obs. Spec_ID | Obs. Phase | Trained | Template MAPE error')
-            for line in AstTRec_SN:
-                # ** retreive observation data (corrected)
-                Fobs = np.array(self.Retrieve_SpecObs(Spec_ID=line['Spec_ID'], data_type='Corrected')['flux'])
-                # ** extract template data at nearest phase
-                Ftemp = LstmData[np.argmin(np.abs(OpPHA - line['Phase'])), :]
-                # ** calculate mape error
-                ape = np.abs((Fobs - Ftemp) / np.clip(np.abs(Fobs), a_min=1e-7, a_max=None))
-                mape = 100.0 * np.mean(ape, axis=-1)
+            for line, mape in zip(AstTRec_SN, MAPE):
                 print('[%s] | %d | %.1f d | %s | %.1f %%' \
                     %(self.SN_name, line['Spec_ID'], line['Phase'], line['Training'], mape))
         
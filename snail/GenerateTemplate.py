@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import numpy as np
+import os.path as pa
+from astropy.io import fits
+from astropy.table import Table
+from snail.SpecProc import HomogenizeSpec
+from snail.Predict import SNAIL_Predict_Deep
+from snail.utils.SpecFPCA import FPCA_Parameterize_Batch
+
+
+class SNAIL_Template:
+
+    # ** Remarks on template generation
+    #    A manifest (csv) gives one template job per SN with columns
+    #    SN_name, redshift, phase_1, file_1, phase_2, file_2
+    #    where file_1 & file_2 are raw spectra (csv with columns 'wavelength' & 'flux') at phase_1 & phase_2,
+    #    (file_2 & phase_2 can be left empty to use a single spectrum, redshift can be left empty
+    #     if the raw spectra are already in rest-frame).
+    #
+    #    The pipeline runs in stages over all (remaining) SNe together
+    #    [1] homogenize all raw spectra (HomogenizeSpec.HS_Batch, with a process pool)
+    #    [2] FPCA parameterization of all homogenized spectra in one batch (FPCA_Parameterize_Batch)
+    #    [3] batched MC-dropout predictions (SNAIL_Predict_Deep.SPD_Batch) for groups of SNe
+    #        on the template phases [-15, 33] with cadence 1/8 day (as the templates in CSD).
+    #
+    #    Output: one FITS file per SN, OutDir/ESurface-<SN_name>.fits, where the primary HDU is
+    #            the template flux surface with shape (wave_dim, phase_dim) = (1700, 385) [same as CSD],
+    #            and the extension 'FLUXERR' is the MC-dropout uncertainty with the same shape.
+    #    Checkpoint: the outputs of stage [1] & [2] are kept in WorkDir (default: OutDir/.snail_template)
+    #                for all spectra of the manifest (keyed on the full manifest, not the remaining SNe,
+    #                with the size & mtime of each raw spectrum, i.e., the stages are redone if a file is edited),
+    #                and each FITS file is written atomically, so an interrupted run can be resumed
+    #                by calling again with the same arguments (finished SNe are skipped in stage [3]).
+
+    OpPcadence = 1/8.0
+    OpPrange = (-15.00, 33.01)
+
+    @staticmethod
+    def Read_Manifest(Manifest):
+
+        AstMan = Table.read(Manifest, format='ascii.csv')
+        JOBS = []
+        for row in AstMan:
+            def value(col):
+                if col not in AstMan.colnames: return None
+                v = row[col]
+                if np.ma.is_masked(v) or str(v).strip() in ['', 'nan', 'None']: return None
+                return v
+
+            job = {'SN_name': str(row['SN_name']), 'redshift': value('redshift'), \
+                   'phase_1': float(row['phase_1']), 'file_1': str(row['file_1'])}
+            if value('file_2') is None: job['phase_2'], job['file_2'] = job['phase_1'], job['file_1']
+            else: job['phase_2'], job['file_2'] = float(row['phase_2']), str(row['file_2'])
+            if job['redshift'] is not None: job['redshift'] = float(job['redshift'])
+
+            # NOTE: the LSTM requires phase_1 <= phase_2
+            if job['phase_1'] > job['phase_2']:
+                job['phase_1'], job['phase_2'] = job['phase_2'], job['phase_1']
+                job['file_1'], job['file_2'] = job['file_2'], job['file_1']
+            JOBS.append(job)
+
+        SN_names = [job['SN_name'] for job in JOBS]
+        assert len(set(SN_names)) == len(SN_names), 'Duplicated SN_name in the manifest !'
+        return JOBS
+
+    @staticmethod
+    def _Stage_Key(SPECS):
+        # NOTE: the spectra [file, redshift] of the manifest with the (size, mtime) stamps of the files,
+        #       as CSD_SpecStore, so that an edited (or replaced) raw spectrum invalidates the checkpoints.
+        return [[file, redshift, os.stat(file).st_size, os.stat(file).st_mtime_ns] for file, redshift in SPECS]
+
+    @staticmethod
+    def _Stage_Cached(WorkDir, stage, SPECS):
+        # NOTE: a stage output is reusable only if it was completed for the same spectra (of the manifest)
+        MARKER = pa.join(WorkDir, '%s.files.json' %stage)
+        if not pa.exists(MARKER): return False
+        with open(MARKER, 'r') as f: return json.load(f) == SNAIL_Template._Stage_Key(SPECS)
+
+    @staticmethod
+    def _Stage_Done(WorkDir, stage, SPECS):
+        with open(pa.join(WorkDir, '%s.files.json' %stage), 'w') as f: json.dump(SNAIL_Template._Stage_Key(SPECS), f)
+
+    @staticmethod
+    def _Stage_Reset(WorkDir, stage):
+        # NOTE: invalidate a stage (and thus the downstream stages using its output)
+        MARKER = pa.join(WorkDir, '%s.files.json' %stage)
+        if pa.exists(MARKER): os.remove(MARKER)
+
+    @staticmethod
+    def STG(Manifest, lstm_model, OutDir, WorkDir=None, num_forward_pass=64, \
+        num_workers=1, chunk_size=16, sn_per_call=8, passes_per_call=None, batch_size=None, \
+        overwrite=False, seed=None, verbose=True):
+
+        # NOTE: returns a dictionary SN_name -> status ('done', 'exists' or 'failed: <reason>').
+        #       seed: seeded MC-dropout (see SNAIL_Predict_Deep.MCDropout) for reproducible templates,
+        #             NOTE: the SNe are predicted in groups, so the same sn_per_call is required to reproduce.
+
+        OpPHA = np.arange(SNAIL_Template.OpPrange[0], SNAIL_Template.OpPrange[1], SNAIL_Template.OpPcadence)
+        if WorkDir is None: WorkDir = pa.join(OutDir, '.snail_template')
+        os.makedirs(OutDir, exist_ok=True)
+        os.makedirs(WorkDir, exist_ok=True)
+
+        JOBS = SNAIL_Template.Read_Manifest(Manifest)
+
+        # ** collect unique raw spectra (with redshift) of the full manifest
+        SPECS = []
+        for job in JOBS:
+            for k in [1, 2]:
+                spec = [job['file_%d' %k], job['redshift']]
+                if spec not in SPECS: SPECS.append(spec)
+        FILES = [spec[0] for spec in SPECS]
+
+        FITS_OUT = lambda SN_name: pa.join(OutDir, 'ESurface-%s.fits' %SN_name)
+        STATUS = {}
+        for job in JOBS:
+            if pa.exists(FITS_OUT(job['SN_name'])) and not overwrite:
+                STATUS[job['SN_name']] = 'exists'
+        JOBS = [job for job in JOBS if job['SN_name'] not in STATUS]
+        if verbose: print('CheckPoint: [%d] templates to generate, [%d] already exist' %(len(JOBS), len(STATUS)))
+        if len(JOBS) == 0: return STATUS
+
+        # ** [1] homogenization
+        HOMO_FILE = pa.join(WorkDir, 'homogenized.npy')
+        QUAL_FILE = pa.join(WorkDir, 'homogenized.quality.npy')
+        if SNAIL_Template._Stage_Cached(WorkDir, 'homogenized', SPECS):
+            FLUX_HOMO, QUALITY = np.load(HOMO_FILE, mmap_mode='r'), np.load(QUAL_FILE)
+            if verbose: print('CheckPoint: [1] homogenization (resumed from checkpoint)')
+        else:
+            SNAIL_Template._Stage_Reset(WorkDir, 'fpca')     # NOTE: the FPCA stage depends on the homogenization
+            def triples():
+                for file, redshift in SPECS:
+                    AstSpec_Raw = Table.read(file, format='ascii.csv')
+                    yield np.array(AstSpec_Raw['wavelength']), np.array(AstSpec_Raw['flux']), redshift
+            HomoBatchDict = HomogenizeSpec.HS_Batch(triples(), N=len(SPECS), out_file=HOMO_FILE, \
+                num_workers=num_workers, chunk_size=chunk_size)
+            FLUX_HOMO, QUALITY = HomoBatchDict['flux'], HomoBatchDict['quality']
+            np.save(QUAL_FILE, QUALITY)
+            SNAIL_Template._Stage_Done(WorkDir, 'homogenized', SPECS)
+            if verbose: print('CheckPoint: [1] homogenization of [%d] spectra' %len(SPECS))
+
+        # ** [2] FPCA parameterization
+        FPCA_FILE = pa.join(WorkDir, 'fpca.npy')
+        if SNAIL_Template._Stage_Cached(WorkDir, 'fpca', SPECS):
+            FPCA_PARAM = np.load(FPCA_FILE)
+            if verbose: print('CheckPoint: [2] FPCA parameterization (resumed from checkpoint)')
+        else:
+            WAVE = np.arange(3800, 7200, 2)
+            GOOD = np.logical_and(QUALITY['success'], QUALITY['finite'])
+            FPCA_PARAM = np.full((len(SPECS), 2, 92), np.nan)
+            if np.sum(GOOD) > 0:
+                FPCA_PARAM[GOOD] = FPCA_Parameterize_Batch(WAVE, np.array(FLUX_HOMO)[GOOD])
+            np.save(FPCA_FILE, FPCA_PARAM)
+            SNAIL_Template._Stage_Done(WorkDir, 'fpca', SPECS)
+            if verbose: print('CheckPoint: [2] FPCA parameterization of [%d] spectra' %np.sum(GOOD))
+
+        # ** [3] batched MC-dropout predictions (groups of SNe)
+        PENDING = []
+        for job in JOBS:
+            i1, i2 = [SPECS.index([job['file_%d' %k], job['redshift']]) for k in [1, 2]]
+            BAD = [k for k in [i1, i2] if not (QUALITY[k]['success'] and QUALITY[k]['finite'])]
+            if BAD:
+                STATUS[job['SN_name']] = 'failed: homogenization of %s' %(', '.join(FILES[k] for k in BAD))
+                continue
+            if not (QUALITY[i1]['covered'] and QUALITY[i2]['covered']) and verbose:
+                print('WARNING: [%s] input spectra not fully cover the wavelength domain !' %job['SN_name'])
+            PENDING.append((job, i1, i2))
+
+        for g0 in range(0, len(PENDING), sn_per_call):
+            GROUP = PENDING[g0: g0+sn_per_call]
+            M = len(OpPHA)
+            phases_o = np.repeat([job['phase_1'] for job, i1, i2 in GROUP], M)
+            phases_t = np.repeat([job['phase_2'] for job, i1, i2 in GROUP], M)
+            phases_out = np.tile(OpPHA, len(GROUP))
+            FPCA_PARAM_o = np.repeat(FPCA_PARAM[[i1 for job, i1, i2 in GROUP]], M, axis=0)
+            FPCA_PARAM_t = np.repeat(FPCA_PARAM[[i2 for job, i1, i2 in GROUP]], M, axis=0)
+
+            PredBatchDict = SNAIL_Predict_Deep.SPD_Batch(FPCA_PARAM_o=FPCA_PARAM_o, phases_o=phases_o, \
+                FPCA_PARAM_t=FPCA_PARAM_t, phases_t=phases_t, phases_out=phases_out, lstm_model=lstm_model, \
+                num_forward_pass=num_forward_pass, passes_per_call=passes_per_call, batch_size=batch_size, seed=seed)
+
+            for k, (job, i1, i2) in enumerate(GROUP):
+                ESurface = PredBatchDict['flux'][k*M: (k+1)*M]
+                eSurface = PredBatchDict['fluxerr'][k*M: (k+1)*M]
+
+                # *** write FITS atomically
+                hdr = fits.Header()
+                hdr['SN_NAME'] = job['SN_name']
+                hdr['PHASE_1'], hdr['PHASE_2'] = job['phase_1'], job['phase_2']
+                hdr['NFPASS'] = PredBatchDict['num_forward_pass']
+                if seed is not None: hdr['MCSEED'] = seed
+                hdr['PHAMIN'], hdr['PHAMAX'], hdr['PHASTEP'] = OpPHA[0], OpPHA[-1], SNAIL_Template.OpPcadence
+                hdul = fits.HDUList([fits.PrimaryHDU(ESurface.T, header=hdr), \
+                                     fits.ImageHDU(eSurface.T, name='FLUXERR')])
+                FITS_TMP = FITS_OUT(job['SN_name']) + '.tmp'
+                hdul.writeto(FITS_TMP, overwrite=True)
+                os.replace(FITS_TMP, FITS_OUT(job['SN_name']))
+                STATUS[job['SN_name']] = 'done'
+
+            if verbose: print('CheckPoint: [3] templates of [%d / %d] SNe generated' \
+                %(min(g0+sn_per_call, len(PENDING)), len(PENDING)))
+
+        return STATUS
+
+def main(argv=None):
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate spectral templates of SNe listed in a manifest.')
+    parser.add_argument('manifest', help='manifest csv (SN_name, redshift, phase_1, file_1, phase_2, file_2)')
+    parser.add_argument('--model', required=True, help='path of the LSTM model (e.g., BiLSTM4ST.h5) or its exported weights (.npz)')
+    parser.add_argument('--outdir', required=True, help='output directory of the FITS templates')
+    parser.add_argument('--workdir', default=None, help='directory of checkpoints')
+    parser.add_argument('--num-forward-pass', type=int, default=64)
+    parser.add_argument('--num-workers', type=int, default=1, help='worker processes for homogenization')
+    parser.add_argument('--sn-per-call', type=int, default=8, help='SNe per batched MC-dropout prediction')
+    parser.add_argument('--seed', type=int, default=None, help='seed of MC-dropout (requires .npz weights)')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args(argv)
+
+    # NOTE: weights exported by Export_BiLSTM (.npz) run on the NumPy engine, without TensorFlow
+    if args.model.endswith('.npz'):
+        from snail.utils.NumpyLSTM import NumpyBiLSTM
+        lstm_model = NumpyBiLSTM.Load(args.model)
+    else:
+        from tensorflow.keras.models import load_model
+        lstm_model = load_model(args.model)
+    STATUS = SNAIL_Template.STG(Manifest=args.manifest, lstm_model=lstm_model, OutDir=args.outdir, \
+        WorkDir=args.workdir, num_forward_pass=args.num_forward_pass, num_workers=args.num_workers, \
+        sn_per_call=args.sn_per_call, overwrite=args.overwrite, seed=args.seed)
+    for SN_name in STATUS: print('%s | %s' %(SN_name, STATUS[SN_name]))
+    return int(any(status.startswith('failed') for status in STATUS.values()))
+
+if __name__ == '__main__':
+    sys.exit(main())
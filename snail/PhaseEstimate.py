@@ -3,10 +3,142 @@ from snail.Predict import SNAIL_Predict_Deep
 from snail.utils.SpecFPCA import FPCA_Parameterize
 from snail.utils.GPLightCurve import GP_Interpolator
 
+def GoldenSectionSearch(func, lower, upper, xatol=0.05):
+    # NOTE: golden-section search of a (unimodal) function on [lower, upper],
+    #       func takes an array of phases and returns an array of MAPE.
+    invphi = (np.sqrt(5.0) - 1.0) / 2.0
+    a, b = lower, upper
+    c, d = b - invphi*(b-a), a + invphi*(b-a)
+    fc, fd = func(np.array([c, d]))
+    while abs(b - a) > xatol:
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - invphi*(b-a)
+            fc = func(np.array([c]))[0]
+        else:
+            a, c, fc = c, d, fd
+            d = a + invphi*(b-a)
+            fd = func(np.array([d]))[0]
+    return (a + b) / 2.0
+
+def BoundedBrentSearch(func, lower, upper, xatol=0.05):
+    # NOTE: Brent's method (bounded) of a (unimodal) function on [lower, upper],
+    #       func takes an array of phases and returns an array of MAPE.
+    from scipy.optimize import minimize_scalar
+    res = minimize_scalar(lambda x: func(np.array([x]))[0], bounds=(lower, upper), \
+        method='bounded', options={'xatol': xatol})
+    return res.x
+
+def myrange(start, stop, step, rtol=1e-05, atol=0.001):
+    # ** a modified np.arange always including the endpoint
+    # NOTE: a evenly separated sequence (except the last interval) always including endpoint
+    #       default atol is 0.001 day ~ 1.4 min.
+    SEQ = np.arange(start, stop, step)
+    if not np.isclose(SEQ[-1], stop, rtol=rtol, atol=atol):
+        """
+        # criterion of np.isclose:
+        # absolute(`a` - `b`) <= (`atol` + `rtol` * absolute(`b`))
+        """
+        SEQ = np.append(SEQ, stop)
+    return SEQ
+
+class PhaseSearchEngine:
+
+    # NOTE: a coarse-to-fine search of the phase hypothesis minimizing an objective (e.g., MAPE),
+    #       objective takes an array of phase hypotheses and returns an array of objective values, 
+    #       so that each search step is evaluated in one batch. The evaluations are memoized on 
+    #       a quantized phase key (phase_quantum, default 0.001 day), such that near-identical 
+    #       grid points (e.g., from accumulation of 0.1-day steps) are evaluated only once.
+    #
+    #       refine: strategy to refine the coarse minimum (of the 2-day grid),
+    #               'grid': two finer grids (0.5 day within +/- 4 days, then 0.1 day within +/- 1 day).
+    #               'golden' / 'brent': golden-section / bounded Brent search within the coarse minimum +/- 2 days.
+    #               callable: refine(func, pbest, lower, upper), where func(phases) returns the objective array.
+    #
+    #       metrics: 'num_evaluations' (number of phase hypotheses evaluated by the model),
+    #                'num_batches' (number of batched objective calls), 'num_cache_hits'.
+
+    def __init__(self, objective, PLBound, PUBound, phase_quantum=0.001):
+        self.objective = objective
+        self.PLBound, self.PUBound = PLBound, PUBound
+        self.phase_quantum = phase_quantum
+        self.AutoDICT = {}    # quantized key -> (phase, objective value)
+        self.metrics = {'num_evaluations': 0, 'num_batches': 0, 'num_cache_hits': 0}
+
+    def evaluate(self, PHASES_HYPO):
+        PHASES_HYPO = np.atleast_1d(PHASES_HYPO).astype(float)
+        KEYS = [int(np.round(phase_hypo / self.phase_quantum)) for phase_hypo in PHASES_HYPO]
+        
+        NEWDICT = {}
+        for key, phase_hypo in zip(KEYS, PHASES_HYPO):
+            if key in self.AutoDICT or key in NEWDICT: self.metrics['num_cache_hits'] += 1
+            else: NEWDICT[key] = phase_hypo
+        
+        if len(NEWDICT) > 0:
+            PHASES_NEW = np.array([NEWDICT[key] for key in NEWDICT])
+            VALUES_NEW = self.objective(PHASES_NEW)
+            for key, phase_hypo, value in zip(NEWDICT, PHASES_NEW, VALUES_NEW):
+                self.AutoDICT[key] = (phase_hypo, value)
+            self.metrics['num_evaluations'] += len(NEWDICT)
+            self.metrics['num_batches'] += 1
+        
+        return np.array([self.AutoDICT[key][1] for key in KEYS])
+
+    def best(self):
+        key = min(self.AutoDICT, key=lambda k: self.AutoDICT[k][1])
+        return self.AutoDICT[key][0]
+
+    def search(self, refine='grid'):
+        PLBound, PUBound = self.PLBound, self.PUBound
+        # ** initial grid guess with 2 days resolution, phase in full range
+        PGuess1 = myrange(PLBound, PUBound, 2.0)
+        self.evaluate(PGuess1)
+        _pbest = self.best()
+        
+        if refine == 'grid':
+            # ** second grid guess with 0.5 days resolution, phase in narrow range: previous best +/- 4 days
+            PGuess2 = myrange(max(_pbest-4.0, PLBound), min(_pbest+4.0, PUBound), 0.5)
+            self.evaluate(PGuess2)
+                    
+            # ** third grid guess with 0.1 days resolution, phase in narrow range: previous best +/- 1 days
+            _pbest = self.best()
+            PGuess3 = myrange(max(_pbest-1.0, PLBound), min(_pbest+1.0, PUBound), 0.1)
+            self.evaluate(PGuess3)
+        else:
+            lower, upper = max(_pbest-2.0, PLBound), min(_pbest+2.0, PUBound)
+            if refine == 'golden': GoldenSectionSearch(self.evaluate, lower, upper, xatol=0.05)
+            elif refine == 'brent': BoundedBrentSearch(self.evaluate, lower, upper, xatol=0.05)
+            else: refine(self.evaluate, _pbest, lower, upper)
+        
+        return self.best()
+
+    def fit_curve(self, FAKE_MAPE_ERROR=0.2):
+        # ** leverage GP to fit a smooth curve
+        PHA_HP = np.array([self.AutoDICT[key][0] for key in self.AutoDICT])
+        MAPE_HP = np.array([self.AutoDICT[key][1] for key in self.AutoDICT])
+        SORT = np.argsort(PHA_HP)
+        PHA_HP, MAPE_HP = PHA_HP[SORT], MAPE_HP[SORT]
+        GPHA_HP = np.arange(self.PLBound, self.PUBound, 0.05)
+        GMAPE_HP, eGMAPE_HP = GP_Interpolator(PHA_HP, MAPE_HP, \
+            np.nan*np.ones(len(MAPE_HP)), GPHA_HP, NaN_fill=FAKE_MAPE_ERROR)
+        
+        return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP
+
+def Calculate_MAPE(Flux_in, Flstm, BadWaveMask_in=None):
+    # ** MAPE of predictions Flstm (shape (M, 1700)) w.r.t the input spectrum
+    ape = 100.0*np.abs((Flux_in[None, :]-Flstm)/np.clip(np.abs(Flux_in[None, :]), a_min=1e-7, a_max=None))
+    if BadWaveMask_in is None: MAPE = np.mean(ape, axis=1)    # MAPE over all wavelength
+    else: MAPE = np.mean(ape[:, ~BadWaveMask_in], axis=1)     # MAPE over valid wavelength
+    return MAPE
+
 class FitSingleSpecPhase:
     @staticmethod
-    def FSSP(Wave_in, Flux_in, lstm_model, PATH_R, BadWaveMask_in=None, num_forward_pass=64, FAKE_MAPE_ERROR=0.2):
+    def FSSP(Wave_in, Flux_in, lstm_model, PATH_R=None, BadWaveMask_in=None, num_forward_pass=64, FAKE_MAPE_ERROR=0.2, \
+        adaptive=False, min_forward_pass=16, rtol_forward_pass=0.01, refine='grid', return_metrics=False, \
+        seed=None):
         # **** this function only support a single spectrum as input **** #
+        # NOTE: see PhaseSearchEngine for the remarks on refine and the search metrics.
+        #       seed: seeded MC-dropout (see SNAIL_Predict_Deep.MCDropout) for reproducible phase estimates.
 
         # ** verify inputs (standard wavelength and normalized flux)
         RCut0, RCut1 = 3800, 7200
@@ -17,72 +149,37 @@ class FitSingleSpecPhase:
         # ** fpca parameterization
         FPCA_PARAM = FPCA_Parameterize(WAVE, Flux_in, PATH_R)
 
-        # ** define auto-prediction function
-        def auto_predict(phase_hypo):
-            PredSpecDict = SNAIL_Predict_Deep.SPD(FPCA_PARAM_o=FPCA_PARAM, phase_o=phase_hypo, \
-                                                   FPCA_PARAM_t=FPCA_PARAM, phase_t=phase_hypo, \
-                                                   phases_out=np.array([phase_hypo]), lstm_model=lstm_model, \
-                                                   num_forward_pass=num_forward_pass)
-            Flstm = PredSpecDict[phase_hypo]['flux']
-            ape = 100.0*np.abs((Flux_in-Flstm)/np.clip(np.abs(Flux_in), a_min=1e-7, a_max=None))
-            if BadWaveMask_in is None: mape = np.mean(ape)    # MAPE over all wavelength
-            else: mape = np.mean(ape[~BadWaveMask_in])        # MAPE over valid wavelength
-            return mape
-        
-        # ** define a modified np.arange always including the endpoint
-        def myrange(start, stop, step, rtol=1e-05, atol=0.001):
-            # NOTE: a evenly separated sequence (except the last interval) always including endpoint
-            #       default atol is 0.001 day ~ 1.4 min.
-            SEQ = np.arange(start, stop, step)
-            if not np.isclose(SEQ[-1], stop, rtol=rtol, atol=atol):
-                """
-                # criterion of np.isclose:
-                # absolute(`a` - `b`) <= (`atol` + `rtol` * absolute(`b`))
-                """
-                SEQ = np.append(SEQ, stop)
-            return SEQ        
-
-        AutoDICT = {}
-        PLBound, PUBound = -15.0, +33.0
-        # ** initial grid guess with 2 days resolution, phase in full range [-15.0, +33.0]
-        PGuess1 = myrange(PLBound, PUBound, 2.0)
-        for phase_hypo in PGuess1:
-            mape = auto_predict(phase_hypo)
-            AutoDICT[phase_hypo] = mape
-
-        # ** second grid guess with 0.5 days resolution, phase in narrow range: previous best +/- 4 days
-        _pbest = min(AutoDICT, key=AutoDICT.get)
-        PGuess2 = myrange(max(_pbest-4.0, PLBound), min(_pbest+4.0, PUBound), 0.5)
-        for phase_hypo in PGuess2:
-            if phase_hypo not in AutoDICT:
-                mape = auto_predict(phase_hypo)
-                AutoDICT[phase_hypo] = mape
-                
-        # ** third grid guess with 0.1 days resolution, phase in narrow range: previous best +/- 1 days
-        _pbest = min(AutoDICT, key=AutoDICT.get)
-        PGuess3 = myrange(max(_pbest-1.0, PLBound), min(_pbest+1.0, PUBound), 0.1)
-        for phase_hypo in PGuess3:
-            if phase_hypo not in AutoDICT:
-                mape = auto_predict(phase_hypo)
-                AutoDICT[phase_hypo] = mape
-        
-        # ** leverage GP to fit a smooth curve
-        PHA_HP = np.array([phase_hypo for phase_hypo in AutoDICT])
-        MAPE_HP = np.array([AutoDICT[phase_hypo] for phase_hypo in AutoDICT])
-        SORT = np.argsort(PHA_HP)
-        PHA_HP, MAPE_HP = PHA_HP[SORT], MAPE_HP[SORT]
-        GPHA_HP = np.arange(PLBound, PUBound, 0.05)
-        GMAPE_HP, eGMAPE_HP = GP_Interpolator(PHA_HP, MAPE_HP, \
-            np.nan*np.ones(len(MAPE_HP)), GPHA_HP, NaN_fill=FAKE_MAPE_ERROR)
+        # ** define auto-prediction function (vectorized over phase hypotheses)
+        def auto_predict(PHASES_HYPO):
+            PredBatchDict = SNAIL_Predict_Deep.SPD_Batch(FPCA_PARAM_o=FPCA_PARAM, phases_o=PHASES_HYPO, \
+                                                         FPCA_PARAM_t=FPCA_PARAM, phases_t=PHASES_HYPO, \
+                                                         phases_out=PHASES_HYPO, lstm_model=lstm_model, \
+                                                         num_forward_pass=num_forward_pass, adaptive=adaptive, \
+                                                         min_forward_pass=min_forward_pass, rtol_forward_pass=rtol_forward_pass, \
+                                                         seed=seed)
+            MAPE = Calculate_MAPE(Flux_in, PredBatchDict['flux'], BadWaveMask_in)
+            return MAPE
 
-        return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP
+        # ** search phase in full range [-15.0, +33.0]
+        PSE = PhaseSearchEngine(auto_predict, PLBound=-15.0, PUBound=+33.0)
+        PSE.search(refine=refine)
+        PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP = PSE.fit_curve(FAKE_MAPE_ERROR=FAKE_MAPE_ERROR)
+
+        if return_metrics:
+            return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP, PSE.metrics
+        else:
+            return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP
 
 
 class FitDoubleSpecPhase:
     @staticmethod
-    def FDSP(Wave_in1, Flux_in1, Wave_in2, Flux_in2, delta_phase, lstm_model, PATH_R, \
-        BadWaveMask_in1=None, BadWaveMask_in2=None, num_forward_pass=64, FAKE_MAPE_ERROR=0.2):
+    def FDSP(Wave_in1, Flux_in1, Wave_in2, Flux_in2, delta_phase, lstm_model, PATH_R=None, \
+        BadWaveMask_in1=None, BadWaveMask_in2=None, num_forward_pass=64, FAKE_MAPE_ERROR=0.2, \
+        adaptive=False, min_forward_pass=16, rtol_forward_pass=0.01, refine='grid', return_metrics=False, \
+        seed=None):
         # **** this function support a pair of phase-unknown spectra as input (with certain delta phase) **** #
+        # NOTE: see PhaseSearchEngine for the remarks on refine and the search metrics.
+        #       seed: seeded MC-dropout (see SNAIL_Predict_Deep.MCDropout) for reproducible phase estimates.
 
         # ** verify inputs (standard wavelength and normalized flux)
         RCut0, RCut1 = 3800, 7200
@@ -96,69 +193,29 @@ class FitDoubleSpecPhase:
         FPCA_PARAM_o = FPCA_Parameterize(WAVE, Flux_in1, PATH_R)
         FPCA_PARAM_t = FPCA_Parameterize(WAVE, Flux_in2, PATH_R)
 
-        # ** define auto-prediction function
+        # ** define auto-prediction function (vectorized over phase hypotheses)
         #    NOTE: In our convention, phase_hypo is the hypothesized phase of the first spectrum.
-        def auto_predict(phase_hypo):
-            phase_o, phase_t = phase_hypo, phase_hypo + delta_phase
-            PredSpecDict = SNAIL_Predict_Deep.SPD(FPCA_PARAM_o=FPCA_PARAM_o, phase_o=phase_o, \
-                                                FPCA_PARAM_t=FPCA_PARAM_t, phase_t=phase_t, \
-                                                phases_out=np.array([phase_o, phase_t]), \
-                                                lstm_model=lstm_model, num_forward_pass=num_forward_pass)
-            mape = []
-            for phase, Flux_in, BadWaveMask_in in zip([phase_o, phase_t], \
-                [Flux_in1, Flux_in2], [BadWaveMask_in1, BadWaveMask_in2]):
-                Flstm = PredSpecDict[phase]['flux']
-                _ape = 100.0*np.abs((Flux_in-Flstm)/np.clip(np.abs(Flux_in), a_min=1e-7, a_max=None))
-                if BadWaveMask_in is None: _mape = np.mean(_ape)    # MAPE over all wavelength
-                else: _mape = np.mean(_ape[~BadWaveMask_in])        # MAPE over valid wavelength
-                mape.append(_mape)
-            mape = np.mean(mape)     # NOTE use the average
-            return mape
-        
-        # ** define a modified np.arange always including the endpoint
-        def myrange(start, stop, step, rtol=1e-05, atol=0.001):
-            # NOTE: a evenly separated sequence (except the last interval) always including endpoint
-            #       default atol is 0.001 day ~ 1.4 min.
-            SEQ = np.arange(start, stop, step)
-            if not np.isclose(SEQ[-1], stop, rtol=rtol, atol=atol):
-                """
-                # criterion of np.isclose:
-                # absolute(`a` - `b`) <= (`atol` + `rtol` * absolute(`b`))
-                """
-                SEQ = np.append(SEQ, stop)
-            return SEQ        
-
-        AutoDICT = {}
-        PLBound, PUBound = -15.0, 33.01-delta_phase
-        # ** initial grid guess with 2 days resolution, phase in full range [-15.0, +33.0-delta_phase]
-        PGuess1 = myrange(PLBound, PUBound, 2.0)
-        for phase_hypo in PGuess1:
-            mape = auto_predict(phase_hypo)
-            AutoDICT[phase_hypo] = mape
-
-        # ** second grid guess with 0.5 days resolution, phase in narrow range: previous best +/- 4 days
-        _pbest = min(AutoDICT, key=AutoDICT.get)
-        PGuess2 = myrange(max(_pbest-4.0, PLBound), min(_pbest+4.0, PUBound), 0.5)
-        for phase_hypo in PGuess2:
-            if phase_hypo not in AutoDICT:
-                mape = auto_predict(phase_hypo)
-                AutoDICT[phase_hypo] = mape
-                
-        # ** third grid guess with 0.1 days resolution, phase in narrow range: previous best +/- 1 days
-        _pbest = min(AutoDICT, key=AutoDICT.get)
-        PGuess3 = myrange(max(_pbest-1.0, PLBound), min(_pbest+1.0, PUBound), 0.1)
-        for phase_hypo in PGuess3:
-            if phase_hypo not in AutoDICT:
-                mape = auto_predict(phase_hypo)
-                AutoDICT[phase_hypo] = mape
-        
-        # ** leverage GP to fit a smooth curve
-        PHA_HP = np.array([phase_hypo for phase_hypo in AutoDICT])
-        MAPE_HP = np.array([AutoDICT[phase_hypo] for phase_hypo in AutoDICT])
-        SORT = np.argsort(PHA_HP)
-        PHA_HP, MAPE_HP = PHA_HP[SORT], MAPE_HP[SORT]
-        GPHA_HP = np.arange(PLBound, PUBound, 0.05)
-        GMAPE_HP, eGMAPE_HP = GP_Interpolator(PHA_HP, MAPE_HP, \
-            np.nan*np.ones(len(MAPE_HP)), GPHA_HP, NaN_fill=FAKE_MAPE_ERROR)
+        #          the outputs at phase_o & phase_t of all hypotheses are predicted in a single batch.
+        def auto_predict(PHASES_HYPO):
+            M = len(PHASES_HYPO)
+            PHASES_O, PHASES_T = PHASES_HYPO, PHASES_HYPO + delta_phase
+            PredBatchDict = SNAIL_Predict_Deep.SPD_Batch(FPCA_PARAM_o=FPCA_PARAM_o, phases_o=np.tile(PHASES_O, 2), \
+                                                         FPCA_PARAM_t=FPCA_PARAM_t, phases_t=np.tile(PHASES_T, 2), \
+                                                         phases_out=np.concatenate([PHASES_O, PHASES_T]), lstm_model=lstm_model, \
+                                                         num_forward_pass=num_forward_pass, adaptive=adaptive, \
+                                                         min_forward_pass=min_forward_pass, rtol_forward_pass=rtol_forward_pass, \
+                                                         seed=seed)
+            MAPE_o = Calculate_MAPE(Flux_in1, PredBatchDict['flux'][:M], BadWaveMask_in1)
+            MAPE_t = Calculate_MAPE(Flux_in2, PredBatchDict['flux'][M:], BadWaveMask_in2)
+            MAPE = (MAPE_o + MAPE_t) / 2.0     # NOTE use the average
+            return MAPE
 
-        return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP
+        # ** search phase in full range [-15.0, +33.0-delta_phase]
+        PSE = PhaseSearchEngine(auto_predict, PLBound=-15.0, PUBound=33.01-delta_phase)
+        PSE.search(refine=refine)
+        PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP = PSE.fit_curve(FAKE_MAPE_ERROR=FAKE_MAPE_ERROR)
+
+        if return_metrics:
+            return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP, PSE.metrics
+        else:
+            return PHA_HP, MAPE_HP, GPHA_HP, GMAPE_HP, eGMAPE_HP
@@ -1,15 +1,114 @@
 import numpy as np
-from scipy.interpolate import interp1d
-from snail.utils.SpecFPCA import FPCA_Parameterize, FPCA_Reconstruct
+from snail.utils.OnlineStats import OnlineSurfaceStats
+from snail.utils.SpecFPCA import FPCA_Parameterize, FPCA_Reconstruct_Batch
 # version: Mar 18, 2023
 
 __author__ = "Lei Hu <hulei@pmo.ac.cn>"
 __version__ = "v1.1.3"
 
+# NOTE: (approximate) number of LSTM input samples per predict call in MC-dropout
+MC_SAMPLES_PER_CALL = 4096
+
 class SNAIL_Predict_Deep:
+    @staticmethod
+    def MCDropout(XDATA, lstm_model, num_forward_pass=64, return_all_forward_pass=False, \
+        passes_per_call=None, batch_size=None, percentiles=None, \
+        adaptive=False, min_forward_pass=16, rtol_forward_pass=0.01, seed=None, pass_offset=0):
+
+        # ** Remarks on batched MC-dropout
+        #    The forward passes are tiled into a single LSTM input of shape (npass x nsamp, 2, 186),
+        #    so that one lstm_model.predict call serves multiple passes (dropout masks are drawn per sample).
+        #    passes_per_call: number of forward passes per predict call, 
+        #                     default (None) is as many as fit in ~MC_SAMPLES_PER_CALL samples.
+        #    batch_size: batch size of lstm_model.predict (None means the Keras default).
+        #    The mean & variance are accumulated in streaming form, the full SurfacePile is 
+        #    only allocated when return_all_forward_pass=True.
+        #    percentiles: e.g., [16, 50, 84], if given, streaming estimates (P-square sketch) 
+        #                 of these percentiles are tracked as well.
+        #
+        # ** Remarks on adaptive MC-dropout
+        #    adaptive=True: keep running forward passes (in blocks) until the Monte Carlo standard error 
+        #    of the mean surface, std / sqrt(n), relative to the flux (averaged over all pixels, i.e.,
+        #    mean(std / sqrt(n)) / mean(|mean|)) is below rtol_forward_pass, with at least min_forward_pass 
+        #    and at most num_forward_pass passes. The number of passes used is MCStats.count.
+        #    NOTE: the required number of passes is about (s / rtol_forward_pass)^2, where s is the typical
+        #          relative MC-dropout scatter of the flux, e.g., s = 2% stops at min_forward_pass (16),
+        #          s = 5% at ~25-32 passes, while s >= 8% runs to the cap num_forward_pass (64) with the defaults.
+        #          (the relative change of the running surfaces is not used, as the change of the std 
+        #           is dominated by its sampling noise ~ 1 / sqrt(2n) regardless of the flux scale.)
+        #
+        # ** Remarks on seeded MC-dropout
+        #    seed=None uses the dropout of the model itself (e.g., Keras training=True), which is not reproducible.
+        #    With a given seed, the dropout masks of each block of passes are drawn up front as one tensor by
+        #    lstm_model.Draw_Masks (only NumpyBiLSTM supports it), and the forward pass p (counted from pass_offset) 
+        #    always uses the masks of generator [seed, p]. Thus the passes can be sharded across processes,
+        #    e.g., shard j runs pass_offset = j * num_forward_pass, and the MCStats are merged exactly by MCStats.merge.
+        #    (the MCStats are returned by SPD & SLP with return_mcstats=True, and by SPD_Batch in the key 'mcstats').
+
+        NSAMP = XDATA.shape[0]
+        if seed is not None and not hasattr(lstm_model, 'Draw_Masks'):
+            raise ValueError('Seeded MC-dropout requires a lstm_model with Draw_Masks (e.g., NumpyBiLSTM) !')
+        if passes_per_call is None:
+            passes_per_call = max(1, MC_SAMPLES_PER_CALL // NSAMP)
+        if adaptive:
+            # NOTE: min_forward_pass is capped by num_forward_pass (i.e., no early stopping for few passes)
+            min_forward_pass = min(min_forward_pass, num_forward_pass)
+            if min_forward_pass < 2:
+                raise ValueError('Adaptive MC-dropout requires at least 2 forward passes !')
+            passes_per_call = min(passes_per_call, max(1, min_forward_pass // 2))
+        passes_per_call = min(passes_per_call, num_forward_pass)
+
+        # ** perform LSTM prediction
+        def walkthrough(npass, pass0):
+            XTILE = np.tile(XDATA, (npass, 1, 1))
+            kwargs = {} if batch_size is None else {'batch_size': batch_size}
+            if seed is not None:
+                kwargs['masks'] = lstm_model.Draw_Masks(NSAMP, range(pass_offset+pass0, pass_offset+pass0+npass), seed)
+            YDATA = lstm_model.predict(XTILE, **kwargs)
+            #*#*#*# + Adjust form [back to single-layer] #*#*#*#
+            YDATA = np.mean(YDATA, axis=1)
+
+            # NOTE: reconstruction & resampling on wavelength in a single batched step
+            RecSpecDict = FPCA_Reconstruct_Batch(YDATA.reshape((YDATA.shape[0], 2, -1)), resample=True)
+            F_pred = RecSpecDict['flux']
+            F_pred = F_pred / np.mean(F_pred, axis=1)[:, None]     # NOTE Normalization [subtle change expected]
+            SurfaceBlock = F_pred.reshape((npass, NSAMP, -1))
+            return SurfaceBlock
+    
+        def relstderr(MCStats):
+            return np.mean(MCStats.std(ddof=1) / np.sqrt(MCStats.count)) / max(np.mean(np.abs(MCStats.mean)), 1e-30)
+
+        MCStats = OnlineSurfaceStats(percentiles=percentiles)
+        SurfacePile = []
+        for _idx in range(0, num_forward_pass, passes_per_call):
+            npass = min(passes_per_call, num_forward_pass - _idx)
+            SurfaceBlock = walkthrough(npass, _idx)
+            MCStats.update(SurfaceBlock)
+            if return_all_forward_pass:
+                SurfacePile.append(SurfaceBlock)
+            
+            # NOTE: early stopping for adaptive MC-dropout
+            if adaptive and MCStats.count >= min_forward_pass:
+                if relstderr(MCStats) < rtol_forward_pass: break
+        
+        if return_all_forward_pass:
+            SurfacePile = np.concatenate(SurfacePile, axis=0)
+        else: SurfacePile = None
+        
+        return MCStats, SurfacePile
+
     @staticmethod
     def SPD(FPCA_PARAM_o, phase_o, FPCA_PARAM_t, phase_t, phases_out, lstm_model, \
-        num_forward_pass=64, return_all_forward_pass=False):
+        num_forward_pass=64, return_all_forward_pass=False, passes_per_call=None, batch_size=None, \
+        percentiles=None, adaptive=False, min_forward_pass=16, rtol_forward_pass=0.01, seed=None, pass_offset=0, \
+        return_mcstats=False):
+
+        # NOTE: see SNAIL_Predict_Deep.MCDropout for the remarks on the MC-dropout options.
+        #       percentiles are returned in an additional key 'fluxpct', and the number of 
+        #       forward passes used is reported in the key 'num_forward_pass'.
+        #       return_mcstats=True: the MCStats (OnlineSurfaceStats of the flux surface on phases_out) 
+        #       are returned as well, e.g., to merge the shards of seeded MC-dropout (see MCDropout),
+        #       i.e., PredSpecDict, [SurfacePile], MCStats.
 
         RCut0, RCut1 = 3800, 7200
         WAVE = np.arange(RCut0, RCut1, 2)
@@ -24,51 +123,80 @@ class SNAIL_Predict_Deep:
                            [phase_d, phase_t] + list(cff_t)])
             XDATA.append(xd)
         XDATA = np.array(XDATA)
-    
-        # ** perform LSTM prediction
-        def walkthrough():
-            YDATA = lstm_model.predict(XDATA)
-            #*#*#*# + Adjust form [back to single-layer] #*#*#*#
-            YDATA = np.array([np.mean(YDATA[k], axis=0) for k in range(YDATA.shape[0])])
-
-            Surface = []
-            for i, phase_d in enumerate(phases_out):
-                cff_pred = YDATA[i]
-                cf_pred = cff_pred.reshape((2, -1))
-                RecSpecDict = FPCA_Reconstruct(FPCA_PARAM=cf_pred)
-                WReC_pred, FReC_pred = RecSpecDict['wavelength'], RecSpecDict['flux']
-                imodel = interp1d(WReC_pred, FReC_pred, fill_value='extrapolate')
-                F_pred = imodel(WAVE)               # NOTE resampling on wavelength
-                FLUX_pred = F_pred / np.mean(F_pred)     # NOTE Normalization [subtle change expected]
-                Surface.append(FLUX_pred)
-            Surface = np.array(Surface)
-            return Surface
-    
-        SurfacePile = []
-        for _idx in range(num_forward_pass):
-            Surface = walkthrough() 
-            SurfacePile.append(Surface)
-        SurfacePile = np.array(SurfacePile)
         
-        ESurface = np.mean(SurfacePile, axis=0)
-        VSurface = np.var(SurfacePile, axis=0)
+        # ** perform MC-dropout LSTM prediction
+        MCStats, SurfacePile = SNAIL_Predict_Deep.MCDropout(XDATA=XDATA, lstm_model=lstm_model, \
+            num_forward_pass=num_forward_pass, return_all_forward_pass=return_all_forward_pass, \
+            passes_per_call=passes_per_call, batch_size=batch_size, percentiles=percentiles, \
+            adaptive=adaptive, min_forward_pass=min_forward_pass, rtol_forward_pass=rtol_forward_pass, \
+            seed=seed, pass_offset=pass_offset)
+
+        ESurface = MCStats.mean
+        VSurface = MCStats.variance()
+        if percentiles is not None:
+            PSurface = {q: MCStats.percentile(q) for q in percentiles}
         
         PredSpecDict = {}
         for idx, phase_d in enumerate(phases_out):
             PredSpecDict[phase_d] = {'wavelength': WAVE, \
                                      'flux': ESurface[idx], \
-                                     'fluxerr': np.sqrt(VSurface[idx])}
+                                     'fluxerr': np.sqrt(VSurface[idx]), \
+                                     'num_forward_pass': MCStats.count}
+            if percentiles is not None:
+                PredSpecDict[phase_d]['fluxpct'] = {q: PSurface[q][idx] for q in percentiles}
 
-        if return_all_forward_pass:
-            return PredSpecDict, SurfacePile
-        else:
-            return PredSpecDict
+        _res = (PredSpecDict, )
+        if return_all_forward_pass: _res += (SurfacePile, )
+        if return_mcstats: _res += (MCStats, )
+        return _res[0] if len(_res) == 1 else _res
+
+    @staticmethod
+    def SPD_Batch(FPCA_PARAM_o, phases_o, FPCA_PARAM_t, phases_t, phases_out, lstm_model, \
+        num_forward_pass=64, passes_per_call=None, batch_size=None, \
+        adaptive=False, min_forward_pass=16, rtol_forward_pass=0.01, seed=None, pass_offset=0):
+
+        # NOTE: predict many independent (phase_o, phase_t, phase_out) hypotheses in one go,
+        #       phases_o, phases_t and phases_out are arrays of the same length M,
+        #       FPCA_PARAM_o & FPCA_PARAM_t have shape (2, 92) (shared) or (M, 2, 92).
+        #       the output is a dictionary of arrays: 'flux' & 'fluxerr' have shape (M, 1700),
+        #       and 'mcstats' (OnlineSurfaceStats) for merging the shards of seeded MC-dropout.
+
+        RCut0, RCut1 = 3800, 7200
+        WAVE = np.arange(RCut0, RCut1, 2)
+
+        # ** construct LSTM input
+        phases_o = np.atleast_1d(phases_o).astype(float)
+        phases_t = np.atleast_1d(phases_t).astype(float)
+        phases_out = np.atleast_1d(phases_out).astype(float)
+        M = len(phases_out)
+        assert len(phases_o) == M and len(phases_t) == M
+        cff_o = np.broadcast_to(np.array(FPCA_PARAM_o).reshape((-1, 184)), (M, 184))
+        cff_t = np.broadcast_to(np.array(FPCA_PARAM_t).reshape((-1, 184)), (M, 184))
+
+        XDATA = np.zeros((M, 2, 186)).astype(float)
+        XDATA[:, :, 0] = phases_out[:, None]
+        XDATA[:, 0, 1], XDATA[:, 0, 2:] = phases_o, cff_o
+        XDATA[:, 1, 1], XDATA[:, 1, 2:] = phases_t, cff_t
+
+        # ** perform MC-dropout LSTM prediction
+        MCStats, _ = SNAIL_Predict_Deep.MCDropout(XDATA=XDATA, lstm_model=lstm_model, \
+            num_forward_pass=num_forward_pass, return_all_forward_pass=False, \
+            passes_per_call=passes_per_call, batch_size=batch_size, percentiles=None, \
+            adaptive=adaptive, min_forward_pass=min_forward_pass, rtol_forward_pass=rtol_forward_pass, \
+            seed=seed, pass_offset=pass_offset)
+
+        PredBatchDict = {'wavelength': WAVE, 'flux': MCStats.mean, 'fluxerr': MCStats.std(), \
+                         'num_forward_pass': MCStats.count, 'mcstats': MCStats}
+
+        return PredBatchDict
 
 class SNAIL_Predict:
     @staticmethod
     def SLP(Wave_in1, Flux_in1, phase_in1, Wave_in2, Flux_in2, phase_in2, \
-        phases_out, lstm_model, PATH_R, num_forward_pass=64, \
-        return_all_forward_pass=False):
+        phases_out, lstm_model, PATH_R=None, num_forward_pass=64, \
+        return_all_forward_pass=False, passes_per_call=None, batch_size=None, percentiles=None, \
+        adaptive=False, min_forward_pass=16, rtol_forward_pass=0.01, seed=None, pass_offset=0, \
+        return_mcstats=False):
 
         # ** verify inputs (standard wavelength and normalized flux)
         RCut0, RCut1 = 3800, 7200
@@ -90,6 +218,9 @@ class SNAIL_Predict:
         # ** predict
         _res = SNAIL_Predict_Deep.SPD(FPCA_PARAM_o=FPCA_PARAM_o, phase_o=phase_in1, \
             FPCA_PARAM_t=FPCA_PARAM_t, phase_t=phase_in2, phases_out=phases_out, lstm_model=lstm_model, \
-            num_forward_pass=num_forward_pass, return_all_forward_pass=return_all_forward_pass)
+            num_forward_pass=num_forward_pass, return_all_forward_pass=return_all_forward_pass, \
+            passes_per_call=passes_per_call, batch_size=batch_size, percentiles=percentiles, \
+            adaptive=adaptive, min_forward_pass=min_forward_pass, rtol_forward_pass=rtol_forward_pass, \
+            seed=seed, pass_offset=pass_offset, return_mcstats=return_mcstats)
     
         return _res
@@ -1,18 +1,148 @@
 import extinction
 import numpy as np
-from scipy.signal import savgol_filter
-from scipy.optimize import least_squares
+from scipy.signal import savgol_coeffs
+from scipy.optimize import brentq
 from scipy.interpolate import interp1d, splrep, splev
 from snail.utils.SpecGSmooth import AutoGSmooth
-from snail.utils.SyntheticPhot import SynPhot, Calculate_BmVoffset
+from snail.utils.SyntheticPhot import SynPhot_Weights, Load_PhotFilter, Calculate_BmVoffset
+
+# NOTE: Savitzky-Golay operators, (window, polyorder) -> (coeffs, left edge matrix, right edge matrix)
+SG_CACHE = {}
+
+# NOTE: homogenization operators, rest-frame (trimmed) wavelength grid -> sparse matrix (see HS_Operator)
+HS_OPERATOR_CACHE = {}
+HS_OPERATOR_CACHE_SIZE = 32
+HS_GRID_SEEN = {}         # hash of the grids homogenized so far (method='auto' in HS_Core)
+
+# NOTE: CCM89 extinction curves per unit E(B-V), (wavelength grid, Rv) -> A(λ) / E(B-V)
+CCM89_CACHE = {}
+
+# NOTE: per-spectrum quality flags of HomogenizeSpec (structured array)
+#       wmin, wmax: rest-frame wavelength range of the raw spectrum
+#       coverage: fraction of [RCut0, RCut1] covered by the raw spectrum
+#       covered: full coverage of [RCut0, RCut1]
+#       deredshifted: whether deredshifting was performed
+#       finite: all homogenized fluxes are finite
+#       success: the spectrum was homogenized without exception
+HS_QUALITY_DTYPE = [('wmin', float), ('wmax', float), ('coverage', float), ('covered', bool), \
+                    ('deredshifted', bool), ('finite', bool), ('success', bool)]
+
+def SG_Operator(window, polyorder):
+
+    # NOTE: the operator of savgol_filter(y, window, polyorder) with the default mode='interp',
+    #       i.e., convolution with the SG coefficients in the interior, and polynomial fits 
+    #       to the first (last) window points at the edges (as linear maps of these points).
+    if (window, polyorder) not in SG_CACHE:
+        half = window // 2
+        coeffs = savgol_coeffs(window, polyorder)
+        A = np.vander(np.arange(window).astype(float), polyorder+1)
+        PROJ = np.matmul(A, np.linalg.pinv(A))    # shape (window, window)
+        SG_CACHE[(window, polyorder)] = (coeffs, PROJ[:half], PROJ[half+1:])
+    return SG_CACHE[(window, polyorder)]
+
+def SG_Smooth(y, window, polyorder):
+
+    # NOTE: equivalent to savgol_filter(y, window, polyorder), but reuses the (cached) SG operator.
+    coeffs, EDGE_L, EDGE_R = SG_Operator(window, polyorder)
+    half = window // 2
+    ys = np.empty(len(y)).astype(float)
+    ys[half: len(y)-half] = np.convolve(y, coeffs, mode='valid')
+    ys[:half] = np.dot(EDGE_L, y[:window])
+    ys[len(y)-half:] = np.dot(EDGE_R, y[-window:])
+    return ys
+
+def Interp_Weights(x, x_new):
+
+    # NOTE: linear interpolation weights of interp1d(x, y, fill_value='extrapolate')(x_new) for sorted x,
+    #       i.e., y_new = W_lo * y[lo] + W_hi * y[hi].
+    idx = np.clip(np.searchsorted(x, x_new), 1, len(x)-1)
+    lo, hi = idx - 1, idx
+    W_hi = (x_new - x[lo]) / (x[hi] - x[lo])
+    return lo, hi, 1.0 - W_hi, W_hi
+
+def HS_Operator(tWave, window=145, polyorder=2):
+
+    # NOTE: the log-space SG-smoothing & resampling of HS (from the trimmed rest-frame spectrum 
+    #       to the standard wavelength) is linear in the flux, so it is composed into a single sparse 
+    #       matrix of shape (1700, len(tWave)), cached per (trimmed rest-frame) wavelength grid.
+    #       the upsampled signal is only evaluated at the SG rows required by the output wavelengths,
+    #       OP = B * S * A, where A: upsampling on log grid, S: SG-smoothing, B: resampling to WAVE.
+    from scipy.sparse import csr_matrix
+
+    key = (np.asarray(tWave, dtype=float).tobytes(), window, polyorder)
+    if key not in HS_OPERATOR_CACHE:
+        RCut0, RCut1 = 3800, 7200
+        WAVE = np.arange(RCut0, RCut1, 2)
+        coeffs, EDGE_L, EDGE_R = SG_Operator(window, polyorder)
+        half = window // 2
+        
+        # ** A: upsampling on log grid, shape (M, len(tWave))
+        L = np.log10(tWave)
+        LLog = np.arange(L.min(), L.max(), 0.00001)
+        M = len(LLog)
+        assert M >= window
+        lo, hi, W_lo, W_hi = Interp_Weights(L, LLog)
+        A = csr_matrix((np.array([W_lo, W_hi]).T.ravel(), np.array([lo, hi]).T.ravel(), \
+            np.arange(M+1)*2), shape=(M, len(L)))
+        
+        # ** B * S: SG rows (convolution in the interior, polynomial fits at edges) of the two
+        #    neighbouring log grid points of each output wavelength, shape (1700, M)
+        ROW_lo, ROW_hi, B_lo, B_hi = Interp_Weights(10**LLog, WAVE)
+        START = np.clip(ROW_lo - half, 0, M - window)
+        BSVALS = B_lo[:, None] * np.append(coeffs[::-1], 0.0)[None, :] + \
+                 B_hi[:, None] * np.append(0.0, coeffs[::-1])[None, :]     # convolution in the interior
+        for k in np.where(np.logical_or(ROW_lo < half, ROW_hi >= M - half))[0]:
+            # polynomial fits at edges (the few outputs close to the ends of the log grid)
+            BSVALS[k] = 0.0
+            for ROW, B in [(ROW_lo[k], B_lo[k]), (ROW_hi[k], B_hi[k])]:
+                _START = np.clip(ROW - half, 0, M - window)
+                if ROW < half: VALS = EDGE_L[ROW]
+                elif ROW >= M - half: VALS = EDGE_R[ROW - (M - half)]
+                else: VALS = coeffs[::-1]
+                BSVALS[k, _START - START[k]: _START - START[k] + window] += B * VALS
+        BSCOLS = np.clip(START[:, None] + np.arange(window+1)[None, :], 0, M-1)  # clipped ones have zero weight
+        BS = csr_matrix((BSVALS.ravel(), BSCOLS.ravel(), np.arange(len(WAVE)+1)*(window+1)), shape=(len(WAVE), M))
+        
+        if len(HS_OPERATOR_CACHE) >= HS_OPERATOR_CACHE_SIZE:
+            HS_OPERATOR_CACHE.pop(next(iter(HS_OPERATOR_CACHE)))
+        HS_OPERATOR_CACHE[key] = BS.dot(A)
+
+    return HS_OPERATOR_CACHE[key]
+
+def _HS_Chunk(args):
+    
+    # NOTE: homogenize a chunk of spectra (the task of a worker process in HS_Batch)
+    Triples, deredshift, method = args
+    FLUX_2D = np.full((len(Triples), 1700), np.nan)
+    QUALITY = np.zeros(len(Triples), dtype=HS_QUALITY_DTYPE)
+    for k, (Wave_Raw, Flux_Raw, redshift) in enumerate(Triples):
+        try:
+            _deredshift = deredshift and redshift is not None
+            FLUX_2D[k], QUALITY[k] = HomogenizeSpec.HS_Core(np.asarray(Wave_Raw, dtype=float), \
+                np.asarray(Flux_Raw, dtype=float), deredshift=_deredshift, redshift=redshift, method=method)
+        except Exception:
+            QUALITY[k]['success'] = False
+    return FLUX_2D, QUALITY
 
 class HomogenizeSpec:
     @staticmethod
-    def HS(Wave_Raw, Flux_Raw, deredshift=True, redshift=None):
+    def HS_Core(Wave_Raw, Flux_Raw, deredshift=True, redshift=None, method='auto'):
+
+        # NOTE: the homogenization without print, returns the homogenized flux and 
+        #       a record of quality flags (see HS_QUALITY_DTYPE).
+        #       method='operator': apply the cached sparse operator (see HS_Operator),
+        #       method='upsample': the original path via the full upsampled log grid,
+        #       method='auto': 'upsample' for a grid seen for the first time, otherwise 'operator'.
+        #       the two methods agree within ~1e-14 (full coverage) and ~1e-12 (partial coverage, extrapolated),
+        #       on the normalized flux (see tests/test_specproc.py).
+        #       per spectrum: ~3 ms (upsample), ~10 ms (operator, first use of a grid), 
+        #                     ~0.3 ms (operator, cached).
+        assert method in ['auto', 'operator', 'upsample']
 
         # ** Define Standard Wavelength [3800, 3802, ..., 7198]
         RCut0, RCut1 = 3800, 7200
         WAVE = np.arange(RCut0, RCut1, 2)
+        Quality = np.zeros(1, dtype=HS_QUALITY_DTYPE)[0]
         
         # ** Read Raw-Spec (sort wavelength)
         Wave, Flux = Wave_Raw.copy(), Flux_Raw.copy()
@@ -21,11 +151,11 @@ class HomogenizeSpec:
 
         # ** Enter the rest-frame by deredshifting
         if deredshift: Wave /= (1.0+redshift)   # obs-frame to rest-frame
-        else: print('WARNING: No deredshifting performed [make sure the raw spectrum already in rest-frame] !')
+        Quality['deredshifted'] = deredshift
         
-        if np.min(Wave) > RCut0 or np.max(Wave) < RCut1:
-            print('ERROR: Spectrum in Rest-Frame [%.1f A - %.1f A] not fully covers ' %(np.min(Wave), np.max(Wave)) + \
-                'the wavelength domain [%.1f A - %.1f A] required by our model !' %(RCut0, RCut1))
+        Quality['wmin'], Quality['wmax'] = np.min(Wave), np.max(Wave)
+        Quality['coverage'] = max(0.0, min(np.max(Wave), RCut1) - max(np.min(Wave), RCut0)) / (RCut1 - RCut0)
+        Quality['covered'] = np.min(Wave) <= RCut0 and np.max(Wave) >= RCut1
         
         # ** Spectrum trimming
         RangeMask = np.logical_and(Wave >= RCut0, Wave <= RCut1)
@@ -33,21 +163,146 @@ class HomogenizeSpec:
         
         # * SG-Smooth in Log-Space (Then Back) with UpSampling
         window = 145    # 1000 km/s, np.log10(1+1000/300000)
-        L = np.log10(tWave)
-        LLog = np.arange(L.min(), L.max(), 0.00001)
-        Lmodel = interp1d(L, tFlux, fill_value='extrapolate')
-        stFlux = savgol_filter(Lmodel(LLog), window, 2)
-        stWave = 10**LLog
+        if method == 'auto':
+            gkey = hash(tWave.tobytes())
+            method = 'operator' if gkey in HS_GRID_SEEN else 'upsample'
+            if len(HS_GRID_SEEN) >= 64*HS_OPERATOR_CACHE_SIZE: HS_GRID_SEEN.pop(next(iter(HS_GRID_SEEN)))
+            HS_GRID_SEEN[gkey] = True
+        if method == 'operator':
+            hFLUX = HS_Operator(tWave, window, 2).dot(tFlux)
+        else:
+            L = np.log10(tWave)
+            LLog = np.arange(L.min(), L.max(), 0.00001)
+            Lmodel = interp1d(L, tFlux, fill_value='extrapolate')
+            stFlux = SG_Smooth(Lmodel(LLog), window, 2)
+            stWave = 10**LLog
+            
+            # * Resampling
+            model = interp1d(stWave, stFlux, fill_value='extrapolate')
+            hFLUX = model(WAVE)
         
-        # * Resampling & Normalization
-        model = interp1d(stWave, stFlux, fill_value='extrapolate')
-        hFLUX = model(WAVE)
+        # * Normalization
         hFLUX /= np.mean(hFLUX)
         
+        Quality['finite'] = np.all(np.isfinite(hFLUX))
+        Quality['success'] = True
+
+        return hFLUX, Quality
+
+    @staticmethod
+    def HS(Wave_Raw, Flux_Raw, deredshift=True, redshift=None, method='auto'):
+
+        # ** Define Standard Wavelength [3800, 3802, ..., 7198]
+        RCut0, RCut1 = 3800, 7200
+        WAVE = np.arange(RCut0, RCut1, 2)
+        
+        hFLUX, Quality = HomogenizeSpec.HS_Core(Wave_Raw, Flux_Raw, deredshift=deredshift, redshift=redshift, \
+            method=method)
+        if not deredshift: 
+            print('WARNING: No deredshifting performed [make sure the raw spectrum already in rest-frame] !')
+        if not Quality['covered']:
+            print('ERROR: Spectrum in Rest-Frame [%.1f A - %.1f A] not fully covers ' %(Quality['wmin'], Quality['wmax']) + \
+                'the wavelength domain [%.1f A - %.1f A] required by our model !' %(RCut0, RCut1))
+
         HomoSpecDict = {'wavelength': WAVE, 'flux': hFLUX}  # in rest-frame
 
         return HomoSpecDict
 
+    @staticmethod
+    def HS_Batch(SpecIter, N=None, out=None, out_file=None, deredshift=True, num_workers=1, chunk_size=64, \
+        method='auto'):
+
+        # ** Remarks on batch homogenization
+        #    SpecIter: an iterable of (Wave_Raw, Flux_Raw, redshift) triples, consumed in a streaming manner,
+        #              redshift=None means the raw spectrum is already in rest-frame (no deredshifting).
+        #    N: number of spectra (default is len(SpecIter), required if SpecIter has no length).
+        #    out: a preallocated array of shape (N, 1700) to be filled, 
+        #         otherwise a memory-mapped .npy file is created if out_file is given, or a new array.
+        #    num_workers: number of worker processes (1 means in-process), each task is a chunk of 
+        #                 chunk_size spectra, at most 2 x num_workers chunks are in flight at a time.
+        #    returns a dictionary with keys 'wavelength', 'flux' (the output array) and 
+        #    'quality' (a structured array of shape (N,), see HS_QUALITY_DTYPE) instead of printing.
+        #    NOTE: failed spectra are filled with NaN and flagged by success=False.
+        #    method: see HomogenizeSpec.HS_Core.
+        
+        from itertools import islice
+        from collections import deque
+        RCut0, RCut1 = 3800, 7200
+        WAVE = np.arange(RCut0, RCut1, 2)
+
+        if N is None: N = len(SpecIter)
+        if out is None:
+            if out_file is not None:
+                out = np.lib.format.open_memmap(out_file, mode='w+', dtype=float, shape=(N, len(WAVE)))
+            else: out = np.zeros((N, len(WAVE))).astype(float)
+        assert out.shape == (N, len(WAVE))
+        QUALITY = np.zeros(N, dtype=HS_QUALITY_DTYPE)
+        
+        SpecIter = iter(SpecIter)
+        def chunks():
+            while True:
+                Triples = list(islice(SpecIter, chunk_size))
+                if len(Triples) == 0: break
+                yield Triples, deredshift, method
+        
+        def collect(i0, FLUX_2D, _QUALITY):
+            i1 = i0 + len(FLUX_2D)
+            assert i1 <= N
+            out[i0: i1], QUALITY[i0: i1] = FLUX_2D, _QUALITY
+            return i1
+        
+        i0 = 0
+        if num_workers is None or num_workers <= 1:
+            for task in chunks():
+                i0 = collect(i0, *_HS_Chunk(task))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                Futures = deque()
+                for task in chunks():
+                    Futures.append(executor.submit(_HS_Chunk, task))
+                    if len(Futures) >= 2*num_workers:
+                        i0 = collect(i0, *Futures.popleft().result())
+                while Futures:
+                    i0 = collect(i0, *Futures.popleft().result())
+        assert i0 == N
+        
+        if isinstance(out, np.memmap): out.flush()
+        HomoBatchDict = {'wavelength': WAVE, 'flux': out, 'quality': QUALITY}
+
+        return HomoBatchDict
+
+def CCM89_Curve(Wave, Rv=3.1):
+
+    # NOTE: extinction.ccm89(Wave, Av, Rv) is linear in Av, A(λ) = Ebv * CCM89_Curve(Wave, Rv)
+    key = (np.asarray(Wave, dtype=float).tobytes(), Rv)
+    if key not in CCM89_CACHE:
+        CCM89_CACHE[key] = extinction.ccm89(np.asarray(Wave, dtype=float), Rv, Rv)
+    return CCM89_CACHE[key]
+
+def ColorCalib_Engine(Flux, redshift, filtname_B, filtname_V, phot_system, Rv=3.1):
+
+    # NOTE: synthetic B-V of the spectrum (on the standard wavelength) reddened by a CCM89 curve,
+    #       as a vectorized function of Ebv, equivalent to the synthetic photometry (in obs-frame)
+    #       of the zero-padded spectrum on [1000, 10000) A (rest-frame), i.e., only the filter weights 
+    #       on the standard wavelength are required. NOTE: B-V does not depend on the normalization.
+    RCut0, RCut1 = 3800, 7200
+    PadWave = np.arange(1000, 10000, 2)
+    m = np.where(PadWave == RCut0)[0][0]
+    n = np.where(PadWave == RCut1)[0][0]
+    WB = SynPhot_Weights(PadWave*(1+redshift), filtname_B)[m: n]
+    WV = SynPhot_Weights(PadWave*(1+redshift), filtname_V)[m: n]
+    ZP = Load_PhotFilter(filtname_B)['%s_zero_mag' %phot_system] - \
+         Load_PhotFilter(filtname_V)['%s_zero_mag' %phot_system]
+    
+    CCM = CCM89_Curve(np.arange(RCut0, RCut1, 2), Rv)
+    FB, FV = Flux * WB, Flux * WV
+    def func_bmv(Ebv):
+        ExtRatio = 10**(np.multiply.outer(Ebv, CCM)/-2.5)
+        return -2.5 * np.log10(np.sum(FB * ExtRatio, axis=-1) / np.sum(FV * ExtRatio, axis=-1)) - ZP
+    
+    return func_bmv
+
 class CorrectSpec:
     @staticmethod
     def CS(Wave_Homo, Flux_Homo, phase, redshift, \
@@ -121,31 +376,23 @@ class CorrectSpec:
             def func_cc(Wave, Flux, Ebv, Rv=3.1, normalize=True):
                 ccFlux = Flux.copy()
                 if Ebv is not None:
-                    ExtRatio = 10**(extinction.ccm89(Wave.astype(float), Rv*Ebv, Rv)/-2.5)  # CCM89
+                    ExtRatio = 10**(Ebv * CCM89_Curve(Wave, Rv)/-2.5)  # CCM89 (cached curve)
                     ccFlux = Flux * ExtRatio    # apply extinction
                 if normalize:
                     ccFlux = ccFlux / np.mean(ccFlux)  # Normalize
                 return ccFlux
             
-            def cmain(Ebv):
-                # perform calibration with given Ebv
-                if Ebv == 0.0: ccFLUX = imFLUX.copy()
-                if Ebv != 0.0: ccFLUX = func_cc(WAVE, imFLUX, Ebv)    
-                # zero padding in rest-frame
-                PadWave = np.arange(1000, 10000, 2)
-                PadFlux = np.zeros(len(PadWave)).astype(float)
-                m = np.where(PadWave == RCut0)[0][0]
-                n = np.where(PadWave == RCut1)[0][0]
-                PadFlux[m: n] = ccFLUX
-                # synthetic-photometry in obs-frame
-                Bmag_sphot = SynPhot(PadWave*(1+redshift), PadFlux, filtname_B, phot_system)
-                Vmag_sphot = SynPhot(PadWave*(1+redshift), PadFlux, filtname_V, phot_system)
-                BmV_sphot = float(Bmag_sphot - Vmag_sphot)
-                BmV_sphot += BmVoffset  # add offset
-                return BmV_sphot
+            # ** Synthetic B-V (with offset) as a function of Ebv
+            #    NOTE: the CCM89 curve & filter weights are precomputed (see ColorCalib_Engine).
+            func_bmv = ColorCalib_Engine(imFLUX, redshift, filtname_B, filtname_V, phot_system)
+            cmain = lambda Ebv: float(func_bmv(Ebv)) + BmVoffset
             
-            costfunc = lambda Ebv: abs(cmain(Ebv) - BmV_tar)
-            Ebv_fin = least_squares(costfunc, 0.0, bounds=([-1.0], [1.0])).x[0]
+            # ** Solve B-V(Ebv) = BmV_tar for Ebv in [-1, 1] by a scalar root finder
+            #    NOTE: B-V is monotonic in Ebv, if the target is not bracketed, take the closer bound.
+            res_lo, res_hi = cmain(-1.0) - BmV_tar, cmain(1.0) - BmV_tar
+            if res_lo * res_hi < 0.0:
+                Ebv_fin = brentq(lambda Ebv: cmain(Ebv) - BmV_tar, -1.0, 1.0, xtol=1e-10)
+            else: Ebv_fin = -1.0 if abs(res_lo) < abs(res_hi) else 1.0
             cFLUX = func_cc(WAVE, imFLUX, Ebv_fin)
             print('CheckPoint: Spectral SyntheticPhot B-V magnitude [%.3f mag (input) >>> %.3f mag (output)]' \
                 %(cmain(0.0), BmV_tar))
@@ -1,4 +1,8 @@
+import re
+import os
+import time
 import numpy as np
+import os.path as pa
 from warnings import simplefilter
 simplefilter(action='ignore', category=FutureWarning)
 import tensorflow
@@ -8,30 +12,133 @@ from tensorflow.keras.regularizers import l2
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.optimizers import Adam, RMSprop, Nadam
 from tensorflow.keras.layers import LSTM, Dense, TimeDistributed, Bidirectional
+from tensorflow.keras.callbacks import Callback, ModelCheckpoint, EarlyStopping
+from snail.utils.TrainShards import TrainShard_Batches, Count_TrainBatches
+
+# * default LSTM architechture & training parameters
+SLT_PARADICT = {'n_units': 256, 'batch_size': 1472, 'epochs': 30, 
+                'optmethod': 'Nadam', 'learning_rate': 40*1e-5, 
+                'drop_rate': 0.14, 'rdrop_rate': 0.16, 'rreg_l2':0*1e-6, 
+                'Bayesian': True, 
+                'fused': False,                    # LSTM without recurrent dropout (fused kernels)
+                'mixed_precision': None,           # e.g., 'mixed_bfloat16' on CPU (TF >= 2.4)
+                'intra_op_threads': None,          # thread pools (None means the TensorFlow default)
+                'inter_op_threads': None,
+                'checkpoint_dir': None,            # checkpoint per epoch & resume from the latest
+                'validation_split': 0.0,           # fraction of (the last) samples for validation (in-memory only)
+                'early_stopping_patience': None,   # epochs without improvement of val_loss (needs validation data)
+                'verbose': 2}
+
+class ThroughputLogger(Callback):
+
+    # NOTE: log the wall time & throughput (samples per second) of each training epoch (including validation),
+    #       the records are kept in self.records as (epoch, seconds, samples_per_sec),
+    #       and appended to a csv file if log_file is given (e.g., for benchmarking configurations).
+
+    def __init__(self, samples_per_epoch, log_file=None):
+        super(ThroughputLogger, self).__init__()
+        self.samples_per_epoch = samples_per_epoch
+        self.log_file = log_file
+        self.records = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.t0 = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        dt = time.time() - self.t0
+        self.records.append((epoch+1, dt, self.samples_per_epoch / dt))
+        print('CheckPoint: epoch [%d] | %.1f s | %.0f samples/s' %(epoch+1, dt, self.samples_per_epoch / dt))
+        if self.log_file is not None:
+            new = not pa.exists(self.log_file)
+            with open(self.log_file, 'a') as f:
+                if new: f.write('epoch,seconds,samples_per_sec\n')
+                f.write('%d,%.3f,%.1f\n' %self.records[-1])
 
 class SNAIL_Train:
     @staticmethod
-    def SLT(XDATA_train, YDATA_train, WEIGHT_train):
+    def Config(paradict=None, **kwargs):
+        # NOTE: the training config, i.e., SLT_PARADICT updated by paradict and keyword arguments.
+        config = dict(SLT_PARADICT)
+        for key, value in list((paradict or {}).items()) + list(kwargs.items()):
+            if key not in SLT_PARADICT: raise KeyError('Unknown training parameter [%s] !' %key)
+            config[key] = value
+        return config
 
-        # ** description of inputs
-        #    XDATA_train: array shape (Nsamp, timestep, 1+1+184)
-        #    YDATA_train: array shape (Nsamp, 184)
-        #    WEIGHT_train: array shape (Nsamp)
-        #    NOTE: timestep == 2 in our work
-        #          184 is the dimension of FPCA parameterization for one SN spectrum
-        #          1+1 (in XDATA_train) means target_phase + input_phase
+    @staticmethod
+    def Setup_Runtime(paradict):
+
+        # NOTE: thread pools & mixed precision, to be set before any model is built.
+        intra, inter = paradict['intra_op_threads'], paradict['inter_op_threads']
+        if intra is not None or inter is not None:
+            if hasattr(tensorflow, 'config') and hasattr(tensorflow.config, 'threading'):
+                try:
+                    if intra is not None: tensorflow.config.threading.set_intra_op_parallelism_threads(intra)
+                    if inter is not None: tensorflow.config.threading.set_inter_op_parallelism_threads(inter)
+                except RuntimeError:
+                    print('WARNING: thread pools can not be changed after TensorFlow is initialized !')
+            else:
+                # NOTE: TensorFlow 1.x (graph mode) configures the thread pools via the session
+                config = tensorflow.compat.v1.ConfigProto(intra_op_parallelism_threads=intra or 0, \
+                                                          inter_op_parallelism_threads=inter or 0)
+                tensorflow.compat.v1.keras.backend.set_session(tensorflow.compat.v1.Session(config=config))
 
-        # ** define LSTM architechture parameters
-        paradict = {'n_units': 256, 'batch_size': 1472, 'epochs': 30, 
-                    'optmethod': 'Nadam', 'learning_rate': 40*1e-5, 
-                    'drop_rate': 0.14, 'rdrop_rate': 0.16, 'rreg_l2':0*1e-6, 
-                    'Bayesian': True}
+        if paradict['mixed_precision'] is not None:
+            from tensorflow.keras import mixed_precision
+            mixed_precision.set_global_policy(paradict['mixed_precision'])
 
-        n_units, batch_size, epochs = paradict['n_units'], paradict['batch_size'], paradict['epochs']
+    @staticmethod
+    def Resume_Model(paradict):
+
+        # NOTE: the latest checkpoint (ckpt-<epoch>.h5, the full model with optimizer states) 
+        #       in checkpoint_dir and its epoch, or (None, 0) if there is no checkpoint.
+        CKDir = paradict['checkpoint_dir']
+        if CKDir is None or not pa.exists(CKDir): return None, 0
+        EPOCHS = {int(m.group(1)): file for file in os.listdir(CKDir) \
+            for m in [re.match(r'^ckpt-(\d+)\.h5$', file)] if m}
+        if not EPOCHS: return None, 0
+        epoch = max(EPOCHS)
+        from tensorflow.keras.models import load_model
+        model = load_model(pa.join(CKDir, EPOCHS[epoch]))
+        print('CheckPoint: resume from [%s] at epoch [%d]' %(EPOCHS[epoch], epoch))
+        return model, epoch
+
+    @staticmethod
+    def Check_Validation(paradict, validation):
+        # NOTE: early stopping monitors val_loss, which only exists with validation data
+        if paradict['early_stopping_patience'] is not None and not validation:
+            raise ValueError('early_stopping_patience requires validation data ' + \
+                             '(validation_split > 0 for SLT, ValData for SLT_Stream) !')
+
+    @staticmethod
+    def Callbacks(paradict, samples_per_epoch, validation=True):
+        SNAIL_Train.Check_Validation(paradict, validation)
+        log_file = None
+        if paradict['checkpoint_dir'] is not None:
+            os.makedirs(paradict['checkpoint_dir'], exist_ok=True)
+            log_file = pa.join(paradict['checkpoint_dir'], 'throughput.csv')
+        callbacks = [ThroughputLogger(samples_per_epoch, log_file=log_file)]
+        if paradict['checkpoint_dir'] is not None:
+            callbacks.append(ModelCheckpoint(pa.join(paradict['checkpoint_dir'], 'ckpt-{epoch:04d}.h5'), \
+                save_weights_only=False))
+        if paradict['early_stopping_patience'] is not None:
+            callbacks.append(EarlyStopping(monitor='val_loss', patience=paradict['early_stopping_patience'], \
+                restore_best_weights=True))
+        return callbacks
+
+    @staticmethod
+    def Build_Model(paradict=None):
+
+        paradict = SNAIL_Train.Config(paradict)
+        n_units = paradict['n_units']
         optmethod, learning_rate = paradict['optmethod'], paradict['learning_rate']
         drop_rate, rdrop_rate, rreg_l2 = paradict['drop_rate'], paradict['rdrop_rate'], paradict['rreg_l2']
         Bayesian = paradict['Bayesian']
         
+        # NOTE: the fused variant drops the recurrent dropout (implementation 2), so that TensorFlow 2
+        #       can dispatch the LSTM to its fused kernels, the input dropout (MC-dropout) is kept.
+        implementation = 1
+        if paradict['fused']: rdrop_rate, implementation = 0.0, 2
+        
         recurrent_regularizer = None
         if rreg_l2 is not None: 
             recurrent_regularizer = l2(rreg_l2)  # typical values are 1e-6, 1e-5, 1e-4 ...
@@ -39,14 +146,8 @@ class SNAIL_Train:
         if optmethod == 'Nadam': optimizer = Nadam(lr=learning_rate)
         if optmethod == 'RMSprop': optimizer = RMSprop(lr=learning_rate)
 
-        # ** train the model
         n_steps = 2
         n_features = (2+90)*2
-        XDP_train = XDATA_train.copy()
-        YDP_train = YDATA_train.copy()
-        WDP_train = WEIGHT_train.copy()
-        #-#-#-# + Adjust form [convert to 2-identical-layers] #-#-#-#
-        YDP_train = np.array([[yd]*n_steps for yd in YDP_train])
 
         # *** Remarks on time-lock dropout mask in LSTM
         #     Keras has 3 implementations of LSTM, with implementation 1 as default (seems to be untied-weights).
@@ -59,39 +160,145 @@ class SNAIL_Train:
             model = Sequential()
             model.add(Bidirectional(LSTM(n_units, activation='tanh', dropout=0.0, kernel_regularizer=None, \
                 recurrent_dropout=rdrop_rate, recurrent_regularizer=recurrent_regularizer, recurrent_activation='sigmoid', \
-                return_sequences=True, implementation=1), input_shape=(n_steps, 2+n_features)))   # No dropout in first layer
+                return_sequences=True, implementation=implementation), input_shape=(n_steps, 2+n_features)))   # No dropout in first layer
 
             model.add(Bidirectional(LSTM(n_units, activation='tanh', dropout=drop_rate, kernel_regularizer=None, \
                 recurrent_dropout=rdrop_rate, recurrent_regularizer=recurrent_regularizer, recurrent_activation='sigmoid', \
-                return_sequences=True, implementation=1)))
+                return_sequences=True, implementation=implementation)))
 
             model.add(Bidirectional(LSTM(n_units, activation='tanh', dropout=drop_rate, kernel_regularizer=None, \
                 recurrent_dropout=rdrop_rate, recurrent_regularizer=recurrent_regularizer, recurrent_activation='sigmoid', \
-                return_sequences=True, implementation=1)))
+                return_sequences=True, implementation=implementation)))
 
-            model.add(TimeDistributed(Dense(units=n_features, activation='linear')))  # No dropout before last layer.
+            model.add(TimeDistributed(Dense(units=n_features, activation='linear', dtype='float32')))  # No dropout before last layer.
             model.compile(loss='mse', optimizer=optimizer, metrics=['mae'])
             
         if Bayesian:
             inputs = Input(shape=(n_steps, 2+n_features))
             blstm1 = Bidirectional(LSTM(n_units, activation='tanh', dropout=0.0, kernel_regularizer=None, \
                 recurrent_dropout=rdrop_rate, recurrent_regularizer=recurrent_regularizer, recurrent_activation='sigmoid', \
-                return_sequences=True, implementation=1))(inputs, training=True)   # No dropout in first layer, otherwise it has terrible performance
+                return_sequences=True, implementation=implementation))(inputs, training=True)   # No dropout in first layer, otherwise it has terrible performance
 
             blstm2 = Bidirectional(LSTM(n_units, activation='tanh', dropout=drop_rate, kernel_regularizer=None, \
                 recurrent_dropout=rdrop_rate, recurrent_regularizer=recurrent_regularizer, recurrent_activation='sigmoid', \
-                return_sequences=True, implementation=1))(blstm1, training=True)
+                return_sequences=True, implementation=implementation))(blstm1, training=True)
             
             blstm3 = Bidirectional(LSTM(n_units, activation='tanh', dropout=drop_rate, kernel_regularizer=None, \
                 recurrent_dropout=rdrop_rate, recurrent_regularizer=recurrent_regularizer, recurrent_activation='sigmoid', \
-                return_sequences=True, implementation=1))(blstm2, training=True)
+                return_sequences=True, implementation=implementation))(blstm2, training=True)
 
             # No dropout layer here, as we didn't find a time-locked dropout-dense.
-            outputs = TimeDistributed(Dense(units=n_features, activation='linear'))(blstm3)
+            outputs = TimeDistributed(Dense(units=n_features, activation='linear', dtype='float32'))(blstm3)
             model = Model(inputs, outputs)
             model.compile(loss='mse', optimizer=optimizer, metrics=['mae'])
 
-        model.fit(XDP_train, YDP_train, sample_weight=WDP_train, validation_data=None, \
-            batch_size=batch_size, epochs=epochs, verbose=2, shuffle=True, callbacks=None)
+        return model
+
+    @staticmethod
+    def SLT(XDATA_train, YDATA_train, WEIGHT_train, paradict=None):
+
+        # ** description of inputs
+        #    XDATA_train: array shape (Nsamp, timestep, 1+1+184)
+        #    YDATA_train: array shape (Nsamp, 184)
+        #    WEIGHT_train: array shape (Nsamp)
+        #    NOTE: timestep == 2 in our work
+        #          184 is the dimension of FPCA parameterization for one SN spectrum
+        #          1+1 (in XDATA_train) means target_phase + input_phase
+        # ** paradict: see SLT_PARADICT (& SNAIL_Train.Config) for the configurable parameters,
+        #    with checkpoint_dir the training resumes from the latest checkpoint (the remaining epochs),
+        #    early stopping on val_loss requires validation_split > 0 (the last samples, as in Keras).
+
+        paradict = SNAIL_Train.Config(paradict)
+        batch_size, epochs = paradict['batch_size'], paradict['epochs']
+        SNAIL_Train.Check_Validation(paradict, paradict['validation_split'] > 0)
+        SNAIL_Train.Setup_Runtime(paradict)
+        model, initial_epoch = SNAIL_Train.Resume_Model(paradict)
+        if model is None: model = SNAIL_Train.Build_Model(paradict)
+
+        # ** train the model
+        n_steps = 2
+        XDP_train = XDATA_train
+        WDP_train = WEIGHT_train
+        #-#-#-# + Adjust form [convert to 2-identical-layers] #-#-#-#
+        YDP_train = np.repeat(np.asarray(YDATA_train)[:, None, :], n_steps, axis=1)
+
+        validation_split = paradict['validation_split']
+        callbacks = SNAIL_Train.Callbacks(paradict, int(len(XDP_train) * (1 - validation_split)), \
+            validation=validation_split > 0)
+        model.fit(XDP_train, YDP_train, sample_weight=WDP_train, validation_split=validation_split, \
+            batch_size=batch_size, epochs=epochs, initial_epoch=initial_epoch, verbose=paradict['verbose'], \
+            shuffle=True, callbacks=callbacks)
+
+        return model
+
+    @staticmethod
+    def SLT_Stream(TrainData, steps_per_epoch=None, shuffle=True, seed=None, prefetch=2, paradict=None, \
+        ValData=None, validation_steps=None):
+
+        # ** Remarks on out-of-core training
+        #    TrainData can be 
+        #    [1] a directory of training shards (see snail.utils.TrainShards), which are memory-mapped 
+        #        and streamed in batches of paradict['batch_size'] through tf.data with prefetching,
+        #        (shuffle & seed: shards in random order and samples shuffled within each shard, per epoch).
+        #    [2] a tf.data.Dataset of batches (X, Y, W), or
+        #    [3] a callable returning a fresh iterator over batches (X, Y, W) for each epoch.
+        #    where X, Y & W have the shapes as XDATA_train, YDATA_train & WEIGHT_train in SLT (per batch).
+        #    the duplicated timestep target of shape (B, 2, 184) is built per batch.
+        #    NOTE: steps_per_epoch is required for [3], and for [2] unless the dataset has a finite cardinality
+        #          (read before the dataset is repeated). For [1], an epoch is one pass over all shards.
+        #    ValData (optional, in the same forms, not shuffled) is the validation data for early stopping,
+        #    and validation_steps is required likewise. paradict: see SNAIL_Train.SLT.
+
+        paradict = SNAIL_Train.Config(paradict)
+        batch_size, epochs = paradict['batch_size'], paradict['epochs']
+        SNAIL_Train.Check_Validation(paradict, ValData is not None)
+        SNAIL_Train.Setup_Runtime(paradict)
+        model, initial_epoch = SNAIL_Train.Resume_Model(paradict)
+        if model is None: model = SNAIL_Train.Build_Model(paradict)
+        n_steps = 2
+
+        def make_dataset(Data, shuffle, seed, nsteps, steps_arg):
+            if isinstance(Data, str):
+                ShardDir = Data
+                if nsteps is None: nsteps = Count_TrainBatches(ShardDir, batch_size)
+                EpochSeeds = np.random.SeedSequence(seed)
+                def gen():
+                    # NOTE: a new shuffle seed for each epoch (each call of the generator)
+                    epoch_seed = EpochSeeds.spawn(1)[0]
+                    for XB, YB, WB in TrainShard_Batches(ShardDir, batch_size, shuffle=shuffle, seed=epoch_seed):
+                        yield XB, YB, WB
+                Data = gen
+
+            if callable(Data):
+                dataset = tensorflow.data.Dataset.from_generator(Data, \
+                    output_types=(tensorflow.float32, tensorflow.float32, tensorflow.float32), \
+                    output_shapes=((None, n_steps, 186), (None, 184), (None,)))
+            else:
+                dataset = Data
+                if nsteps is None:
+                    # NOTE: negative cardinality means infinite (-1) or unknown (-2)
+                    if hasattr(dataset, 'cardinality'): cardinality = int(dataset.cardinality())
+                    else: cardinality = int(tensorflow.data.experimental.cardinality(dataset))
+                    if cardinality > 0: nsteps = cardinality
+            
+            if nsteps is None:
+                raise ValueError('The number of batches per epoch of the input data is unknown, ' + \
+                                 'please specify %s !' %steps_arg)
+
+            #-#-#-# + Adjust form [convert to 2-identical-layers] #-#-#-#
+            def duplicate_target(XB, YB, WB):
+                return XB, tensorflow.tile(tensorflow.expand_dims(YB, 1), [1, n_steps, 1]), WB
+            dataset = dataset.map(duplicate_target).repeat().prefetch(prefetch)
+            return dataset, nsteps
+
+        dataset, steps_per_epoch = make_dataset(TrainData, shuffle, seed, steps_per_epoch, 'steps_per_epoch')
+        validation_data = None
+        if ValData is not None:
+            validation_data, validation_steps = make_dataset(ValData, False, None, validation_steps, 'validation_steps')
+
+        callbacks = SNAIL_Train.Callbacks(paradict, steps_per_epoch * batch_size, validation=ValData is not None)
+        model.fit(dataset, steps_per_epoch=steps_per_epoch, validation_data=validation_data, \
+            validation_steps=validation_steps, epochs=epochs, initial_epoch=initial_epoch, \
+            verbose=paradict['verbose'], callbacks=callbacks)
 
         return model
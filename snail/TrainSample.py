@@ -0,0 +1,174 @@
+import os
+import numpy as np
+import os.path as pa
+from astropy.table import Table
+from snail.utils.SpecFPCA import FPCA_Parameterize_Batch
+from snail.utils.TrainShards import Write_TrainShard, List_TrainShards
+from snail.AccessArchivalData import CSD_Catalog, CSD_SpecStore
+
+def Enumerate_Pairs(n, include_single=True, exclude_target=False):
+
+    # NOTE: all (o, t, d) index triples of n spectra (sorted by phase) of a SN, vectorized,
+    #       with the input pair o <= t (o == t means a single input spectrum, if include_single)
+    #       and any target d (exclude_target=True drops the targets that are one of the inputs).
+    IO, IT = np.triu_indices(n, k=0 if include_single else 1)
+    IO, IT = np.repeat(IO, n), np.repeat(IT, n)
+    ID = np.tile(np.arange(n), len(IO) // n if n > 0 else 0)
+    if exclude_target:
+        mask = np.logical_and(ID != IO, ID != IT)
+        IO, IT, ID = IO[mask], IT[mask], ID[mask]
+    return IO, IT, ID
+
+def _SN_Samples(task):
+
+    # NOTE: training samples of a single SN (in a worker process),
+    #       the random generator is keyed by (seed, SN index) so the output does not depend on the scheduling.
+    sn_index, PHASES, FPCA_PARAM, options, seed = task
+    rng = np.random.default_rng([seed, sn_index])
+    IO, IT, ID = Enumerate_Pairs(len(PHASES), include_single=options['include_single'], \
+        exclude_target=options['exclude_target'])
+
+    max_samples = options['max_samples_per_sn']
+    if max_samples is not None and len(IO) > max_samples:
+        SEL = np.sort(rng.choice(len(IO), size=max_samples, replace=False))
+        IO, IT, ID = IO[SEL], IT[SEL], ID[SEL]
+
+    M = len(IO)
+    CFF = FPCA_PARAM.reshape((-1, 184))
+    XDATA = np.zeros((M, 2, 186), dtype=options['dtype'])
+    XDATA[:, :, 0] = PHASES[ID][:, None]
+    XDATA[:, 0, 1], XDATA[:, 0, 2:] = PHASES[IO], CFF[IO]
+    XDATA[:, 1, 1], XDATA[:, 1, 2:] = PHASES[IT], CFF[IT]
+    YDATA = CFF[ID].astype(options['dtype'])
+
+    weighting = options['weighting']
+    if weighting == 'uniform': WEIGHT = np.ones(M)
+    elif weighting == 'sn': WEIGHT = np.ones(M) / max(M, 1)
+    else: WEIGHT = np.asarray(weighting(PHASES[ID], PHASES[IO], PHASES[IT]), dtype=float)
+
+    return XDATA, YDATA, WEIGHT.astype(options['dtype'])
+
+class SNAIL_TrainSample:
+
+    # ** Remarks on training samples
+    #    A training sample of a SN consists of an input pair of spectra (o, t) with phase_o <= phase_t
+    #    and a target spectrum d of the same SN, in the form of SNAIL_Train.SLT
+    #    XDATA: [[phase_d, phase_o] + FPCA_PARAM_o, [phase_d, phase_t] + FPCA_PARAM_t], shape (2, 186)
+    #    YDATA: FPCA_PARAM_d, shape (184,)
+    #    i.e., the same LSTM input as SNAIL_Predict_Deep.SPD_Batch.
+
+    @staticmethod
+    def SN_Spectra(DBDir, SN_name, data_type='Corrected', PhaseRange=None, Spec_IDs=None, build_store=False):
+
+        # NOTE: phases, Spec_IDs & flux (n, 1700) of a SN (sorted by phase) from the bulk spectrum store 
+        #       or the ASCII files (see CSD_SpecStore.Read), only the spectra available for the data type,
+        #       Spec_IDs (optional) restricts to a subset of the spectra.
+        #       build_store=True: (re)build the store (in DBDir/Observations/SpecStore) if needed.
+        Catalog = CSD_Catalog.Load(DBDir)
+        rows = Catalog.Spec_RowIndices(SN_name, PhaseRange=PhaseRange)
+        SIDs = np.array(Catalog.AstSpecMa['Spec_ID'][rows]).astype(int)
+        PHASES = np.array(Catalog.AstSpecMa['Phase'][rows]).astype(float)
+        if Spec_IDs is not None:
+            mask = np.isin(SIDs, np.array(list(Spec_IDs)).astype(int))
+            SIDs, PHASES = SIDs[mask], PHASES[mask]
+
+        # NOTE: the spectra not available for the data type are skipped
+        mask = np.array([pa.exists(CSD_SpecStore.SpecFile(DBDir, data_type, SN_name, sid)) for sid in SIDs]).astype(bool)
+        SIDs, PHASES = SIDs[mask], PHASES[mask]
+        FLUX = np.array(CSD_SpecStore.Read(DBDir, data_type, SN_name, list(SIDs), build_store=build_store))
+        return PHASES, SIDs, FLUX.reshape((len(SIDs), -1))
+
+    @staticmethod
+    def STS(DBDir, ShardDir, SN_names=None, data_type='Corrected', PhaseRange=(-15.0, 33.0), \
+        training_record=False, include_single=True, exclude_target=False, max_samples_per_sn=None, \
+        weighting='sn', shard_size=65536, num_workers=1, sn_chunk=64, seed=0, dtype=np.float32, \
+        build_store=False, verbose=True):
+
+        # ** Remarks on the training-sample generation
+        #    SN_names: the SNe to use (default: all SNe in SpecMaster.csv).
+        #    training_record: only use the spectra flagged as Training in Templates/TrainingRecord.csv.
+        #    include_single & exclude_target: see Enumerate_Pairs, all (o, t, d) triples are enumerated
+        #    per SN, and randomly subsampled (without replacement) to at most max_samples_per_sn.
+        #    weighting: sample weights, 'uniform' (1), 'sn' (1 / number of samples of the SN,
+        #               i.e., equal total weight for each SN) or a function of (phases_d, phases_o, phases_t),
+        #               NOTE: the function must be picklable (defined at module level) if num_workers > 1.
+        #    build_store: (re)build the bulk spectrum store if needed (see SNAIL_TrainSample.SN_Spectra).
+        #    The spectra are FPCA parameterized in batches of sn_chunk SNe, and the samples of each SN are
+        #    generated in worker processes (num_workers), at most 2 x num_workers SNe are in flight at a time.
+        #    The samples are streamed (in SN order) into shards of shard_size samples (see snail.utils.TrainShards),
+        #    and the output is deterministic under the seed regardless of num_workers.
+        #    returns the number of samples per SN.
+
+        from collections import deque
+        RCut0, RCut1 = 3800, 7200
+        WAVE = np.arange(RCut0, RCut1, 2)
+        assert weighting in ['uniform', 'sn'] or callable(weighting)
+        assert not List_TrainShards(ShardDir), 'ShardDir [%s] already contains shards !' %ShardDir
+        os.makedirs(ShardDir, exist_ok=True)
+
+        Catalog = CSD_Catalog.Load(DBDir)
+        if SN_names is None: SN_names = list(Catalog.SpecRows.keys())
+        TRAIN_SIDs = None
+        if training_record:
+            AstTRec = Table.read(pa.join(DBDir, 'Templates', 'TrainingRecord.csv'), format='ascii.csv')
+            AstTRec = AstTRec[AstTRec['Training'] == 'Yes']
+            TRAIN_SIDs = {}
+            for SN_name, Spec_ID in zip(AstTRec['SN_name'], AstTRec['Spec_ID']):
+                TRAIN_SIDs.setdefault(SN_name, []).append(Spec_ID)
+
+        options = {'include_single': include_single, 'exclude_target': exclude_target, \
+                   'max_samples_per_sn': max_samples_per_sn, 'weighting': weighting, 'dtype': dtype}
+
+        # ** tasks: batched FPCA parameterization for chunks of SNe
+        def tasks():
+            for c0 in range(0, len(SN_names), sn_chunk):
+                SPECS = []
+                for SN_name in SN_names[c0: c0+sn_chunk]:
+                    Spec_IDs = None if TRAIN_SIDs is None else TRAIN_SIDs.get(SN_name, [])
+                    PHASES, _, FLUX = SNAIL_TrainSample.SN_Spectra(DBDir, SN_name, data_type=data_type, \
+                        PhaseRange=PhaseRange, Spec_IDs=Spec_IDs, build_store=build_store)
+                    SPECS.append((PHASES, FLUX))
+
+                FLUX_2D = np.concatenate([FLUX for PHASES, FLUX in SPECS], axis=0).reshape((-1, len(WAVE)))
+                FPCA_PARAM = FPCA_Parameterize_Batch(WAVE, FLUX_2D) if len(FLUX_2D) > 0 else np.zeros((0, 2, 92))
+                i0 = 0
+                for k, (PHASES, FLUX) in enumerate(SPECS):
+                    yield c0 + k, PHASES, FPCA_PARAM[i0: i0+len(PHASES)], options, seed
+                    i0 += len(PHASES)
+
+        # ** stream the samples into shards
+        BUFFER, STATS = [], {}
+        def flush(final=False):
+            nbuf = sum(len(W) for X, Y, W in BUFFER)
+            while nbuf >= shard_size or (final and nbuf > 0):
+                XDATA, YDATA, WEIGHT = [np.concatenate(A, axis=0) for A in zip(*BUFFER)]
+                n = min(shard_size, nbuf)
+                Write_TrainShard(ShardDir, XDATA[:n], YDATA[:n], WEIGHT[:n])
+                BUFFER[:] = [(XDATA[n:], YDATA[n:], WEIGHT[n:])] if nbuf > n else []
+                nbuf -= n
+                if verbose: print('CheckPoint: shard [%d] written with [%d] samples' %(len(List_TrainShards(ShardDir))-1, n))
+
+        def collect(task, result):
+            STATS[str(SN_names[task[0]])] = len(result[2])
+            BUFFER.append(result)
+            flush()
+
+        if num_workers is None or num_workers <= 1:
+            for task in tasks():
+                collect(task, _SN_Samples(task))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                Futures = deque()
+                for task in tasks():
+                    Futures.append((task, executor.submit(_SN_Samples, task)))
+                    if len(Futures) >= 2*num_workers:
+                        task, future = Futures.popleft()
+                        collect(task, future.result())
+                while Futures:
+                    task, future = Futures.popleft()
+                    collect(task, future.result())
+        flush(final=True)
+
+        if verbose: print('CheckPoint: [%d] training samples generated from [%d] SNe' %(sum(STATS.values()), len(STATS)))
+        return STATS
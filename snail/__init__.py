@@ -5,11 +5,44 @@ Remarks on Internal Packages Imports:
     from snail.Predict import SNAIL_Predict
     from snail.PhaseEstimate import FitSingleSpecPhase
     from snail.Train import SNAIL_Train
+    from snail.TrainSample import SNAIL_TrainSample
+    from snail.GenerateTemplate import SNAIL_Template
 
 """
 
-from .AccessArchivalData import AccessDB
-from .SpecProc import HomogenizeSpec, CorrectSpec
-from .Predict import SNAIL_Predict_Deep, SNAIL_Predict
-from .PhaseEstimate import FitSingleSpecPhase
-from .Train import SNAIL_Train
+# NOTE: submodules are imported lazily (on first attribute access), so that
+#       e.g. "from snail import AccessDB" does not pay for FPCA, pyphot or TensorFlow.
+#       Python 3.6 has no module-level __getattr__ (PEP 562), so we fall back to eager imports.
+
+import sys
+import importlib
+
+_LAZY_ATTRS = {
+    'AccessDB': 'AccessArchivalData',
+    'HomogenizeSpec': 'SpecProc',
+    'CorrectSpec': 'SpecProc',
+    'SNAIL_Predict_Deep': 'Predict',
+    'SNAIL_Predict': 'Predict',
+    'FitSingleSpecPhase': 'PhaseEstimate',
+    'SNAIL_Train': 'Train',
+    'SNAIL_TrainSample': 'TrainSample',
+    'SNAIL_Template': 'GenerateTemplate'
+}
+
+if sys.version_info < (3, 7):
+    from .AccessArchivalData import AccessDB
+    from .SpecProc import HomogenizeSpec, CorrectSpec
+    from .Predict import SNAIL_Predict_Deep, SNAIL_Predict
+    from .PhaseEstimate import FitSingleSpecPhase
+    from .Train import SNAIL_Train
+    from .TrainSample import SNAIL_TrainSample
+    from .GenerateTemplate import SNAIL_Template
+else:
+    def __getattr__(name):
+        if name in _LAZY_ATTRS:
+            module = importlib.import_module('.' + _LAZY_ATTRS[name], __name__)
+            return getattr(module, name)
+        raise AttributeError("module %r has no attribute %r" %(__name__, name))
+
+    def __dir__():
+        return sorted(list(globals()) + list(_LAZY_ATTRS))
@@ -1,9 +1,212 @@
 import warnings
 import numpy as np
-from sklearn.gaussian_process import GaussianProcessRegressor
-from sklearn.gaussian_process.kernels import RBF, ConstantKernel as CK
 
-def GP_Interpolator(X, Y, eY, X_q, NaN_fill=0.1):
+# * A specialised exact-GP engine for 1-D data with RBF kernel
+#   k(x, x') = σ^2 * exp(- (x - x')^2 / 2*l^2) with heteroscedastic noise eY^2 on the diagonal,
+#   this is the same model as the sklearn configuration CK(σ^2) * RBF(l) with alpha=eY^2 (see GP_Interpolator),
+#   hyperparameters are optimized on the log marginal likelihood with analytic gradients (see GP_Fit_Batch).
+#   NOTE: many independent datasets (and multiple starting points of each) are fitted in one vectorized step,
+#         where datasets of different lengths are padded by dummy points with zero covariance to others,
+#         unit noise and zero value, which leave the marginal likelihood & its gradient unchanged.
+
+GP_SIG2_BOUNDS = (1e-3, 1e3)
+GP_LENGTH_BOUNDS = (1e-2, 1e2)
+GP_JITTER = 1e-10
+GP_FIT_CACHE = {}        # (X, Y, eY) bytes -> (theta, factorization), cached fitted GPs
+GP_FIT_CACHE_SIZE = 256
+GP_WARM_START = []       # hyperparameters (log σ^2, log l) of the most recent fit (only used if warm_start=True)
+
+def _GP_Pad(X_Lst, Y_Lst, eY_Lst):
+    B = len(X_Lst)
+    n = max(len(X) for X in X_Lst)
+    X, Y = np.zeros((B, n)), np.zeros((B, n))
+    NOISE, MASK = np.ones((B, n)), np.zeros((B, n))
+    for i in range(B):
+        m = len(X_Lst[i])
+        X[i, :m], Y[i, :m] = X_Lst[i], Y_Lst[i]
+        NOISE[i, :m], MASK[i, :m] = eY_Lst[i]**2 + GP_JITTER, 1.0
+    return X, Y, NOISE, MASK
+
+def _GP_Factorize(theta, X, Y, NOISE, MASK, return_grad=False):
+    # theta: shape (B, 2) as (log σ^2, log l); X, Y, NOISE, MASK: shape (B, n)
+    sig2, length = np.exp(theta[:, 0]), np.exp(theta[:, 1])
+    D2 = (X[:, :, None] - X[:, None, :])**2
+    MM = MASK[:, :, None] * MASK[:, None, :]
+    E = np.exp(-0.5 * D2 / length[:, None, None]**2) * MM
+    KS = sig2[:, None, None] * E
+    n = X.shape[1]
+    K = KS + NOISE[:, :, None] * np.eye(n)[None, :, :]
+    L = np.linalg.cholesky(K)
+    
+    # negative log marginal likelihood
+    if not return_grad:
+        beta = np.linalg.solve(L, Y[:, :, None])
+        alpha = np.linalg.solve(L.transpose(0, 2, 1), beta)[:, :, 0]
+        nlml = 0.5 * np.sum(beta[:, :, 0]**2, axis=1) + np.sum(np.log(np.diagonal(L, axis1=1, axis2=2)), axis=1) \
+            + 0.5 * np.sum(MASK, axis=1) * np.log(2*np.pi)
+        return nlml, L, alpha
+
+    Linv = np.linalg.solve(L, np.broadcast_to(np.eye(n), K.shape))
+    Kinv = np.matmul(Linv.transpose(0, 2, 1), Linv)
+    alpha = np.matmul(Kinv, Y[:, :, None])[:, :, 0]
+    nlml = 0.5 * np.sum(Y * alpha, axis=1) + np.sum(np.log(np.diagonal(L, axis1=1, axis2=2)), axis=1) \
+        + 0.5 * np.sum(MASK, axis=1) * np.log(2*np.pi)
+
+    # gradient: -0.5 * tr((αα^T - K^-1) dK/dθ)
+    # Fisher information: 0.5 * tr(K^-1 dK/dθ_i K^-1 dK/dθ_j)
+    W = alpha[:, :, None] * alpha[:, None, :] - Kinv
+    dK = [KS, KS * D2 / length[:, None, None]**2]     # dK/dlog(σ^2), dK/dlog(l)
+    A = [np.matmul(Kinv, dK[i]) for i in range(2)]
+    grad = np.zeros(theta.shape)
+    FISHER = np.zeros(theta.shape + (2,))
+    for i in range(2):
+        grad[:, i] = -0.5 * np.sum(W * dK[i], axis=(1, 2))
+        for j in range(2):
+            FISHER[:, i, j] = 0.5 * np.sum(A[i] * A[j].transpose(0, 2, 1), axis=(1, 2))
+    return nlml, grad, FISHER
+
+def GP_Fit_Batch(X_Lst, Y_Lst, eY_Lst, warm_start=False, max_iter=100, tol=1e-5):
+
+    # NOTE: the hyperparameters of all (dataset, starting point) pairs are optimized simultaneously
+    #       by vectorized Fisher scoring (Newton steps with the expected Hessian) with backtracking
+    #       line search, the steps are projected onto the bounds (in log space).
+    #       warm_start=True: add the optimum of the previous call as a starting point, e.g., for a sequence
+    #       of similar datasets. it is off by default, as the result would then depend on the call history.
+
+    # ** starting points: sklearn default, a fixed log-spaced design within bounds, and warm start
+    LB = np.log([GP_SIG2_BOUNDS[0], GP_LENGTH_BOUNDS[0]])
+    UB = np.log([GP_SIG2_BOUNDS[1], GP_LENGTH_BOUNDS[1]])
+    STARTS = [np.log([1.0, 10.0])]
+    for a, b in [(0.25, 0.25), (0.25, 0.75), (0.75, 0.25), (0.75, 0.75), (0.5, 0.5)]:
+        STARTS.append(LB + np.array([a, b]) * (UB - LB))
+    if warm_start and GP_WARM_START: STARTS.append(GP_WARM_START[-1])
+    STARTS = np.array(STARTS)
+    
+    B, S = len(X_Lst), len(STARTS)
+    X, Y, NOISE, MASK = _GP_Pad(X_Lst, Y_Lst, eY_Lst)
+    XR, YR = np.repeat(X, S, axis=0), np.repeat(Y, S, axis=0)
+    NOISER, MASKR = np.repeat(NOISE, S, axis=0), np.repeat(MASK, S, axis=0)
+    theta = np.tile(STARTS, (B, 1))    # shape (B*S, 2)
+
+    def evaluate(theta, index):
+        # NOTE: non-positive-definite covariance (if any) is treated as infinite nlml
+        nlml = np.full(len(index), np.inf)
+        try:
+            nlml = _GP_Factorize(theta, XR[index], YR[index], NOISER[index], MASKR[index])[0]
+        except np.linalg.LinAlgError:
+            for k, idx in enumerate(index):
+                try: nlml[k] = _GP_Factorize(theta[k: k+1], XR[idx: idx+1], YR[idx: idx+1], \
+                    NOISER[idx: idx+1], MASKR[idx: idx+1])[0][0]
+                except np.linalg.LinAlgError: pass
+        return nlml
+
+    # ** vectorized Fisher scoring
+    ALL = np.arange(B*S)
+    active = ALL.copy()
+    for _ in range(max_iter):
+        if len(active) == 0: break
+        try:
+            nlml, grad, FISHER = _GP_Factorize(theta[active], XR[active], YR[active], \
+                NOISER[active], MASKR[active], return_grad=True)
+        except np.linalg.LinAlgError:
+            break
+        FISHER += 1e-8 * np.eye(2)[None, :, :]
+        step = np.linalg.solve(FISHER, grad[:, :, None])[:, :, 0]
+        
+        # *** backtracking line search (projected onto bounds)
+        t = np.ones(len(active))
+        accept = np.zeros(len(active)).astype(bool)
+        theta_new = theta[active].copy()
+        for _ in range(20):
+            pending = np.where(~accept)[0]
+            if len(pending) == 0: break
+            cand = np.clip(theta[active][pending] - t[pending, None] * step[pending], LB, UB)
+            nlml_cand = evaluate(cand, active[pending])
+            ok = nlml_cand <= nlml[pending] + 1e-4 * np.sum(grad[pending] * (cand - theta[active][pending]), axis=1)
+            theta_new[pending[ok]] = cand[ok]
+            accept[pending[ok]] = True
+            t[pending[~ok]] /= 2.0
+        
+        converged = np.logical_or(~accept, np.max(np.abs(theta_new - theta[active]), axis=1) < tol)
+        theta[active] = theta_new
+        active = active[~converged]
+
+    # ** select the best start of each dataset
+    nlml = evaluate(theta, ALL).reshape((B, S))
+    theta_best = theta.reshape((B, S, 2))[np.arange(B), np.argmin(nlml, axis=1)]
+    GP_WARM_START[:] = [theta_best[-1].copy()]
+    
+    return theta_best
+
+def GP_Predict_Batch(theta, X_Lst, Y_Lst, eY_Lst, X_q, FACTOR=None):
+    # NOTE: FACTOR is the (cached) factorization (X, MASK, L, alpha) returned by a previous call.
+    if FACTOR is None:
+        X, Y, NOISE, MASK = _GP_Pad(X_Lst, Y_Lst, eY_Lst)
+        _, L, alpha = _GP_Factorize(theta, X, Y, NOISE, MASK)
+        FACTOR = (X, MASK, L, alpha)
+    X, MASK, L, alpha = FACTOR
+    sig2, length = np.exp(theta[:, 0]), np.exp(theta[:, 1])
+    KQ = sig2[:, None, None] * np.exp(-0.5 * (X[:, :, None] - X_q[None, None, :])**2 \
+        / length[:, None, None]**2) * MASK[:, :, None]     # shape (B, n, nq)
+    Y_q = np.sum(KQ * alpha[:, :, None], axis=1)
+    V = np.linalg.solve(L, KQ)
+    VAR_q = np.clip(sig2[:, None] - np.sum(V**2, axis=1), a_min=0.0, a_max=None)
+    return Y_q, np.sqrt(VAR_q), FACTOR
+
+def GP_Interpolator_Batch(X_Lst, Y_Lst, eY_Lst, X_q, NaN_fill=0.1, chunk_size=64, warm_start=False):
+    
+    # NOTE: fit many independent datasets (e.g., B & V light curves of many SNe) in vectorized steps
+    #       (chunk_size datasets per step), and predict them on a common X_q.
+    #       returns arrays of shape (B, len(X_q)). warm_start: see GP_Fit_Batch.
+    
+    # * nan-correction
+    _X_Lst, _Y_Lst, _eY_Lst = [], [], []
+    for X, Y, eY in zip(X_Lst, Y_Lst, eY_Lst):
+        Avmask = ~np.isnan(Y)
+        X, Y, eY = np.asarray(X, dtype=float)[Avmask], np.asarray(Y, dtype=float)[Avmask], \
+            np.asarray(eY, dtype=float)[Avmask].copy()
+        eY[np.isnan(eY)] = NaN_fill
+        _X_Lst.append(X)
+        _Y_Lst.append(Y)
+        _eY_Lst.append(eY)
+    X_q = np.asarray(X_q, dtype=float)
+    
+    Y_q, eY_q = [], []
+    for i0 in range(0, len(_X_Lst), chunk_size):
+        i1 = i0 + chunk_size
+        theta = GP_Fit_Batch(_X_Lst[i0: i1], _Y_Lst[i0: i1], _eY_Lst[i0: i1], warm_start=warm_start)
+        _Y_q, _eY_q, _ = GP_Predict_Batch(theta, _X_Lst[i0: i1], _Y_Lst[i0: i1], _eY_Lst[i0: i1], X_q)
+        Y_q.append(_Y_q)
+        eY_q.append(_eY_q)
+    Y_q, eY_q = np.concatenate(Y_q, axis=0), np.concatenate(eY_q, axis=0)
+    
+    return Y_q, eY_q
+
+def GP_Interpolator(X, Y, eY, X_q, NaN_fill=0.1, engine='native'):
+    
+    # NOTE: engine='native' is the specialised 1-D RBF GP engine above (same model as sklearn),
+    #       engine='sklearn' is the original implementation via GaussianProcessRegressor.
+    assert engine in ['native', 'sklearn']
+    if engine == 'native':
+        # * fitted GPs are cached (by data), refitting the same data only costs a prediction
+        key = (np.asarray(X, dtype=float).tobytes(), np.asarray(Y, dtype=float).tobytes(), \
+            np.asarray(eY, dtype=float).tobytes(), NaN_fill)
+        if key not in GP_FIT_CACHE:
+            Avmask = ~np.isnan(Y)
+            _X, _Y, _eY = X[Avmask].astype(float), Y[Avmask].astype(float), eY[Avmask].astype(float)
+            _eY[np.isnan(_eY)] = NaN_fill
+            theta = GP_Fit_Batch([_X], [_Y], [_eY])
+            _, _, FACTOR = GP_Predict_Batch(theta, [_X], [_Y], [_eY], _X[:1])
+            if len(GP_FIT_CACHE) >= GP_FIT_CACHE_SIZE: GP_FIT_CACHE.pop(next(iter(GP_FIT_CACHE)))
+            GP_FIT_CACHE[key] = (theta, FACTOR)
+        
+        theta, FACTOR = GP_FIT_CACHE[key]
+        Y_q, eY_q, _ = GP_Predict_Batch(theta, None, None, None, np.asarray(X_q, dtype=float), FACTOR=FACTOR)
+        return Y_q[0], eY_q[0]
+
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import RBF, ConstantKernel as CK
+
     # * nan-correction
     Avmask = ~np.isnan(Y)
     X, Y, eY = X[Avmask], Y[Avmask], eY[Avmask]
@@ -0,0 +1,68 @@
+import os
+import glob
+import shutil
+import hashlib
+import numpy as np
+import os.path as pa
+from tempfile import mkdtemp
+
+# * Binary cache of the helper assets (see ./helper/)
+#   NOTE: the text files in ./helper/ are always the source of truth.
+#         they are compiled once into a directory of .npy files, which can be loaded via memory-mapping.
+#         a cache entry is keyed by CACHE_VERSION and the (name, size, mtime) of its source files,
+#         so editing any source file (or bumping CACHE_VERSION) triggers a rebuild.
+
+CACHE_VERSION = 1
+HDIR = pa.join(pa.dirname(__file__), 'helper')
+
+def Cache_Dir():
+
+    # ** priority: $SNAIL_CACHE_DIR > ./helper/cache > ~/.cache/snail
+    if os.environ.get('SNAIL_CACHE_DIR'):
+        return os.environ['SNAIL_CACHE_DIR']
+    CDIR = pa.join(HDIR, 'cache')
+    if os.access(HDIR, os.W_OK) or os.access(CDIR, os.W_OK):
+        return CDIR
+    return pa.join(pa.expanduser('~'), '.cache', 'snail')
+
+def Cache_Key(source_files):
+
+    H = hashlib.sha1(('v%d' %CACHE_VERSION).encode())
+    for file in sorted(source_files):
+        st = os.stat(file)
+        H.update(('%s|%d|%d' %(pa.basename(file), st.st_size, st.st_mtime_ns)).encode())
+    return H.hexdigest()[:16]
+
+def Load_CachedArrays(tag, source_files, builder, mmap_mode='r'):
+
+    # ** try to load an existing cache entry
+    CDIR = Cache_Dir()
+    EDIR = pa.join(CDIR, '%s-%s' %(tag, Cache_Key(source_files)))
+    if pa.exists(EDIR):
+        ARRDICT = {}
+        for file in glob.glob(EDIR + '/*.npy'):
+            ARRDICT[pa.basename(file)[:-4]] = np.load(file, mmap_mode=mmap_mode)
+        return ARRDICT
+
+    # ** build from the source files
+    ARRDICT = builder()
+
+    # ** write a new cache entry (atomic rename of a temp-dir, silently skip if not writable)
+    try:
+        os.makedirs(CDIR, exist_ok=True)
+        TDIR = mkdtemp(prefix='.%s-' %tag, dir=CDIR)
+        for key in ARRDICT:
+            np.save(pa.join(TDIR, '%s.npy' %key), np.ascontiguousarray(ARRDICT[key]))
+        try:
+            os.rename(TDIR, EDIR)
+        except OSError:
+            shutil.rmtree(TDIR, ignore_errors=True)   # entry made by a concurrent process
+
+        # ** remove stale entries of this tag
+        for _EDIR in glob.glob(pa.join(CDIR, '%s-%s' %(tag, '?'*16))):
+            if _EDIR != EDIR:
+                shutil.rmtree(_EDIR, ignore_errors=True)
+    except OSError:
+        pass
+
+    return ARRDICT
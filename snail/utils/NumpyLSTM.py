@@ -0,0 +1,172 @@
+import numpy as np
+
+def Export_BiLSTM(lstm_model, npz_file=None):
+
+    # NOTE: pull the weights of the (Bayesian) Bi-LSTM returned by SNAIL_Train.SLT,
+    #       i.e., a stack of Bidirectional(LSTM) layers followed by TimeDistributed(Dense),
+    #       into a dictionary of arrays (saved as .npz if npz_file is given).
+    #       the keys are L<k>_<fw|bw>_<kernel|recurrent_kernel|bias> & L<k>_<dropout|recurrent_dropout|untied_masks>
+    #       for the k-th Bi-LSTM layer, and dense_kernel & dense_bias for the output layer.
+
+    WEIGHTS, k = {}, 0
+    for layer in lstm_model.layers:
+        lname = layer.__class__.__name__
+        if lname == 'InputLayer': continue
+
+        if lname == 'Bidirectional':
+            assert layer.merge_mode == 'concat'
+            for tag, sublayer in [('fw', layer.forward_layer), ('bw', layer.backward_layer)]:
+                config = sublayer.get_config()
+                assert config['activation'] == 'tanh' and config['recurrent_activation'] == 'sigmoid'
+                assert config['return_sequences'] and config['use_bias']
+                kernel, recurrent_kernel, bias = sublayer.get_weights()
+                WEIGHTS['L%d_%s_kernel' %(k, tag)] = kernel
+                WEIGHTS['L%d_%s_recurrent_kernel' %(k, tag)] = recurrent_kernel
+                WEIGHTS['L%d_%s_bias' %(k, tag)] = bias
+
+            # NOTE: Keras 2 (implementation 1) draws an independent dropout mask for each of the 4 gates,
+            #       while implementation 2 (and Keras 3) share a single mask for all gates.
+            cell = layer.forward_layer.cell
+            untied = config.get('implementation', 1) == 1 and hasattr(cell, 'get_dropout_mask_for_cell')
+            WEIGHTS['L%d_dropout' %k] = float(config['dropout'])
+            WEIGHTS['L%d_recurrent_dropout' %k] = float(config['recurrent_dropout'])
+            WEIGHTS['L%d_untied_masks' %k] = bool(untied)
+            k += 1
+            continue
+
+        if lname == 'TimeDistributed':
+            assert layer.layer.get_config()['activation'] == 'linear'
+            WEIGHTS['dense_kernel'], WEIGHTS['dense_bias'] = layer.layer.get_weights()
+            continue
+
+        raise ValueError('Unsupported layer [%s] for NumpyBiLSTM !' %lname)
+
+    WEIGHTS['n_layers'] = k
+    if npz_file is not None: np.savez(npz_file, **WEIGHTS)
+    return WEIGHTS
+
+class NumpyBiLSTM:
+
+    # ** Remarks on the NumPy inference engine
+    #    A drop-in replacement of the Keras lstm_model (only the predict method) in SNAIL_Predict_Deep,
+    #    running the Bi-LSTM layers exported by Export_BiLSTM without TensorFlow.
+    #    mc_dropout=True mimics the Bayesian model (training=True), i.e., the time-locked dropout
+    #    masks on inputs and recurrent states are drawn per sample (and per direction) in each call,
+    #    as in Keras. mc_dropout=False gives the deterministic prediction (dropout off).
+    #    NOTE: dtype float32 follows Keras, use float64 for reference calculations.
+
+    def __init__(self, WEIGHTS, mc_dropout=True, seed=None, dtype=np.float32):
+        if isinstance(WEIGHTS, str):
+            with np.load(WEIGHTS) as NPZ: WEIGHTS = {key: NPZ[key] for key in NPZ.files}
+        self.mc_dropout = mc_dropout
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+
+        self.LAYERS = []
+        for k in range(int(WEIGHTS['n_layers'])):
+            layer = {'dropout': float(WEIGHTS['L%d_dropout' %k]), \
+                     'recurrent_dropout': float(WEIGHTS['L%d_recurrent_dropout' %k]), \
+                     'untied_masks': bool(WEIGHTS['L%d_untied_masks' %k])}
+            for tag in ['fw', 'bw']:
+                kernel = np.asarray(WEIGHTS['L%d_%s_kernel' %(k, tag)], dtype=dtype)
+                recurrent_kernel = np.asarray(WEIGHTS['L%d_%s_recurrent_kernel' %(k, tag)], dtype=dtype)
+                n_units = recurrent_kernel.shape[0]
+                # NOTE: gate-major copies (4, dim, n_units) for the gate-wise masked products, gates ordered as i, f, c, o
+                layer[tag] = (kernel, kernel.reshape((-1, 4, n_units)).transpose(1, 0, 2).copy(), \
+                              recurrent_kernel, recurrent_kernel.reshape((-1, 4, n_units)).transpose(1, 0, 2).copy(), \
+                              np.asarray(WEIGHTS['L%d_%s_bias' %(k, tag)], dtype=dtype))
+            self.LAYERS.append(layer)
+        self.DENSE = (np.asarray(WEIGHTS['dense_kernel'], dtype=dtype), np.asarray(WEIGHTS['dense_bias'], dtype=dtype))
+
+    @staticmethod
+    def Load(npz_file, mc_dropout=True, seed=None, dtype=np.float32):
+        return NumpyBiLSTM(npz_file, mc_dropout=mc_dropout, seed=seed, dtype=dtype)
+
+    def _draw_masks(self, rng, nsamp):
+        # NOTE: boolean keep-masks (True = kept) of all Bi-LSTM layers for nsamp samples,
+        #       one mask per gate (untied) or shared (nmask=1), drawn in a fixed order.
+        MASKS = {}
+        for k, layer in enumerate(self.LAYERS):
+            nmask = 4 if layer['untied_masks'] else 1
+            for tag in ['fw', 'bw']:
+                D, n_units = layer[tag][0].shape[0], layer[tag][2].shape[0]
+                DMASK, RMASK = None, None
+                if layer['dropout'] > 0: DMASK = rng.random((nmask, nsamp, D)) >= layer['dropout']
+                if layer['recurrent_dropout'] > 0: RMASK = rng.random((nmask, nsamp, n_units)) >= layer['recurrent_dropout']
+                MASKS[(k, tag)] = (DMASK, RMASK)
+        return MASKS
+
+    def Draw_Masks(self, nsamp, passes, seed):
+
+        # ** Remarks on seeded MC-dropout
+        #    The masks of forward pass p are drawn from its own generator default_rng([seed, p]),
+        #    so that a pass gives identical output no matter how the passes are grouped into calls
+        #    or sharded across processes. The masks of all given passes are stacked (pass-major)
+        #    as one tensor per layer & direction, matching the LSTM input np.tile(XDATA, (npass, 1, 1)).
+        #    NOTE: the masks of a pass depend on nsamp, i.e., the outputs are reproducible for the same XDATA.
+        
+        MASKS_Lst = [self._draw_masks(np.random.default_rng([seed, p]), nsamp) for p in passes]
+        MASKS = {}
+        for key in MASKS_Lst[0]:
+            MASKS[key] = tuple(None if MASKS_Lst[0][key][j] is None else \
+                np.concatenate([_masks[key][j] for _masks in MASKS_Lst], axis=1) for j in range(2))
+        return MASKS
+
+    def _lstm_sequence(self, X, WEIGHTS, dropout, recurrent_dropout, DMASK, RMASK, reverse):
+        kernel, kernel_4, recurrent_kernel, recurrent_kernel_4, bias = WEIGHTS
+        B, T, D = X.shape
+        n_units = recurrent_kernel.shape[0]
+
+        # ** input projections of all timesteps (the input mask is time-locked)
+        #    NOTE: inverted dropout as Keras, the kept entries are scaled by 1/(1-rate)
+        if DMASK is not None:
+            nmask = DMASK.shape[0]
+            XPROJ = np.concatenate([np.matmul(X * DMASK[g % nmask][:, None, :], kernel_4[g]) \
+                for g in range(4)], axis=2) / self.dtype(1.0 - dropout)
+        else: XPROJ = np.matmul(X, kernel)
+        XPROJ += bias
+        if RMASK is not None:
+            RMASK = np.broadcast_to(RMASK / self.dtype(1.0 - recurrent_dropout), (4, B, n_units))
+
+        # ** recurrence
+        H = np.zeros((B, n_units), dtype=self.dtype)
+        C = np.zeros((B, n_units), dtype=self.dtype)
+        HSEQ = np.zeros((B, T, n_units), dtype=self.dtype)
+        for step, t in enumerate(range(T-1, -1, -1) if reverse else range(T)):
+            Z = XPROJ[:, t, :].copy()
+            if step == 0: pass      # NOTE: zero initial state, no recurrent term
+            elif RMASK is not None:
+                Z += np.matmul(H[None] * RMASK, recurrent_kernel_4).transpose(1, 0, 2).reshape((B, -1))
+            else: Z += np.matmul(H, recurrent_kernel)
+            I = 1.0 / (1.0 + np.exp(-Z[:, :n_units]))
+            F = 1.0 / (1.0 + np.exp(-Z[:, n_units: 2*n_units]))
+            O = 1.0 / (1.0 + np.exp(-Z[:, 3*n_units:]))
+            C = F * C + I * np.tanh(Z[:, 2*n_units: 3*n_units])
+            H = O * np.tanh(C)
+            HSEQ[:, t, :] = H
+        return HSEQ
+
+    def _forward(self, X, MASKS):
+        for k, layer in enumerate(self.LAYERS):
+            HSEQ_Lst = []
+            for tag, reverse in [('fw', False), ('bw', True)]:
+                DMASK, RMASK = (None, None) if MASKS is None else MASKS[(k, tag)]
+                HSEQ_Lst.append(self._lstm_sequence(X, layer[tag], layer['dropout'], layer['recurrent_dropout'], \
+                    DMASK, RMASK, reverse))
+            X = np.concatenate(HSEQ_Lst, axis=2)
+        return np.matmul(X, self.DENSE[0]) + self.DENSE[1]
+
+    def predict(self, X, batch_size=None, verbose=0, masks=None):
+        # NOTE: same call signature as the Keras predict (verbose is ignored),
+        #       batch_size only bounds the peak memory here (default: all samples at once).
+        #       masks: pre-drawn dropout masks (see Draw_Masks), otherwise the masks are drawn 
+        #       from the internal generator if mc_dropout=True (no dropout if mc_dropout=False).
+        X = np.asarray(X, dtype=self.dtype)
+        if masks is None and self.mc_dropout: masks = self._draw_masks(self.rng, X.shape[0])
+        if batch_size is None or batch_size >= X.shape[0]: return self._forward(X, masks)
+        
+        def slice_masks(i0, i1):
+            if masks is None: return None
+            return {key: tuple(None if M is None else M[:, i0: i1] for M in masks[key]) for key in masks}
+        return np.concatenate([self._forward(X[i: i+batch_size], slice_masks(i, i+batch_size)) \
+            for i in range(0, X.shape[0], batch_size)], axis=0)
@@ -0,0 +1,113 @@
+import numpy as np
+
+class OnlineSurfaceStats:
+
+    # NOTE: streaming mean & variance of MC-dropout surfaces (Welford's algorithm),
+    #       each update takes a block of forward passes with shape (npass, ...),
+    #       and blocks are merged by the parallel form of the algorithm (Chan et al. 1979).
+    #       peak memory is O(size of one block) regardless of the total number of passes.
+    #
+    #       optionally, percentiles (e.g., [16, 50, 84]) are tracked by the P-square algorithm
+    #       (Jain & Chlamtac 1985), a sketch with 5 markers per percentile per pixel.
+    #       NOTE: the P-square estimates are approximate, they are exact for no more than 5 passes.
+
+    def __init__(self, percentiles=None):
+        self.count = 0
+        self.mean = None
+        self.M2 = None
+
+        self.percentiles = [] if percentiles is None else [float(q) for q in percentiles]
+        for q in self.percentiles: assert 0.0 < q < 100.0
+        self._init_obs = []      # the first 5 passes (to initialize the markers)
+        self._markers = {}       # percentile -> (marker heights, marker positions)
+
+    def update(self, SurfaceBlock):
+        SurfaceBlock = np.asarray(SurfaceBlock, dtype=float)
+        m = SurfaceBlock.shape[0]
+        if m == 0: return
+
+        # ** P-square sketch (one pass at a time, vectorized over pixels)
+        if self.percentiles:
+            for k in range(m):
+                self._update_sketch(SurfaceBlock[k], self.count + k + 1)
+
+        # ** Welford (block-wise)
+        bmean = np.mean(SurfaceBlock, axis=0)
+        bM2 = np.sum((SurfaceBlock - bmean)**2, axis=0)
+        self._combine(m, bmean, bM2)
+
+    def _combine(self, m, bmean, bM2):
+        if self.count == 0:
+            self.count, self.mean, self.M2 = m, bmean, bM2
+        else:
+            n = self.count + m
+            delta = bmean - self.mean
+            self.mean = self.mean + delta * (m / n)
+            self.M2 = self.M2 + bM2 + delta**2 * (self.count * m / n)
+            self.count = n
+
+    def merge(self, other):
+        # NOTE: merge the statistics of another (disjoint) set of passes, e.g., a shard of
+        #       seeded MC-dropout passes computed by another process (see SNAIL_Predict_Deep.MCDropout).
+        #       the P-square sketches can not be merged, so percentiles are not supported here.
+        assert not self.percentiles and not other.percentiles
+        if other.count > 0: self._combine(other.count, other.mean, other.M2)
+        return self
+
+    def _update_sketch(self, x, nobs):
+        if nobs <= 5:
+            self._init_obs.append(x.copy())
+            if nobs == 5:
+                Q0 = np.sort(np.array(self._init_obs), axis=0)
+                for q in self.percentiles:
+                    N0 = np.broadcast_to(np.arange(5).astype(float).reshape((5,) + (1,)*x.ndim), Q0.shape).copy()
+                    self._markers[q] = (Q0.copy(), N0)
+                self._init_obs = []
+            return
+
+        for q in self.percentiles:
+            p = q / 100.0
+            Q, N = self._markers[q]
+
+            # *** find the cell k of x and update extreme markers
+            Q[0] = np.minimum(Q[0], x)
+            Q[4] = np.maximum(Q[4], x)
+            k = np.sum(x >= Q[1:4], axis=0)   # 0 ... 3
+            for i in range(1, 5):
+                N[i] += (k < i)
+
+            # *** desired marker positions after nobs observations
+            NP = (nobs - 1) * np.array([0.0, p/2, p, (1+p)/2, 1.0])
+
+            # *** adjust the three middle markers
+            for i in range(1, 4):
+                d = NP[i] - N[i]
+                move = np.logical_or(np.logical_and(d >= 1, N[i+1] - N[i] > 1), \
+                                     np.logical_and(d <= -1, N[i-1] - N[i] < -1))
+                if not np.any(move): continue
+                d = np.sign(d)
+                # parabolic prediction
+                Qp = Q[i] + d / (N[i+1] - N[i-1]) * ((N[i] - N[i-1] + d) * (Q[i+1] - Q[i]) / (N[i+1] - N[i]) + \
+                                                      (N[i+1] - N[i] - d) * (Q[i] - Q[i-1]) / (N[i] - N[i-1]))
+                # linear prediction (fallback)
+                Qn = np.where(d > 0, Q[i] + (Q[i+1] - Q[i]) / (N[i+1] - N[i]), \
+                                     Q[i] - (Q[i-1] - Q[i]) / (N[i-1] - N[i]))
+                Qnew = np.where(np.logical_and(Q[i-1] < Qp, Qp < Q[i+1]), Qp, Qn)
+                Q[i] = np.where(move, Qnew, Q[i])
+                N[i] = np.where(move, N[i] + d, N[i])
+
+    def variance(self, ddof=0):
+        # NOTE: ddof=0 is consistent with np.var
+        return self.M2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof=ddof))
+
+    def percentile(self, q):
+        q = float(q)
+        assert q in self.percentiles
+        if self.count < 5:
+            return np.percentile(np.array(self._init_obs), q, axis=0)
+        if self.count == 5:
+            return np.percentile(self._markers[q][0], q, axis=0)   # markers are the sorted passes
+        return self._markers[q][0][2].copy()
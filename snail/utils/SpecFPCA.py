@@ -2,26 +2,85 @@ import os
 import numpy as np
 import os.path as pa
 from tempfile import mkdtemp
-from astropy.table import Table
+from snail.utils.HelperCache import Load_CachedArrays
 
-# * Load default FPCA Basis
+# * Load default FPCA Basis (lazily, through the binary cache of helper assets)
 HDIR = pa.join(pa.dirname(__file__), 'helper')
 FPCA_DIR = pa.join(HDIR, 'fpca_basis')
-BASIS_Lst, MEAN_Lst = [], []
-for b in range(2):
-    Ast_SEFunc = Table.read(FPCA_DIR + '/B%d_SoEfunc.csv' %b)
-    B = [np.array([e for e in Ast_SEFunc[k]]) for k in range(len(Ast_SEFunc))]
-    BASIS_Lst.append(B)
-    Ast_SFM = Table.read(FPCA_DIR + '/B%d_SoFittedMean.csv' %b)
-    MEAN_Lst.append(np.array(Ast_SFM['x']))
-
-def FPCA_Parameterize(WAVE, FLUX, R_PATH):
+FPCA_MODEL = {}
+
+def Load_FPCA_Model():
+
+    if not FPCA_MODEL:
+        SOURCES = [FPCA_DIR + '/B%d_%s.csv' %(b, comp) for b in range(2) \
+            for comp in ['ReqGrid', 'SoFittedMean', 'SoEval', 'SoEfunc', 'SoErrvar']]
+        
+        def builder():
+            from astropy.table import Table
+            ARRDICT = {}
+            for b in range(2):
+                Ast_SEFunc = Table.read(FPCA_DIR + '/B%d_SoEfunc.csv' %b)
+                ARRDICT['B%d_SoEfunc' %b] = np.array([Ast_SEFunc[c] for c in Ast_SEFunc.colnames]).T.astype(float)
+                for comp in ['ReqGrid', 'SoFittedMean', 'SoEval', 'SoErrvar']:
+                    ARRDICT['B%d_%s' %(b, comp)] = np.array(Table.read(FPCA_DIR + '/B%d_%s.csv' %(b, comp))['x']).astype(float)
+            return ARRDICT
+        
+        ARRDICT = Load_CachedArrays('fpca_basis', SOURCES, builder)
+        FPCA_MODEL['BASIS_Lst'] = [ARRDICT['B%d_SoEfunc' %b] for b in range(2)]    # shape (90, 1001)
+        FPCA_MODEL['MEAN_Lst'] = [ARRDICT['B%d_SoFittedMean' %b] for b in range(2)]
+        FPCA_MODEL['GRID_Lst'] = [ARRDICT['B%d_ReqGrid' %b] for b in range(2)]
+        FPCA_MODEL['EVAL_Lst'] = [ARRDICT['B%d_SoEval' %b] for b in range(2)]
+        FPCA_MODEL['ERRVAR_Lst'] = [float(ARRDICT['B%d_SoErrvar' %b][0]) for b in range(2)]
+    
+    return FPCA_MODEL
+
+def __getattr__(name):
+    # NOTE: keep module attributes (e.g., BASIS_Lst, MEAN_Lst) available on first access
+    if name in ['BASIS_Lst', 'MEAN_Lst', 'GRID_Lst', 'EVAL_Lst', 'ERRVAR_Lst']:
+        return Load_FPCA_Model()[name]
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
+
+def FPCA_ScoreOperator(MEASTIME, b, Dim=90):
+
+    # NOTE: this is a NumPy transcription of fpca.score in the R package fpca,
+    #       the conditional FPC scores (BLUP) are given by
+    #       xi = Λ Φ^T (Φ Λ Φ^T + σ^2 I)^-1 (Y - μ) = (Φ^T Φ + σ^2 Λ^-1)^-1 Φ^T (Y - μ)
+    #       where the right-hand side (Woodbury identity) only requires a Dim x Dim solve.
+    #       The linear operator only depends on the measurement times, so one can reuse it.
+
+    FM = Load_FPCA_Model()
+    N = len(FM['GRID_Lst'][b])
+    gridtime = np.ceil(N*MEASTIME).astype(int) - 1   # R indexing (1-based) to Python
+    gridtime = np.clip(gridtime, 0, N-1)
+    Phiy = FM['BASIS_Lst'][b][:Dim, gridtime].T   # shape (m, Dim)
+    muy = FM['MEAN_Lst'][b][gridtime]
+    
+    A = np.dot(Phiy.T, Phiy) + FM['ERRVAR_Lst'][b] * np.diag(1.0/FM['EVAL_Lst'][b][:Dim])
+    SOPER = np.linalg.solve(A, Phiy.T)   # shape (Dim, m)
+    
+    return muy, SOPER
+
+def FPCA_MeasTime(W, b):
+    # * map the wavelength of a section (blue & red) onto the unit interval
+    RCut0 = 3800
+    L = 1698
+    WAV = W.astype(float)-(RCut0+1700*b)
+    WAV = WAV/(L/0.998)
+    WAV = WAV+0.001
+    return WAV
+
+# NOTE: the measurement times are fixed by the standard wavelength,
+#       so the scoring operators are computed once and cached here.
+SOPER_CACHE = {}
+
+def FPCA_Parameterize(WAVE, FLUX, R_PATH=None, backend='native'):
     
     Dim = 90
     RCut0, RCut1 = 3800, 7200
     _WAVE = np.arange(RCut0, RCut1, 2)
     assert np.allclose(WAVE, _WAVE)
     assert np.allclose(np.mean(FLUX), 1.0)
+    assert backend in ['native', 'R']
     
     # * divide into two sections (blue & red)
     SECE = []
@@ -34,25 +93,45 @@ def FPCA_Parameterize(WAVE, FLUX, R_PATH):
         F = F / varcolor
         SECE.append([photcolor, varcolor, W, F])
     
-    # * place FPCA input in a temp-dir
-    TDIR = mkdtemp(suffix=None, prefix='4fpca', dir=None)
+    # * measurement times on the unit interval (same as the FPCA input)
     for b in range(2):
-        WAV = SECE[b][2].copy()
-        FL = SECE[b][3].copy()
-        L = 1698
-        WAV = WAV-(RCut0+1700*b)
-        WAV = WAV/(L/0.998)
-        WAV = WAV+0.001
-        IDX = np.zeros(len(WAV)).astype(int)
-        AST = Table([IDX, FL, WAV], names=['IDX', 'FL', 'WAV'])
-        AST.write(TDIR + '/B%d_CataApply.csv' %b, format='ascii.csv', overwrite=True)
+        WAV = FPCA_MeasTime(SECE[b][2], b)
+        SECE[b].append(WAV)
     
-    # * run FPCA in R
-    for b in range(2):
-        command1 = 'cd %s/ && %s --slave --no-restore --file=B%d_FPCA_Application.R ' %(FPCA_DIR, R_PATH, b)
-        command2 = '--args %s/B%d_CataApply.csv %s/B%d_ApplyScore.csv' %(TDIR, b, TDIR, b)
-        os.system(command1 + command2)
+    if backend == 'native':
+        # * run FPCA scoring in-process
+        ScoreArray = np.zeros((2, Dim)).astype(float)
+        for b in range(2):
+            FL, WAV = SECE[b][3], SECE[b][4]
+            if (b, Dim) not in SOPER_CACHE:
+                SOPER_CACHE[(b, Dim)] = FPCA_ScoreOperator(WAV, b, Dim=Dim)
+            muy, SOPER = SOPER_CACHE[(b, Dim)]
+            ScoreArray[b, :] = np.dot(SOPER, FL - muy)
     
+    if backend == 'R':
+        assert R_PATH is not None
+        from astropy.table import Table
+        # * place FPCA input in a temp-dir
+        TDIR = mkdtemp(suffix=None, prefix='4fpca', dir=None)
+        for b in range(2):
+            FL, WAV = SECE[b][3].copy(), SECE[b][4].copy()
+            IDX = np.zeros(len(WAV)).astype(int)
+            AST = Table([IDX, FL, WAV], names=['IDX', 'FL', 'WAV'])
+            AST.write(TDIR + '/B%d_CataApply.csv' %b, format='ascii.csv', overwrite=True)
+        
+        # * run FPCA in R
+        for b in range(2):
+            command1 = 'cd %s/ && %s --slave --no-restore --file=B%d_FPCA_Application.R ' %(FPCA_DIR, R_PATH, b)
+            command2 = '--args %s/B%d_CataApply.csv %s/B%d_ApplyScore.csv' %(TDIR, b, TDIR, b)
+            os.system(command1 + command2)
+        
+        ScoreArray = np.zeros((2, Dim)).astype(float)
+        for b in range(2):
+            ast = Table.read(TDIR + '/B%d_ApplyScore.csv' %b)
+            for k in range(Dim): 
+                ScoreArray[b, k] = ast['V%d' %(k+1)][0]
+        os.system('rm -rf %s' %TDIR)
+
     # * collect the parameters
     CArray = np.zeros((2, 2)).astype(float)
     for b in range(2):
@@ -60,41 +139,109 @@ def FPCA_Parameterize(WAVE, FLUX, R_PATH):
         CArray[b, 0] = photcolor
         CArray[b, 1] = varcolor
     
-    ScoreArray = np.zeros((2, Dim)).astype(float)
-    for b in range(2):
-        ast = Table.read(TDIR + '/B%d_ApplyScore.csv' %b)
-        for k in range(Dim): 
-            ScoreArray[b, k] = ast['V%d' %(k+1)][0]
-    
     FPCA_PARAM = np.concatenate((CArray, ScoreArray), axis=1)
-    os.system('rm -rf %s' %TDIR)
     
     return FPCA_PARAM
 
-def FPCA_Reconstruct(FPCA_PARAM):
-        
+def FPCA_Parameterize_Batch(WAVE, FLUX_2D, chunk_size=4096):
+
+    # NOTE: in-process FPCA parameterization for many spectra in one call,
+    #       FLUX_2D has shape (N, 1700) and the output has shape (N, 2, 92).
+    #       Spectra are processed in blocks of chunk_size to keep memory bounded.
+
     Dim = 90
     RCut0, RCut1 = 3800, 7200
-    WRec, FRec = [], []
+    _WAVE = np.arange(RCut0, RCut1, 2)
+    assert np.allclose(WAVE, _WAVE)
+    FLUX_2D = np.atleast_2d(FLUX_2D)
+    assert FLUX_2D.shape[1] == len(_WAVE)
+    assert np.allclose(np.mean(FLUX_2D, axis=1), 1.0)
+
+    # * get the (cached) scoring operators of two sections (blue & red)
     for b in range(2):
-        BASIS = BASIS_Lst[b].copy()
-        MEAN = MEAN_Lst[b].copy()
-        photcolor, varcolor = FPCA_PARAM[b, :2]
-        scores = FPCA_PARAM[b, 2:]
-        
-        ReSpec = MEAN
-        for i in range(Dim):
-            ReSpec += scores[i] * BASIS[i]  
-        ReSpec *= varcolor
-        ReSpec += photcolor
+        if (b, Dim) not in SOPER_CACHE:
+            WAV = FPCA_MeasTime(WAVE[850*b: 850*(b+1)], b)
+            SOPER_CACHE[(b, Dim)] = FPCA_ScoreOperator(WAV, b, Dim=Dim)
+
+    NSPEC = FLUX_2D.shape[0]
+    FPCA_PARAM_3D = np.zeros((NSPEC, 2, 2+Dim)).astype(float)
+    for i0 in range(0, NSPEC, chunk_size):
+        i1 = min(i0+chunk_size, NSPEC)
+        for b in range(2):
+            F = FLUX_2D[i0: i1, 850*b: 850*(b+1)].astype(float)
+            photcolor = np.mean(F, axis=1)
+            F = F - photcolor[:, None]
+            varcolor = np.std(F, axis=1)
+            F = F / varcolor[:, None]
+            muy, SOPER = SOPER_CACHE[(b, Dim)]
+            FPCA_PARAM_3D[i0: i1, b, 0] = photcolor
+            FPCA_PARAM_3D[i0: i1, b, 1] = varcolor
+            FPCA_PARAM_3D[i0: i1, b, 2:] = np.dot(F - muy, SOPER.T)   # single GEMM per block
+    
+    return FPCA_PARAM_3D
+
+# NOTE: stacked basis & (optional) resampling operators for reconstruction, computed once and cached here.
+RECON_CACHE = {}
+
+def FPCA_Reconstruct_Operator(resample=False, Dim=90):
+
+    if (resample, Dim) not in RECON_CACHE:
+        RCut0, RCut1 = 3800, 7200
+        FM = Load_FPCA_Model()
+        BASIS_3D = np.array([FM['BASIS_Lst'][b][:Dim] for b in range(2)])   # shape (2, Dim, 1001)
+        MEAN_2D = np.array([FM['MEAN_Lst'][b] for b in range(2)])           # shape (2, 1001)
+        ONE_2D = np.ones(MEAN_2D.shape).astype(float)
+        WRec = np.concatenate([np.linspace(RCut0+1700*b, RCut0+1700*(b+1)-2, 1001) for b in range(2)])
+
+        if resample:
+            # * linear interpolation (with extrapolation) from the reconstruction wavelength
+            #   to the standard wavelength, as a sparse matrix of shape (1700, 2002).
+            #   being linear, it can be folded into the basis, mean and the constant term of each section.
+            from scipy.sparse import csr_matrix
+            WAVE = np.arange(RCut0, RCut1, 2).astype(float)
+            idx = np.clip(np.searchsorted(WRec, WAVE, side='right') - 1, 0, len(WRec)-2)
+            t = (WAVE - WRec[idx]) / (WRec[idx+1] - WRec[idx])
+            rows = np.concatenate([np.arange(len(WAVE))]*2)
+            cols = np.concatenate([idx, idx+1])
+            vals = np.concatenate([1.0-t, t])
+            IMAT = csr_matrix((vals, (rows, cols)), shape=(len(WAVE), len(WRec)))
+            
+            BASIS_3D = np.array([IMAT[:, 1001*b: 1001*(b+1)].dot(BASIS_3D[b].T).T for b in range(2)])  # shape (2, Dim, 1700)
+            MEAN_2D = np.array([IMAT[:, 1001*b: 1001*(b+1)].dot(MEAN_2D[b]) for b in range(2)])        # shape (2, 1700)
+            ONE_2D = np.array([IMAT[:, 1001*b: 1001*(b+1)].dot(ONE_2D[b]) for b in range(2)])          # shape (2, 1700)
+            WRec = WAVE
         
-        B0, B1 = RCut0+1700*b, RCut0+1700*(b+1)-2
-        wav = np.linspace(B0, B1, 1001)
-        WRec += list(wav)
-        FRec += list(ReSpec)
+        RECON_CACHE[(resample, Dim)] = (WRec, BASIS_3D, MEAN_2D, ONE_2D)
+    
+    return RECON_CACHE[(resample, Dim)]
+
+def FPCA_Reconstruct_Batch(FPCA_PARAM_3D, resample=False):
+
+    # NOTE: reconstruct many spectra in one call, FPCA_PARAM_3D has shape (N, 2, 92).
+    #       resample=False: output on the reconstruction wavelength, flux has shape (N, 2002).
+    #       resample=True: output (linearly) resampled on the standard wavelength, flux has shape (N, 1700).
 
-    WRec = np.array(WRec)
-    FRec = np.array(FRec)
+    Dim = 90
+    FPCA_PARAM_3D = np.asarray(FPCA_PARAM_3D).astype(float)
+    assert FPCA_PARAM_3D.ndim == 3 and FPCA_PARAM_3D.shape[1:] == (2, 2+Dim)
+    WRec, BASIS_3D, MEAN_2D, ONE_2D = FPCA_Reconstruct_Operator(resample=resample, Dim=Dim)
+    
+    photcolor = FPCA_PARAM_3D[:, :, 0]   # shape (N, 2)
+    varcolor = FPCA_PARAM_3D[:, :, 1]    # shape (N, 2)
+    scores = FPCA_PARAM_3D[:, :, 2:]     # shape (N, 2, Dim)
+    ReSpec = np.matmul(scores.transpose(1, 0, 2), BASIS_3D).transpose(1, 0, 2)   # one GEMM per section
+    ReSpec = ReSpec + MEAN_2D[None, :, :]
+    ReSpec = ReSpec * varcolor[:, :, None] + photcolor[:, :, None] * ONE_2D[None, :, :]
+    
+    if resample: FRec = np.sum(ReSpec, axis=1)   # sections overlap at the boundary
+    else: FRec = ReSpec.reshape((ReSpec.shape[0], -1))
     RecSpecDict = {'wavelength': WRec, 'flux': FRec}
 
     return RecSpecDict
+
+def FPCA_Reconstruct(FPCA_PARAM):
+    
+    RecSpecDict = FPCA_Reconstruct_Batch(np.asarray(FPCA_PARAM)[None, :, :])
+    RecSpecDict = {'wavelength': RecSpecDict['wavelength'].copy(), 'flux': RecSpecDict['flux'][0]}
+
+    return RecSpecDict
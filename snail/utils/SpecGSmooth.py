@@ -2,49 +2,109 @@ import numpy as np
 from math import sqrt, pi
 # NOTE: these are functions copied from Kaepora.
 
-def GSmooth(Wave, Flux, varFlux=None, vexp=0.002, nsig=5.0):
+# NOTE: cache of sparse smoothing kernels, (Wave grid, vexp, nsig) -> csr matrix (see GSmooth_Kernel)
+GSMOOTH_KERNEL_CACHE = {}
+GSMOOTH_KERNEL_CACHE_SIZE = 8
+
+def GSmooth_Band(Wave, vexp=0.002, nsig=5.0):
+
+    # NOTE: banded form of the Gaussian kernels (Wave is sorted),
+    #       the window [lo, hi) of each point is located by searchsorted, 
+    #       returns the column indices COLS & gaussian weights GAUSS, both of shape (len(Wave), max window).
+    #       entries outside a window have zero weight.
+
+    Wave = np.asarray(Wave, dtype=float)
+    SIGMA = vexp*Wave
+    
+    # ** windows of +/- nsig sigma (widened by one point, then restricted by the exact criterion)
+    lo = np.clip(np.searchsorted(Wave, Wave - nsig*SIGMA, side='left') - 1, 0, None)
+    hi = np.clip(np.searchsorted(Wave, Wave + nsig*SIGMA, side='right') + 1, None, len(Wave))
+    COLS = lo[:, None] + np.arange(np.max(hi - lo))[None, :]
+    INWIN = COLS < hi[:, None]
+    COLS = np.where(INWIN, COLS, lo[:, None])
+    
+    DW = Wave[COLS] - Wave[:, None]
+    INWIN = np.logical_and(INWIN, abs(DW) <= nsig*SIGMA[:, None])
+    GAUSS = (1/(SIGMA[:, None]*sqrt(2*pi)))*np.exp(-0.5*(DW/SIGMA[:, None])**2)
+    GAUSS[~INWIN] = 0.0
+
+    return COLS, GAUSS
+
+def GSmooth_Kernel(Wave, vexp=0.002, nsig=5.0):
+
+    # NOTE: the Gaussian kernels as a sparse matrix of shape (len(Wave), len(Wave)),
+    #       cached per (Wave grid, vexp, nsig) and reused across spectra.
+    from scipy.sparse import csr_matrix
+
+    Wave = np.asarray(Wave, dtype=float)
+    key = (Wave.tobytes(), float(vexp), float(nsig))
+    if key not in GSMOOTH_KERNEL_CACHE:
+        COLS, GAUSS = GSmooth_Band(Wave, vexp=vexp, nsig=nsig)
+        ROWS = np.broadcast_to(np.arange(len(Wave))[:, None], COLS.shape)
+        nzmask = GAUSS > 0.0
+        KMAT = csr_matrix((GAUSS[nzmask], (ROWS[nzmask], COLS[nzmask])), shape=(len(Wave), len(Wave)))
+        if len(GSMOOTH_KERNEL_CACHE) >= GSMOOTH_KERNEL_CACHE_SIZE: 
+            GSMOOTH_KERNEL_CACHE.pop(next(iter(GSMOOTH_KERNEL_CACHE)))
+        GSMOOTH_KERNEL_CACHE[key] = KMAT
+
+    return GSMOOTH_KERNEL_CACHE[key]
+
+def GSmooth(Wave, Flux, varFlux=None, vexp=0.002, nsig=5.0, use_cache=False):
 
     # NOTE: Kaepora Function gsmooth is an inverse variance weighted Gaussian smoothing of spectra
     #       Optional inputs are smoothing velocity (vexp) and number of sigma (nsig)
+    #       use_cache=True: use the cached sparse kernel (see GSmooth_Kernel) instead of the banded form,
+    #                       which is preferable when the same (Wave, vexp) is used repeatedly.
 
     # ** Check for zero variance points, and set to 1E-31
     if varFlux is None: varFlux = 1.e-31*np.ones(len(Flux))
     
-    # ** Loop over Flux elements
-    newFlux = np.zeros(len(Wave)).astype(float)
-    for i in range(len(Wave)):
-        
-        # *** Construct a Gaussian of sigma = vexp*Wave[i]
-        gaussian = np.zeros(len(Wave), float)
-        sigma = vexp*Wave[i]
-        
-        # *** Restrict range to +/- nsig sigma
-        sigrange = np.nonzero(abs(Wave-Wave[i]) <= nsig*sigma)
-        gaussian[sigrange] = (1/(sigma*sqrt(2*pi)))*np.exp(-0.5*((Wave[sigrange]-Wave[i])/sigma)**2)
-        
-        # *** Multiply Gaussian by 1 / variance
-        W_lambda = gaussian / varFlux
-        
-        # *** Perform a weighted sum to give smoothed y value at Wave[i]
-        W0 = np.sum(W_lambda)
-        W1 = np.sum(W_lambda*Flux)
-        newFlux[i] = W1/W0
+    # ** Multiply Gaussian by 1 / variance & perform a weighted sum to give smoothed y value at each Wave
+    #    NOTE: equivalent to the original loop over Flux elements, evaluated in a vectorized form
+    IVAR = 1.0 / varFlux
+    if use_cache:
+        KMAT = GSmooth_Kernel(Wave, vexp=vexp, nsig=nsig)
+        W0 = KMAT.dot(IVAR)
+        W1 = KMAT.dot(IVAR*Flux)
+    else:
+        COLS, GAUSS = GSmooth_Band(Wave, vexp=vexp, nsig=nsig)
+        W_lambda = GAUSS * IVAR[COLS]
+        W0 = np.sum(W_lambda, axis=1)
+        W1 = np.sum(W_lambda*Flux[COLS], axis=1)
+    newFlux = W1/W0
 
     return newFlux
 
-def AutoGSmooth(Wave, Flux, varFlux=None, nsig=5.0):
+def GSmooth_Batch(Wave, FLUX_2D, varFLUX_2D=None, vexp=0.002, nsig=5.0):
+
+    # NOTE: GSmooth for many spectra on the same wavelength grid, FLUX_2D has shape (N, len(Wave)),
+    #       varFLUX_2D (optional) has the same shape. the cached sparse kernel is shared by all spectra.
+
+    FLUX_2D = np.atleast_2d(np.asarray(FLUX_2D, dtype=float))
+    if varFLUX_2D is None: varFLUX_2D = 1.e-31*np.ones(FLUX_2D.shape)
+    IVAR_2D = 1.0 / np.atleast_2d(varFLUX_2D)
+
+    KMAT = GSmooth_Kernel(Wave, vexp=vexp, nsig=nsig)
+    W0 = KMAT.dot(IVAR_2D.T).T
+    W1 = KMAT.dot((IVAR_2D*FLUX_2D).T).T
+    newFLUX_2D = W1/W0
+
+    return newFLUX_2D
+
+def AutoGSmooth(Wave, Flux, varFlux=None, nsig=5.0, use_cache=True):
 
     # NOTE There is an preliminary operation (eliminated here) called 'clip' before performing gsmooth,
     #      which is designed for interpolating over unwanted cosmic rays and emission lines.
 
     # ** Automatically determine vexp
-    newFlux_init = GSmooth(Wave, Flux, varFlux, vexp=0.002, nsig=5.0)  # this smoothing should get in right ballpark
+    #    NOTE: the kernels of the two fixed vexp are cached (if use_cache), as they are shared by all spectra on the same grid.
+    newFlux_init = GSmooth(Wave, Flux, varFlux, vexp=0.002, nsig=5.0, use_cache=use_cache)  # this smoothing should get in right ballpark
     if varFlux is not None:
         Error = np.sqrt(varFlux)
         mSNR = np.median(newFlux_init / Error)
     else:
         Error = np.absolute(Flux - newFlux_init)
-        smError = GSmooth(Wave, Error, varFlux, vexp=0.008, nsig=5.0)
+        smError = GSmooth(Wave, Error, varFlux, vexp=0.008, nsig=5.0, use_cache=use_cache)
         mSNR = np.median(newFlux_init / smError)
 
     # TODO (Kaepora): interpolate a function of mSNR
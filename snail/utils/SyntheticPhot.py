@@ -1,26 +1,129 @@
 import os
 import glob
 import contextlib
+from collections import OrderedDict
 import numpy as np
 import os.path as pa
-from astropy.table import Table
+from snail.utils.HelperCache import Load_CachedArrays
 
 # * Load transmission curves of popular filters (Natural System)
 #   (see ./helper/transmission_curves/*.txt)
+#   NOTE: the curves are loaded lazily (on first use) through the binary cache of helper assets.
 
 TCDICT = {}
 HDIR = pa.join(pa.dirname(__file__), 'helper')
-for file in glob.glob(HDIR + '/transmission_curves/*.txt'):
-    filtname = pa.basename(file)[:-4]
-    ast = Table.read(file, format='ascii')
-    lamb_T, T = np.array(ast['col1']).astype(float), np.array(ast['col2']).astype(float)   
-    TCDICT[filtname] = (lamb_T, T)
+def Load_TCDICT():
+
+    if not TCDICT:
+        SOURCES = glob.glob(HDIR + '/transmission_curves/*.txt')
+        
+        def builder():
+            from astropy.table import Table
+            ARRDICT = {}
+            for file in SOURCES:
+                filtname = pa.basename(file)[:-4]
+                ast = Table.read(file, format='ascii')
+                lamb_T, T = np.array(ast['col1']).astype(float), np.array(ast['col2']).astype(float)
+                ARRDICT[filtname] = np.array([lamb_T, T])
+            return ARRDICT
+
+        ARRDICT = Load_CachedArrays('transmission_curves', SOURCES, builder)
+        for filtname in ARRDICT:
+            TCDICT[filtname] = (ARRDICT[filtname][0], ARRDICT[filtname][1])
+    
+    return TCDICT
+
+# * Native synthetic photometry engine
+#   NOTE: the flux integral of pyphot (Filter.get_flux) on a spectrum grid is
+#         a = trapz(λ T(λ) F(λ), λ) / trapz(λ T(λ), λ) over the grid points with T(λ) > 0 for photon-counting filters,
+#         (with T(λ) in place of λ T(λ) for energy-counting filters, i.e., dtype='energy' in pyphot),
+#         where T is interpolated onto the grid (zero outside the filter).
+#         it is linear in F, hence a fixed weight vector per (filter, grid) and 
+#         a single matrix product for many spectra & filters.
+#   NOTE: the filter curves & zero points are taken from pyphot once per process (see Load_PhotFilter),
+#         and the weight vectors are cached by (filter, grid) (see SynPhot_Weights).
+
+PHOT_FILTERS = {}           # filtname -> {'wavelength', 'transmit', 'dtype', 'Vega_zero_mag', 'AB_zero_mag'}
+PHOT_LIBRARY = {}           # the pyphot filter library (loaded once)
+PHOT_WEIGHTS = {}           # (filtname, grid bytes) -> weight vector
+PHOT_WEIGHTS_SIZE = 64
+
+def Load_PhotFilter(filtname):
+
+    if filtname not in PHOT_FILTERS:
+        import pyphot
+        TCDICT = Load_TCDICT()
+        assert (filtname in ['B(Standard)', 'V(Standard)']) or (filtname in TCDICT)
+        if filtname in ['B(Standard)', 'V(Standard)']:
+            if not PHOT_LIBRARY: PHOT_LIBRARY['lib'] = pyphot.get_library()   # NOTE: load the HDF5 library only once
+            pypfilt = PHOT_LIBRARY['lib']['GROUND_JOHNSON_%s' %filtname[0]]
+        if filtname in TCDICT:
+            lamb_T, T = TCDICT[filtname]
+            pypfilt = pyphot.Filter(lamb_T, T, name=filtname, dtype='photon', unit='Angstrom')
+
+        lamb_T = pypfilt._wavelength if hasattr(pypfilt, '_wavelength') else pypfilt.wavelength
+        T = pypfilt.transmit
+        with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+            PHOT_FILTERS[filtname] = {'wavelength': np.array(getattr(lamb_T, 'value', lamb_T)).astype(float), \
+                                      'transmit': np.array(getattr(T, 'value', T)).astype(float), \
+                                      'dtype': str(getattr(pypfilt, 'dtype', 'photon')), \
+                                      'Vega_zero_mag': float(pypfilt.Vega_zero_mag), \
+                                      'AB_zero_mag': float(pypfilt.AB_zero_mag)}
+    
+    return PHOT_FILTERS[filtname]
+
+def SynPhot_Weights(Wave, filtname, cache=True):
+
+    # NOTE: weight vector on the grid Wave such that fluxes = Flux.dot(weights)
+    #       cache=False: do not keep the weights (e.g., for grids used only once)
+    Wave = np.asarray(Wave, dtype=float)
+    key = (filtname, Wave.tobytes())
+    if key not in PHOT_WEIGHTS or not cache:
+        PF = Load_PhotFilter(filtname)
+        ifT = np.interp(Wave, PF['wavelength'], PF['transmit'], left=0., right=0.)
+        ind = np.where(ifT > 0.)[0]
+        weights = np.zeros(len(Wave)).astype(float)
+        if len(ind) > 1:
+            # trapezoidal weights on the selected points
+            dx = np.diff(Wave[ind])
+            tw = np.zeros(len(ind)).astype(float)
+            tw[:-1] += 0.5*dx
+            tw[1:] += 0.5*dx
+            weights[ind] = tw * ifT[ind]
+            if PF['dtype'] == 'photon': weights[ind] *= Wave[ind]
+            weights /= np.sum(weights)
+        if not cache: return weights
+        if len(PHOT_WEIGHTS) >= PHOT_WEIGHTS_SIZE: PHOT_WEIGHTS.pop(next(iter(PHOT_WEIGHTS)))
+        PHOT_WEIGHTS[key] = weights
+    
+    return PHOT_WEIGHTS[key]
+
+def SynPhot_Batch(Wave, FLUX_2D, filtnames, phot_system, cache=True):
+
+    # NOTE: synthetic magnitudes of many spectra on the same grid Wave through many filters,
+    #       FLUX_2D has shape (N, len(Wave)), returns magnitudes of shape (N, len(filtnames)).
+    assert phot_system in ['Vega', 'AB']
+    FLUX_2D = np.atleast_2d(np.asarray(FLUX_2D, dtype=float))
+    WMAT = np.array([SynPhot_Weights(Wave, filtname, cache=cache) for filtname in filtnames]).T
+    ZEROMAG = np.array([Load_PhotFilter(filtname)['%s_zero_mag' %phot_system] for filtname in filtnames])
+    
+    fluxes = np.dot(FLUX_2D, WMAT)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        MAG_2D = -2.5 * np.log10(fluxes) - ZEROMAG[None, :]
+    return MAG_2D
 
 # * Calculate Synthetic Photometry
 #   NOTE: make sure that input spectrum fully covers the transmission curve.
-def SynPhot(Wave, Flux, filtname, phot_system):
+#         engine='native' uses the cached native engine above, engine='pyphot' calls pyphot directly.
+def SynPhot(Wave, Flux, filtname, phot_system, engine='native'):
+    assert engine in ['native', 'pyphot']
+    if engine == 'native':
+        mag_sphot = SynPhot_Batch(Wave, Flux, [filtname], phot_system)[0, 0]
+        return mag_sphot
+
     import pyphot
     assert phot_system in ['Vega', 'AB']
+    TCDICT = Load_TCDICT()
     assert (filtname in ['B(Standard)', 'V(Standard)']) or (filtname in TCDICT)
 
     if filtname == 'B(Standard)':
@@ -46,28 +149,139 @@ def SynPhot(Wave, Flux, filtname, phot_system):
     return mag_sphot
 
 # * Calculate Synthetic B-V offset due to too narrow wavelength coverage using Hsiao's template
-AstHsiao = Table.read(HDIR + '/HsiaoTemplate.csv', format='ascii.csv')
-def Calculate_BmVoffset(phase, redshift, WaveRange, filtname_B, filtname_V, phot_system):
+#   NOTE: the template is loaded lazily (on first use) through the binary cache of helper assets.
+#         besides the astropy Table (AstHsiao), it is reshaped once into a (phase, wavelength) array.
+HSIAO = {}
+def Load_HsiaoColumns():
+
+    if 'columns' not in HSIAO:
+        SOURCES = [HDIR + '/HsiaoTemplate.csv']
+        
+        def builder():
+            from astropy.table import Table
+            ast = Table.read(SOURCES[0], format='ascii.csv')
+            return {col: np.array(ast[col]) for col in ['Phase', 'Wavelength', 'Flux']}
+
+        HSIAO['columns'] = Load_CachedArrays('hsiao_template', SOURCES, builder)
+    
+    return HSIAO['columns']
+
+def Load_HsiaoTemplate():
+
+    from astropy.table import Table
+    if 'AstHsiao' not in HSIAO:
+        ARRDICT = Load_HsiaoColumns()
+        HSIAO['AstHsiao'] = Table([ARRDICT['Phase'], ARRDICT['Wavelength'], ARRDICT['Flux']], \
+            names=['Phase', 'Wavelength', 'Flux'], copy=False)
+    
+    return HSIAO['AstHsiao']
+
+def Load_HsiaoArray():
+
+    # NOTE: returns a dictionary with keys 'phase' (P,), 'wavelength' (W,) and 'flux' (P, W),
+    #       the template has the same wavelength grid at all (integer) phases.
+    if 'array' not in HSIAO:
+        ARRDICT = Load_HsiaoColumns()
+        PHA = np.array(ARRDICT['Phase'])
+        WAV = np.array(ARRDICT['Wavelength']).astype(float)
+        FLX = np.array(ARRDICT['Flux']).astype(float)
+        
+        ORDER = np.lexsort((WAV, PHA))
+        PHASES = np.unique(PHA)
+        WAVE_2D = WAV[ORDER].reshape((len(PHASES), -1))
+        assert np.all(WAVE_2D == WAVE_2D[0])
+        HSIAO['array'] = {'phase': PHASES, 'wavelength': WAVE_2D[0], \
+                          'flux': FLX[ORDER].reshape((len(PHASES), -1))}
+    
+    return HSIAO['array']
+
+def Hsiao_PhaseIndex(phase):
+    
+    # NOTE: the row of the template at the rounded phase
+    PHASES = Load_HsiaoArray()['phase']
+    idx = np.searchsorted(PHASES, round(phase))
+    assert idx < len(PHASES) and PHASES[idx] == round(phase), \
+        'Phase [%.1f] out of the range of Hsiao template !' %phase
+    return idx
+
+def __getattr__(name):
+    # NOTE: keep module attributes (i.e., AstHsiao) available on first access
+    if name == 'AstHsiao': return Load_HsiaoTemplate()
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
+
+BMVOFFSET_CACHE = OrderedDict()     # (phase, redshift, WaveRange, filtname_B, filtname_V, phot_system) -> B-V offset
+BMVOFFSET_CACHE_SIZE = 4096
+BMVOFFSET_GRID = {}                 # (WaveRange, filtname_B, filtname_V, phot_system, redshift grid) -> offsets (P, Z)
+
+def BmVoffset_Grid(WaveRange, filtname_B, filtname_V, phot_system, redshift_grid):
+
+    # NOTE: precomputed B-V offsets at all template phases over a redshift grid, shape (P, len(redshift_grid)),
+    #       one matrix product (all phases, full & truncated) per redshift.
+    redshift_grid = np.asarray(redshift_grid, dtype=float)
+    key = (tuple(WaveRange), filtname_B, filtname_V, phot_system, redshift_grid.tobytes())
+    if key not in BMVOFFSET_GRID:
+        HA = Load_HsiaoArray()
+        Wave_h, FLUX_h = HA['wavelength'], HA['flux']
+        TruncMask = np.logical_and(Wave_h >= WaveRange[0], Wave_h <= WaveRange[1])
+        FLUX_2D = np.concatenate([FLUX_h, FLUX_h * TruncMask], axis=0)   # zero-padding
+        
+        P = len(HA['phase'])
+        GRID = np.zeros((P, len(redshift_grid))).astype(float)
+        for j, redshift in enumerate(redshift_grid):
+            MAG_2D = SynPhot_Batch(Wave_h*(1+redshift), FLUX_2D, [filtname_B, filtname_V], phot_system, cache=False)
+            BmV_2D = MAG_2D[:, 0] - MAG_2D[:, 1]
+            GRID[:, j] = BmV_2D[:P] - BmV_2D[P:]
+        BMVOFFSET_GRID[key] = GRID
+    
+    return BMVOFFSET_GRID[key]
+
+def Calculate_BmVoffset(phase, redshift, WaveRange, filtname_B, filtname_V, phot_system, redshift_grid=None):
+
+    # NOTE: the template is taken at the rounded phase, 
+    #       the offsets are cached (LRU) per (rounded phase, redshift, WaveRange, filters, phot_system).
+    #       redshift_grid: if given, the offset is (linearly) interpolated from the precomputed 
+    #                      offsets over the redshift grid (see BmVoffset_Grid).
+    if redshift_grid is not None:
+        GRID = BmVoffset_Grid(WaveRange, filtname_B, filtname_V, phot_system, redshift_grid)
+        BmVoffset = float(np.interp(redshift, redshift_grid, GRID[Hsiao_PhaseIndex(phase)]))
+        return BmVoffset
+    
+    key = (round(phase), float(redshift), tuple(WaveRange), filtname_B, filtname_V, phot_system)
+    if key in BMVOFFSET_CACHE: 
+        BMVOFFSET_CACHE.move_to_end(key)
+        return BMVOFFSET_CACHE[key]
 
     # ** read the full template spectrum
-    Asth = AstHsiao[AstHsiao['Phase'] == round(phase)]
-    Wave_h = np.array(Asth['Wavelength']).astype(float)  # in rest-frame
-    Flux_h = np.array(Asth['Flux']).astype(float)
+    HA = Load_HsiaoArray()
+    Wave_h = HA['wavelength']  # in rest-frame
+    Flux_h = HA['flux'][Hsiao_PhaseIndex(phase)]
 
     # ** make truncated version of template spectrum
     TruncMask = np.logical_and(Wave_h >= WaveRange[0], Wave_h <= WaveRange[1])
     Wave_th, Flux_th = Wave_h.copy(), Flux_h.copy()
     Flux_th[~TruncMask] = 0.0  # zero-padding 
 
-    # ** synthetic-photometry on the full template [Lab-Frame]
-    MAGB_h = SynPhot(Wave_h*(1+redshift), Flux_h, filtname_B, phot_system)
-    MAGV_h = SynPhot(Wave_h*(1+redshift), Flux_h, filtname_V, phot_system)
-    BmV_h = MAGB_h - MAGV_h
-
-    # ** synthetic-photometry on truncated template [Lab-Frame]
-    MAGB_th = SynPhot(Wave_th*(1+redshift), Flux_th, filtname_B, phot_system)
-    MAGV_th = SynPhot(Wave_th*(1+redshift), Flux_th, filtname_V, phot_system)
-    BmV_th = MAGB_th - MAGV_th
+    # ** synthetic-photometry on the full & truncated template [Lab-Frame] (in one go)
+    MAG_2D = SynPhot_Batch(Wave_h*(1+redshift), np.array([Flux_h, Flux_th]), \
+        [filtname_B, filtname_V], phot_system)
+    BmV_h = MAG_2D[0, 0] - MAG_2D[0, 1]
+    BmV_th = MAG_2D[1, 0] - MAG_2D[1, 1]
     BmVoffset = float(BmV_h - BmV_th)  # mag
+    
+    if len(BMVOFFSET_CACHE) >= BMVOFFSET_CACHE_SIZE: BMVOFFSET_CACHE.popitem(last=False)
+    BMVOFFSET_CACHE[key] = BmVoffset
 
     return BmVoffset
+
+def Calculate_BmVoffset_Batch(phases, redshifts, WaveRange, filtname_B, filtname_V, phot_system, redshift_grid=None):
+
+    # NOTE: B-V offsets of many (phase, redshift) pairs, e.g., for batch color-correction.
+    if redshift_grid is not None:
+        GRID = BmVoffset_Grid(WaveRange, filtname_B, filtname_V, phot_system, redshift_grid)
+        BmVoffsets = np.array([np.interp(redshift, redshift_grid, GRID[Hsiao_PhaseIndex(phase)]) \
+            for phase, redshift in zip(phases, redshifts)])
+        return BmVoffsets
+    
+    BmVoffsets = np.array([Calculate_BmVoffset(phase, redshift, WaveRange, filtname_B, filtname_V, phot_system) \
+        for phase, redshift in zip(phases, redshifts)])
+    return BmVoffsets
@@ -0,0 +1,69 @@
+import os
+import glob
+import numpy as np
+import os.path as pa
+
+# ** Remarks on sharded training samples
+#    A training set (for SNAIL_Train) is stored as a directory of shards, the shard k consists of
+#    shard-<k>.X.npy (Nk, 2, 186), shard-<k>.Y.npy (Nk, 184) & shard-<k>.W.npy (Nk),
+#    i.e., the same arrays as XDATA_train, YDATA_train & WEIGHT_train of SNAIL_Train.SLT.
+#    Shards are memory-mapped when read, so the training set can be larger than RAM,
+#    and the duplicated timestep target (Nk, 2, 184) is only formed per batch.
+
+def Write_TrainShard(ShardDir, XDATA, YDATA, WEIGHT, shard_index=None):
+
+    # NOTE: the .X.npy is written last (after a temporary file), its presence marks a complete shard.
+    os.makedirs(ShardDir, exist_ok=True)
+    if shard_index is None: shard_index = len(List_TrainShards(ShardDir))
+    XDATA, YDATA, WEIGHT = np.asarray(XDATA), np.asarray(YDATA), np.asarray(WEIGHT)
+    assert XDATA.shape[0] == YDATA.shape[0] == WEIGHT.shape[0]
+
+    PREFIX = pa.join(ShardDir, 'shard-%05d' %shard_index)
+    np.save(PREFIX + '.Y.npy', YDATA)
+    np.save(PREFIX + '.W.npy', WEIGHT)
+    with open(PREFIX + '.X.tmp.npy', 'wb') as f: np.save(f, XDATA)
+    os.replace(PREFIX + '.X.tmp.npy', PREFIX + '.X.npy')
+    return PREFIX
+
+def List_TrainShards(ShardDir):
+    # NOTE: returns the prefixes of complete shards (sorted)
+    return sorted([FILE[:-len('.X.npy')] for FILE in glob.glob(pa.join(ShardDir, 'shard-*.X.npy'))])
+
+def Load_TrainShard(PREFIX, mmap_mode='r'):
+    XDATA = np.load(PREFIX + '.X.npy', mmap_mode=mmap_mode)
+    YDATA = np.load(PREFIX + '.Y.npy', mmap_mode=mmap_mode)
+    WEIGHT = np.load(PREFIX + '.W.npy', mmap_mode=mmap_mode)
+    return XDATA, YDATA, WEIGHT
+
+def Count_TrainSamples(ShardDir):
+    # NOTE: only reads the .npy headers
+    return int(sum(Load_TrainShard(PREFIX)[0].shape[0] for PREFIX in List_TrainShards(ShardDir)))
+
+def Count_TrainBatches(ShardDir, batch_size):
+    # NOTE: number of batches per epoch of TrainShard_Batches, 
+    #       i.e., sum of ceil(Nk / batch_size) over the shards (the last batch of each shard is partial)
+    return int(sum(-(-Load_TrainShard(PREFIX)[0].shape[0] // batch_size) for PREFIX in List_TrainShards(ShardDir)))
+
+def TrainShard_Batches(ShardDir, batch_size, shuffle=True, seed=None, n_steps=None, dtype=np.float32):
+
+    # NOTE: one epoch of (X, Y, W) batches over all shards.
+    #       shuffle=True visits the shards in random order and shuffles the samples within each shard,
+    #       (the global shuffle is approximated, as a shard is the unit of I/O).
+    #       n_steps: if given, the target Y is duplicated per batch to shape (B, n_steps, 184).
+    #       the last batch of each shard may be smaller than batch_size.
+
+    rng = np.random.default_rng(seed)
+    PREFIX_Lst = List_TrainShards(ShardDir)
+    if shuffle: PREFIX_Lst = [PREFIX_Lst[i] for i in rng.permutation(len(PREFIX_Lst))]
+    for PREFIX in PREFIX_Lst:
+        XDATA, YDATA, WEIGHT = Load_TrainShard(PREFIX)
+        N = XDATA.shape[0]
+        ORDER = rng.permutation(N) if shuffle else np.arange(N)
+        for i0 in range(0, N, batch_size):
+            IDX = np.sort(ORDER[i0: i0+batch_size])     # NOTE: sorted for sequential reads of the memmap
+            if shuffle: IDX = rng.permutation(IDX)
+            XB = np.asarray(XDATA[IDX], dtype=dtype)
+            YB = np.asarray(YDATA[IDX], dtype=dtype)
+            WB = np.asarray(WEIGHT[IDX], dtype=dtype)
+            if n_steps is not None: YB = np.repeat(YB[:, None, :], n_steps, axis=1)
+            yield XB, YB, WB
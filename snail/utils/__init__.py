@@ -1,13 +1,60 @@
 """
 Remarks on Internal Packages Imports:
     from snail.utils.GPLightCurve import GP_Interpolator, PhotGP, PhotBVColor
-    from snail.utils.SpecFPCA import FPCA_Parameterize, FPCA_Reconstruct
-    from snail.utils.SpecGSmooth import GSmooth, AutoGSmooth
-    from snail.utils.SyntheticPhot import SynPhot, Calculate_BmVoffset
+    from snail.utils.NumpyLSTM import NumpyBiLSTM, Export_BiLSTM
+    from snail.utils.OnlineStats import OnlineSurfaceStats
+    from snail.utils.SpecFPCA import FPCA_Parameterize, FPCA_Parameterize_Batch, FPCA_Reconstruct, FPCA_Reconstruct_Batch
+    from snail.utils.SpecGSmooth import GSmooth, GSmooth_Batch, AutoGSmooth
+    from snail.utils.SyntheticPhot import SynPhot, SynPhot_Batch, Calculate_BmVoffset, Calculate_BmVoffset_Batch
+    from snail.utils.TrainShards import Write_TrainShard, List_TrainShards, Load_TrainShard, TrainShard_Batches
 
 """
 
-from .GPLightCurve import GP_Interpolator, PhotGP, PhotBVColor
-from .SpecFPCA import FPCA_Parameterize, FPCA_Reconstruct
-from .SpecGSmooth import GSmooth, AutoGSmooth
-from .SyntheticPhot import SynPhot, Calculate_BmVoffset
+# NOTE: submodules are imported lazily (on first attribute access), so that
+#       e.g. "from snail import AccessDB" does not pay for FPCA, pyphot or TensorFlow.
+#       Python 3.6 has no module-level __getattr__ (PEP 562), so we fall back to eager imports.
+
+import sys
+import importlib
+
+_LAZY_ATTRS = {
+    'GP_Interpolator': 'GPLightCurve',
+    'PhotGP': 'GPLightCurve',
+    'PhotBVColor': 'GPLightCurve',
+    'NumpyBiLSTM': 'NumpyLSTM',
+    'Export_BiLSTM': 'NumpyLSTM',
+    'OnlineSurfaceStats': 'OnlineStats',
+    'FPCA_Parameterize': 'SpecFPCA',
+    'FPCA_Parameterize_Batch': 'SpecFPCA',
+    'FPCA_Reconstruct': 'SpecFPCA',
+    'FPCA_Reconstruct_Batch': 'SpecFPCA',
+    'GSmooth': 'SpecGSmooth',
+    'GSmooth_Batch': 'SpecGSmooth',
+    'AutoGSmooth': 'SpecGSmooth',
+    'SynPhot': 'SyntheticPhot',
+    'SynPhot_Batch': 'SyntheticPhot',
+    'Calculate_BmVoffset': 'SyntheticPhot',
+    'Calculate_BmVoffset_Batch': 'SyntheticPhot',
+    'Write_TrainShard': 'TrainShards',
+    'List_TrainShards': 'TrainShards',
+    'Load_TrainShard': 'TrainShards',
+    'TrainShard_Batches': 'TrainShards'
+}
+
+if sys.version_info < (3, 7):
+    from .GPLightCurve import GP_Interpolator, PhotGP, PhotBVColor
+    from .NumpyLSTM import NumpyBiLSTM, Export_BiLSTM
+    from .OnlineStats import OnlineSurfaceStats
+    from .SpecFPCA import FPCA_Parameterize, FPCA_Parameterize_Batch, FPCA_Reconstruct, FPCA_Reconstruct_Batch
+    from .SpecGSmooth import GSmooth, GSmooth_Batch, AutoGSmooth
+    from .SyntheticPhot import SynPhot, SynPhot_Batch, Calculate_BmVoffset, Calculate_BmVoffset_Batch
+    from .TrainShards import Write_TrainShard, List_TrainShards, Load_TrainShard, TrainShard_Batches
+else:
+    def __getattr__(name):
+        if name in _LAZY_ATTRS:
+            module = importlib.import_module('.' + _LAZY_ATTRS[name], __name__)
+            return getattr(module, name)
+        raise AttributeError("module %r has no attribute %r" %(__name__, name))
+
+    def __dir__():
+        return sorted(list(globals()) + list(_LAZY_ATTRS))
@@ -0,0 +1,53 @@
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from snail.utils.SpecFPCA import Load_FPCA_Model, FPCA_MeasTime, FPCA_ScoreOperator, \
+    FPCA_Parameterize, FPCA_Parameterize_Batch
+
+WAVE = np.arange(3800, 7200, 2)
+
+def random_flux(rng):
+    Flux = 1.0 + 0.3*np.sin(WAVE / rng.uniform(50, 300)) + 0.2*np.exp(-0.5*((WAVE - rng.uniform(4000, 7000)) / 100.)**2)
+    Flux += 0.02*rng.normal(size=len(WAVE))
+    return Flux / np.mean(Flux)
+
+@pytest.mark.parametrize('b', [0, 1])
+def test_score_woodbury(b):
+    # NOTE: the Woodbury form (Dim x Dim solve) against the direct BLUP Λ Φ^T (Φ Λ Φ^T + σ^2 I)^-1 (Y - μ)
+    Dim = 90
+    FM = Load_FPCA_Model()
+    MEASTIME = FPCA_MeasTime(WAVE[850*b: 850*(b+1)], b)
+    muy, SOPER = FPCA_ScoreOperator(MEASTIME, b, Dim=Dim)
+    
+    N = len(FM['GRID_Lst'][b])
+    gridtime = np.clip(np.ceil(N*MEASTIME).astype(int) - 1, 0, N-1)
+    Phiy = FM['BASIS_Lst'][b][:Dim, gridtime].T
+    LAMBDA = np.diag(FM['EVAL_Lst'][b][:Dim])
+    SIGMA = np.dot(np.dot(Phiy, LAMBDA), Phiy.T) + FM['ERRVAR_Lst'][b] * np.eye(len(MEASTIME))
+    
+    rng = np.random.default_rng(b)
+    Y = rng.normal(size=(len(MEASTIME), 4))
+    XI_direct = np.dot(np.dot(LAMBDA, Phiy.T), np.linalg.solve(SIGMA, Y - muy[:, None]))
+    XI = np.dot(SOPER, Y - muy[:, None])
+    assert np.max(np.abs(XI - XI_direct)) < 1e-10 * np.max(np.abs(XI_direct))
+
+def test_batch_parity():
+    rng = np.random.default_rng(0)
+    FLUX_2D = np.array([random_flux(rng) for k in range(5)])
+    FPCA_PARAM_3D = FPCA_Parameterize_Batch(WAVE, FLUX_2D)
+    for k in range(5):
+        assert np.allclose(FPCA_PARAM_3D[k], FPCA_Parameterize(WAVE, FLUX_2D[k]), rtol=0, atol=1e-12)
+
+def test_parity_R():
+    # NOTE: the native backend against fpca.score in R (skipped without R & the fpca package)
+    R_PATH = shutil.which('R')
+    if R_PATH is None: pytest.skip('R not found')
+    if subprocess.call([R_PATH, '--slave', '-e', 'library(fpca)'], stdout=subprocess.DEVNULL, \
+        stderr=subprocess.DEVNULL) != 0: pytest.skip('R package fpca not installed')
+    rng = np.random.default_rng(1)
+    for k in range(3):
+        Flux = random_flux(rng)
+        FPCA_PARAM_R = FPCA_Parameterize(WAVE, Flux, R_PATH=R_PATH, backend='R')
+        FPCA_PARAM_N = FPCA_Parameterize(WAVE, Flux, backend='native')
+        assert np.allclose(FPCA_PARAM_N, FPCA_PARAM_R, rtol=0, atol=1e-6)
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import os.path as pa
+from snail.GenerateTemplate import SNAIL_Template
+
+class StubModel:
+    # NOTE: stand-in for the Bayesian LSTM, a fixed FPCA spectrum plus Gaussian (dropout-like) noise
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.BASE = np.zeros(184)
+        self.BASE[[0, 92]] = 1.0
+        self.BASE[[1, 93]] = 0.3
+
+    def predict(self, X, batch_size=None, verbose=0):
+        X = np.asarray(X)
+        return self.BASE + 0.01 * self.rng.normal(size=(X.shape[0], X.shape[1], 184))
+
+def write_manifest(DIR, nsn=3):
+    rng = np.random.default_rng(0)
+    LINES = ['SN_name,redshift,phase_1,file_1,phase_2,file_2']
+    for i in range(nsn):
+        FILES = []
+        for k in range(2):
+            Wave = np.arange(3500., 7600., 2.5)
+            Flux = 1.0 + 0.3*np.sin(Wave / rng.uniform(50, 300)) + 0.02*rng.normal(size=len(Wave))
+            FILES.append(pa.join(DIR, 'SN%d.%d.csv' %(i, k)))
+            np.savetxt(FILES[-1], np.array([Wave, Flux]).T, delimiter=',', header='wavelength,flux', comments='')
+        LINES.append('SN%d,,-5.0,%s,10.0,%s' %(i, FILES[0], FILES[1]))
+    Manifest = pa.join(DIR, 'manifest.csv')
+    with open(Manifest, 'w') as f: f.write('\n'.join(LINES) + '\n')
+    return Manifest
+
+def test_resume_reuses_stages(tmp_path, capsys):
+    Manifest = write_manifest(str(tmp_path))
+    OutDir = str(tmp_path / 'out')
+    STATUS = SNAIL_Template.STG(Manifest, StubModel(), OutDir, num_forward_pass=4, sn_per_call=2)
+    assert set(STATUS.values()) == {'done'}
+    
+    # NOTE: a resumed run (one template lost) reuses the homogenization & FPCA checkpoints
+    os.remove(pa.join(OutDir, 'ESurface-SN1.fits'))
+    capsys.readouterr()
+    STATUS = SNAIL_Template.STG(Manifest, StubModel(), OutDir, num_forward_pass=4, sn_per_call=2)
+    out = capsys.readouterr().out
+    assert STATUS == {'SN0': 'exists', 'SN1': 'done', 'SN2': 'exists'}
+    assert '[1] homogenization (resumed from checkpoint)' in out
+    assert '[2] FPCA parameterization (resumed from checkpoint)' in out
+
+def test_edited_spectrum_invalidates_stages(tmp_path, capsys):
+    Manifest = write_manifest(str(tmp_path))
+    OutDir = str(tmp_path / 'out')
+    SNAIL_Template.STG(Manifest, StubModel(), OutDir, num_forward_pass=4, sn_per_call=2)
+    
+    # NOTE: a raw spectrum replaced at the same path is homogenized again (not taken from the checkpoint)
+    FILE = str(tmp_path / 'SN1.0.csv')
+    Wave = np.arange(3500., 7600., 2.5)
+    np.savetxt(FILE, np.array([Wave, 1.0 + 0.5*np.cos(Wave / 80.)]).T, delimiter=',', header='wavelength,flux', comments='')
+    os.remove(pa.join(OutDir, 'ESurface-SN1.fits'))
+    capsys.readouterr()
+    STATUS = SNAIL_Template.STG(Manifest, StubModel(), OutDir, num_forward_pass=4, sn_per_call=2)
+    out = capsys.readouterr().out
+    assert STATUS['SN1'] == 'done'
+    assert 'resumed from checkpoint' not in out
+    assert '[1] homogenization of [6] spectra' in out
@@ -0,0 +1,42 @@
+import warnings
+import numpy as np
+import pytest
+from snail.utils.GPLightCurve import GP_Interpolator, GP_Interpolator_Batch, GP_Fit_Batch
+
+def light_curve(rng):
+    n = rng.integers(8, 40)
+    X = np.sort(rng.uniform(-15, 50, n))
+    Y = 0.5*np.sin(X/12.) + 0.02*X + rng.normal(0, 0.05, n)
+    eY = rng.uniform(0.02, 0.1, n)
+    return X, Y, eY
+
+def test_parity_sklearn():
+    # NOTE: the native engine reaches the same optimum as sklearn (10 restarts), 
+    #       the predicted mean & std agree within 1e-4 (typically ~1e-7)
+    pytest.importorskip('sklearn')
+    rng = np.random.default_rng(1)
+    X_q = np.linspace(-10, 45, 50)
+    for trial in range(10):
+        X, Y, eY = light_curve(rng)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            Y_n, eY_n = GP_Interpolator(X, Y, eY, X_q, engine='native')
+            np.random.seed(0)
+            Y_s, eY_s = GP_Interpolator(X, Y.copy(), eY.copy(), X_q, engine='sklearn')
+        assert np.max(np.abs(Y_n - Y_s)) < 1e-4
+        assert np.max(np.abs(eY_n - eY_s)) < 1e-4
+
+def test_fit_independent_of_history():
+    # NOTE: without warm start, a fit does not depend on the previous calls
+    rng = np.random.default_rng(2)
+    DATA = [light_curve(rng) for k in range(3)]
+    X_Lst, Y_Lst, eY_Lst = [list(A) for A in zip(*DATA)]
+    theta_0 = GP_Fit_Batch(X_Lst[:1], Y_Lst[:1], eY_Lst[:1])
+    GP_Fit_Batch(X_Lst[1:], Y_Lst[1:], eY_Lst[1:])
+    theta_1 = GP_Fit_Batch(X_Lst[:1], Y_Lst[:1], eY_Lst[:1])
+    assert np.array_equal(theta_0, theta_1)
+
+    X_q = np.linspace(-10, 45, 20)
+    Y_q, eY_q = GP_Interpolator_Batch(X_Lst, Y_Lst, eY_Lst, X_q)
+    Y_0, eY_0 = GP_Interpolator(*DATA[0], X_q)
+    assert np.allclose(Y_q[0], Y_0, rtol=0, atol=1e-10) and np.allclose(eY_q[0], eY_0, rtol=0, atol=1e-10)
@@ -0,0 +1,27 @@
+import sys
+import subprocess
+
+def run_isolated(code):
+    # NOTE: in a fresh interpreter, as the modules imported by other tests are cached in sys.modules
+    return subprocess.check_output([sys.executable, '-c', code]).decode().strip()
+
+HEAVY = "[m for m in sys.modules if m.split('.')[0] in ['sklearn', 'rpy2', 'tensorflow', 'pyphot']]"
+
+def test_import_snail():
+    # NOTE: importing the package pulls in none of the submodules & heavy dependencies
+    out = run_isolated("import sys, snail, snail.utils; " + \
+        "print(sorted(m for m in sys.modules if m.startswith('snail.') and m != 'snail.utils'), %s)" %HEAVY)
+    assert out == '[] []'
+
+def test_helper_tables_on_use():
+    # NOTE: importing the modules does not load the helper tables (FPCA basis, transmission curves, 
+    #       Hsiao template), and the native engines do not pull in sklearn or rpy2.
+    out = run_isolated("import sys; from snail import AccessDB, HomogenizeSpec, SNAIL_Predict_Deep; " + \
+        "from snail.utils import SpecFPCA, SyntheticPhot; " + \
+        "print(bool(SpecFPCA.FPCA_MODEL), bool(SyntheticPhot.TCDICT), bool(SyntheticPhot.HSIAO), %s)" %HEAVY)
+    assert out == 'False False False []'
+
+    out = run_isolated("import sys, numpy as np; from snail.utils import SpecFPCA, GP_Interpolator; " + \
+        "SpecFPCA.Load_FPCA_Model(); GP_Interpolator(np.arange(5.), np.ones(5), 0.1*np.ones(5), [1.5]); " + \
+        "print(bool(SpecFPCA.FPCA_MODEL), %s)" %HEAVY)
+    assert out == 'True []'
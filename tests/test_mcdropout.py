@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from snail.Predict import SNAIL_Predict_Deep
+
+class StubModel:
+    # NOTE: stand-in for the Bayesian LSTM, a fixed FPCA spectrum plus Gaussian (dropout-like) noise
+    def __init__(self, noise, seed=0):
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.BASE = np.zeros(184)
+        self.BASE[[0, 92]] = 1.0
+        self.BASE[[1, 93]] = 0.3
+
+    def predict(self, X, batch_size=None, verbose=0):
+        X = np.asarray(X)
+        Y = np.broadcast_to(self.BASE, (X.shape[0], X.shape[1], 184))
+        return Y + self.rng.normal(size=(X.shape[0], 1, 184)) * self.noise
+
+def run_spd(noise, adaptive=True):
+    FPCA_PARAM = np.zeros((2, 92))
+    FPCA_PARAM[:, 0] = 1.0
+    PredSpecDict = SNAIL_Predict_Deep.SPD(FPCA_PARAM, -5.0, FPCA_PARAM, 5.0, [0.0, 10.0, 20.0], StubModel(noise), \
+        num_forward_pass=64, adaptive=adaptive)
+    return PredSpecDict[0.0]
+
+def test_adaptive_stops_early():
+    # NOTE: small MC-dropout scatter, the standard error of the mean converges well before the cap
+    PredSpecDict = run_spd(0.02)
+    assert PredSpecDict['num_forward_pass'] < 64
+
+def test_adaptive_runs_to_cap():
+    PredSpecDict = run_spd(0.1)
+    assert PredSpecDict['num_forward_pass'] == 64
+    assert run_spd(0.02, adaptive=False)['num_forward_pass'] == 64
+
+def test_adaptive_few_passes():
+    # NOTE: num_forward_pass below the default min_forward_pass (16) simply runs all passes
+    FPCA_PARAM = np.zeros((2, 92))
+    FPCA_PARAM[:, 0] = 1.0
+    for num_forward_pass in [2, 8]:
+        PredSpecDict = SNAIL_Predict_Deep.SPD(FPCA_PARAM, -5.0, FPCA_PARAM, 5.0, [0.0], StubModel(0.02), \
+            num_forward_pass=num_forward_pass, adaptive=True)
+        assert PredSpecDict[0.0]['num_forward_pass'] == num_forward_pass
+    with pytest.raises(ValueError):
+        SNAIL_Predict_Deep.SPD(FPCA_PARAM, -5.0, FPCA_PARAM, 5.0, [0.0], StubModel(0.02), \
+            num_forward_pass=1, adaptive=True)
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from snail.utils.NumpyLSTM import NumpyBiLSTM, Export_BiLSTM
+
+U, D, NL = 8, 186, 3
+
+def random_weights(untied, seed=0):
+    rng = np.random.default_rng(seed)
+    WEIGHTS = {'n_layers': NL, 'dense_kernel': rng.normal(0, .1, (2*U, 184)), 'dense_bias': rng.normal(0, .1, 184)}
+    for k in range(NL):
+        for tag in ['fw', 'bw']:
+            WEIGHTS['L%d_%s_kernel' %(k, tag)] = rng.normal(0, .1, (D if k == 0 else 2*U, 4*U))
+            WEIGHTS['L%d_%s_recurrent_kernel' %(k, tag)] = rng.normal(0, .3, (U, 4*U))
+            WEIGHTS['L%d_%s_bias' %(k, tag)] = rng.normal(0, .1, 4*U)
+        WEIGHTS['L%d_dropout' %k] = 0.0 if k == 0 else 0.14
+        WEIGHTS['L%d_recurrent_dropout' %k] = 0.16
+        WEIGHTS['L%d_untied_masks' %k] = untied
+    return WEIGHTS
+
+def reference(WEIGHTS, X, MASKS=None):
+    # NOTE: per-sample, per-gate recurrence (gates i, f, c, o) with the given keep-masks (inverted dropout)
+    sigmoid = lambda z: 1.0 / (1.0 + np.exp(-z))
+    OUT = []
+    for s in range(X.shape[0]):
+        x = X[s]
+        for k in range(NL):
+            HSEQ_Lst = []
+            for tag, TIMES in [('fw', [0, 1]), ('bw', [1, 0])]:
+                K, R = WEIGHTS['L%d_%s_kernel' %(k, tag)], WEIGHTS['L%d_%s_recurrent_kernel' %(k, tag)]
+                bias = WEIGHTS['L%d_%s_bias' %(k, tag)]
+                DMASK, RMASK = (None, None) if MASKS is None else MASKS[(k, tag)]
+                h, c, HSEQ = np.zeros(U), np.zeros(U), np.zeros((2, U))
+                for t in TIMES:
+                    G = []
+                    for q in range(4):
+                        xq, hq = x[t].copy(), h.copy()
+                        if DMASK is not None: xq *= DMASK[q % len(DMASK)][s] / (1.0 - WEIGHTS['L%d_dropout' %k])
+                        if RMASK is not None: hq *= RMASK[q % len(RMASK)][s] / (1.0 - WEIGHTS['L%d_recurrent_dropout' %k])
+                        G.append(np.dot(xq, K[:, q*U: (q+1)*U]) + np.dot(hq, R[:, q*U: (q+1)*U]) + bias[q*U: (q+1)*U])
+                    c = sigmoid(G[1]) * c + sigmoid(G[0]) * np.tanh(G[2])
+                    h = sigmoid(G[3]) * np.tanh(c)
+                    HSEQ[t] = h
+                HSEQ_Lst.append(HSEQ)
+            x = np.concatenate(HSEQ_Lst, axis=1)
+        OUT.append(np.dot(x, WEIGHTS['dense_kernel']) + WEIGHTS['dense_bias'])
+    return np.array(OUT)
+
+@pytest.mark.parametrize('untied', [True, False])
+def test_reference_recurrence(untied):
+    WEIGHTS = random_weights(untied)
+    X = np.random.default_rng(1).normal(size=(5, 2, D))
+    model = NumpyBiLSTM(WEIGHTS, mc_dropout=False, dtype=np.float64)
+    assert np.max(np.abs(model.predict(X) - reference(WEIGHTS, X))) < 1e-12
+    
+    # NOTE: fixed (pre-drawn) masks, independent of the batching
+    model = NumpyBiLSTM(WEIGHTS, dtype=np.float64)
+    MASKS = model.Draw_Masks(5, [0], seed=7)
+    Y = model.predict(X, masks=MASKS)
+    assert np.max(np.abs(Y - reference(WEIGHTS, X, MASKS))) < 1e-12
+    assert np.max(np.abs(Y - model.predict(X, masks=MASKS, batch_size=2))) < 1e-12
+    assert np.max(np.abs(Y - reference(WEIGHTS, X))) > 1e-3
+
+    model32 = NumpyBiLSTM(WEIGHTS, mc_dropout=False)
+    assert model32.predict(X).dtype == np.float32
+    assert np.max(np.abs(model32.predict(X) - reference(WEIGHTS, X))) < 1e-5
+
+def test_parity_keras(tmp_path):
+    # NOTE: the exported Keras Bi-LSTM of SNAIL_Train (skipped without TensorFlow),
+    #       deterministic prediction (Bayesian=False) and the MC-dropout distribution (Bayesian=True)
+    pytest.importorskip('tensorflow')
+    from snail.Train import SNAIL_Train
+    X = np.random.default_rng(2).normal(size=(4, 2, D)).astype(np.float32)
+    
+    lstm_model = SNAIL_Train.Build_Model({'n_units': U, 'Bayesian': False})
+    model = NumpyBiLSTM(Export_BiLSTM(lstm_model, npz_file=str(tmp_path / 'w.npz')), mc_dropout=False)
+    assert np.max(np.abs(model.predict(X) - lstm_model.predict(X, verbose=0))) < 1e-5
+    model = NumpyBiLSTM.Load(str(tmp_path / 'w.npz'), mc_dropout=False)
+    assert np.max(np.abs(model.predict(X) - lstm_model.predict(X, verbose=0))) < 1e-5
+
+    lstm_model = SNAIL_Train.Build_Model({'n_units': U, 'Bayesian': True})
+    model = NumpyBiLSTM(Export_BiLSTM(lstm_model), seed=0)
+    XTILE = np.tile(X[:1], (4000, 1, 1))
+    Y_keras, Y_numpy = lstm_model.predict(XTILE, verbose=0), model.predict(XTILE)
+    assert np.std(Y_keras[:, 0, 0]) > 0 and np.std(Y_numpy[:, 0, 0]) > 0
+    SE = np.sqrt((np.var(Y_keras, axis=0) + np.var(Y_numpy, axis=0)) / len(XTILE))
+    assert np.max(np.abs(np.mean(Y_keras, axis=0) - np.mean(Y_numpy, axis=0)) / SE) < 5.0
+    assert np.allclose(np.std(Y_keras, axis=0), np.std(Y_numpy, axis=0), rtol=0.15, atol=1e-6)
+
+def test_seeded_spd():
+    # NOTE: seeded MC-dropout through SPD, reproducible, invariant to the grouping of passes into calls,
+    #       and shards of passes (pass_offset) merge into the full run
+    from snail.Predict import SNAIL_Predict_Deep
+    WEIGHTS = random_weights(True)
+    WEIGHTS['dense_kernel'] = WEIGHTS['dense_kernel'] * 0.1
+    WEIGHTS['dense_bias'] = np.zeros(184)
+    WEIGHTS['dense_bias'][[0, 92]], WEIGHTS['dense_bias'][[1, 93]] = 1.0, 0.3
+    model = NumpyBiLSTM(WEIGHTS, dtype=np.float64)
+    FPCA_PARAM = np.zeros((2, 92))
+    FPCA_PARAM[:, 0] = 1.0
+
+    def spd(**kwargs):
+        return SNAIL_Predict_Deep.SPD(FPCA_PARAM, -5.0, FPCA_PARAM, 5.0, [0.0, 10.0], model, return_mcstats=True, **kwargs)
+    
+    PredSpecDict, MCStats = spd(num_forward_pass=64, seed=11)
+    _, MCStats_ = spd(num_forward_pass=64, seed=11)
+    assert np.array_equal(MCStats.mean, MCStats_.mean) and np.array_equal(MCStats.variance(), MCStats_.variance())
+    assert np.array_equal(PredSpecDict[10.0]['flux'], MCStats.mean[1]) and MCStats.count == 64
+    assert np.max(MCStats.std()) > 1e-6
+    _, MCStats_ = spd(num_forward_pass=64, seed=12)
+    assert not np.allclose(MCStats.mean, MCStats_.mean, rtol=0, atol=1e-12)
+    
+    _, MCStats_ = spd(num_forward_pass=64, seed=11, passes_per_call=5)
+    assert np.allclose(MCStats.mean, MCStats_.mean, rtol=0, atol=1e-12)
+    assert np.allclose(MCStats.variance(), MCStats_.variance(), rtol=0, atol=1e-12)
+
+    _, MCStats_0 = spd(num_forward_pass=32, seed=11)
+    _, MCStats_1 = spd(num_forward_pass=32, seed=11, pass_offset=32)
+    MCStats_0.merge(MCStats_1)
+    assert MCStats_0.count == 64
+    assert np.allclose(MCStats.mean, MCStats_0.mean, rtol=0, atol=1e-12)
+    assert np.allclose(MCStats.variance(), MCStats_0.variance(), rtol=0, atol=1e-12)
@@ -0,0 +1,59 @@
+import numpy as np
+from snail.utils.OnlineStats import OnlineSurfaceStats
+
+def test_welford():
+    # NOTE: blocks of uneven sizes against np.mean & np.var over the full pile
+    rng = np.random.default_rng(0)
+    PILE = 1.0 + 0.1 * rng.normal(size=(64, 3, 50))
+    MCStats = OnlineSurfaceStats()
+    for i0, i1 in [(0, 1), (1, 8), (8, 30), (30, 64)]:
+        MCStats.update(PILE[i0: i1])
+    assert MCStats.count == 64
+    assert np.allclose(MCStats.mean, np.mean(PILE, axis=0), rtol=0, atol=1e-14)
+    assert np.allclose(MCStats.variance(), np.var(PILE, axis=0), rtol=0, atol=1e-14)
+    assert np.allclose(MCStats.std(ddof=1), np.std(PILE, axis=0, ddof=1), rtol=0, atol=1e-14)
+
+def test_merge():
+    rng = np.random.default_rng(1)
+    PILE = rng.normal(size=(40, 7))
+    MCStats = OnlineSurfaceStats()
+    MCStats.update(PILE)
+    MCStats_0, MCStats_1 = OnlineSurfaceStats(), OnlineSurfaceStats()
+    MCStats_0.update(PILE[:13])
+    MCStats_1.update(PILE[13:])
+    MCStats_0.merge(MCStats_1).merge(OnlineSurfaceStats())
+    assert MCStats_0.count == 40
+    assert np.allclose(MCStats_0.mean, MCStats.mean, rtol=0, atol=1e-14)
+    assert np.allclose(MCStats_0.variance(), MCStats.variance(), rtol=0, atol=1e-14)
+
+def test_psquare():
+    rng = np.random.default_rng(2)
+    PILE = rng.normal(size=(64, 3, 500))
+    PERCENTILES = [16, 50, 84]
+    
+    # NOTE: exact for no more than 5 passes
+    for npass in [3, 5]:
+        MCStats = OnlineSurfaceStats(percentiles=PERCENTILES)
+        for k in range(npass): MCStats.update(PILE[k: k+1])
+        for q in PERCENTILES:
+            assert np.allclose(MCStats.percentile(q), np.percentile(PILE[:npass], q, axis=0), rtol=0, atol=1e-14)
+    
+    # NOTE: approximate at 64 passes (errors in units of the scatter, i.e., unit normal here)
+    MCStats = OnlineSurfaceStats(percentiles=PERCENTILES)
+    for i0 in range(0, 64, 8): MCStats.update(PILE[i0: i0+8])
+    for q in PERCENTILES:
+        ERR = np.abs(MCStats.percentile(q) - np.percentile(PILE, q, axis=0))
+        assert np.mean(ERR) < 0.15 and np.max(ERR) < 1.5
+
+def test_spd_percentiles():
+    from snail.Predict import SNAIL_Predict_Deep
+    from test_mcdropout import StubModel
+    FPCA_PARAM = np.zeros((2, 92))
+    FPCA_PARAM[:, 0] = 1.0
+    PredSpecDict = SNAIL_Predict_Deep.SPD(FPCA_PARAM, -5.0, FPCA_PARAM, 5.0, [0.0, 10.0], StubModel(0.02), \
+        num_forward_pass=16, percentiles=[16, 50, 84])
+    for phase_d in [0.0, 10.0]:
+        FLUXPCT = PredSpecDict[phase_d]['fluxpct']
+        assert sorted(FLUXPCT.keys()) == [16, 50, 84]
+        for q in FLUXPCT: assert FLUXPCT[q].shape == (1700,)
+        assert np.all(FLUXPCT[16] <= FLUXPCT[84])
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from snail.SpecProc import HomogenizeSpec
+
+def random_spectrum(rng, wmin, wmax):
+    Wave = np.sort(rng.uniform(wmin, wmax, rng.integers(1500, 4000)))
+    Flux = 1.0 + 0.3*np.sin(Wave / rng.uniform(50, 300)) + 0.05*rng.normal(size=len(Wave))
+    return Wave, Flux
+
+@pytest.mark.parametrize('wmin, wmax', [(3500., 7600.), (4100., 6900.)])
+def test_operator_parity(wmin, wmax):
+    # NOTE: the sparse operator agrees with the upsampling path, for full & partial coverage (extrapolation)
+    rng = np.random.default_rng(0)
+    for trial in range(5):
+        redshift = rng.uniform(0.0, 0.05)
+        Wave, Flux = random_spectrum(rng, wmin*(1+redshift), wmax*(1+redshift))
+        hFLUX_o, Quality = HomogenizeSpec.HS_Core(Wave, Flux, redshift=redshift, method='operator')
+        hFLUX_u, _ = HomogenizeSpec.HS_Core(Wave, Flux, redshift=redshift, method='upsample')
+        assert Quality['covered'] == (wmin < 3800.)
+        assert np.max(np.abs(hFLUX_o - hFLUX_u)) < 1e-10
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import os.path as pa
+from snail.AccessArchivalData import AccessDB, CSD_SpecStore
+
+WAVE = np.arange(3800, 7200, 2)
+
+def write_spectrum(DBDir, Spec_ID, SN_name, Flux):
+    SpecFile = CSD_SpecStore.SpecFile(DBDir, 'Corrected', SN_name, Spec_ID)
+    with open(SpecFile, 'w') as f:
+        f.write('RFwavelength,flux\n')
+        for w, fl in zip(WAVE, Flux): f.write('%d,%.10f\n' %(w, fl))
+
+def make_db(DBDir, nspec=3):
+    os.makedirs(pa.join(DBDir, 'Observations', 'Corrected'))
+    with open(pa.join(DBDir, 'ObjectMaster.csv'), 'w') as f:
+        f.write('SN_name,RA_J2000,DEC_J2000,Subtype,Redshift,MJD_Bmax,Subtype_ref,Redshift_ref,MJD_Bmax_ref,Num_Spec\n')
+        f.write('SN0000,1.0,2.0,Ia-norm,0.01,55000.0,a,b,c,%d\n' %nspec)
+    with open(pa.join(DBDir, 'SpecMaster.csv'), 'w') as f:
+        f.write('Spec_ID,SN_name,MJD_OBS,Phase,Tel_Inst,RawSpec_DeRedshifted_Type,' + \
+                'RawSpec_Median_SNR,HomoSpec_ColorCorrectness_Sigma,RawSpec_ref\n')
+        for k in range(nspec):
+            f.write('%d,SN0000,55000.0,%.1f,X,"Yes,VI",10.0,0.5,r\n' %(k+1, 5.0*k))
+    for k in range(nspec):
+        write_spectrum(DBDir, k+1, 'SN0000', np.full(len(WAVE), 1.0 + k))
+
+def test_store_fallback(tmp_path):
+    DBDir = str(tmp_path)
+    make_db(DBDir)
+    CSD_SpecStore.Build(DBDir, 'Corrected')
+    DB = AccessDB('SN0000', DBDir)
+    assert np.allclose(DB.Retrieve_SpecObs(2, 'Corrected')['flux'], 2.0)
+
+    # NOTE: an updated spectrum file (new size & mtime) is read from the ASCII file, not the stale store
+    write_spectrum(DBDir, 2, 'SN0000', np.full(len(WAVE), 20.0))
+    os.utime(CSD_SpecStore.SpecFile(DBDir, 'Corrected', 'SN0000', 2), ns=(0, 0))
+    Store = CSD_SpecStore.Load(DBDir, 'Corrected')
+    assert Store.Is_Current(DBDir, 'SN0000', 1) and not Store.Is_Current(DBDir, 'SN0000', 2)
+    assert np.allclose(DB.Retrieve_SpecObs(2, 'Corrected')['flux'], 20.0)
+    FLUX = DB.Retrieve_SpecObs_Batch([1, 2, 3], 'Corrected')['flux']
+    assert np.allclose(FLUX[:, 0], [1.0, 20.0, 3.0])
+
+def test_store_opt_in(tmp_path):
+    # NOTE: no store is written unless build_store=True
+    from snail.TrainSample import SNAIL_TrainSample
+    DBDir = str(tmp_path)
+    make_db(DBDir)
+    DB = AccessDB('SN0000', DBDir)
+    FLUX = DB.Retrieve_SpecObs_Batch([1, 2, 3], 'Corrected')['flux']
+    PHASES, SIDs, FLUX_ = SNAIL_TrainSample.SN_Spectra(DBDir, 'SN0000')
+    assert not CSD_SpecStore.Exists(DBDir, 'Corrected')
+    assert np.allclose(FLUX[:, 0], [1.0, 2.0, 3.0]) and np.allclose(FLUX_, FLUX)
+    assert np.allclose(PHASES, [0.0, 5.0, 10.0]) and list(SIDs) == [1, 2, 3]
+
+    FLUX = DB.Retrieve_SpecObs_Batch([1, 2, 3], 'Corrected', build_store=True)['flux']
+    assert CSD_SpecStore.Exists(DBDir, 'Corrected') and np.allclose(FLUX[:, 0], [1.0, 2.0, 3.0])
+
+def test_batch_raw_deredshift(tmp_path):
+    # NOTE: the batch & single retrieval of raw spectra share the default (deredshift_rawspec=True)
+    DBDir = str(tmp_path)
+    make_db(DBDir, nspec=2)
+    os.makedirs(pa.join(DBDir, 'Observations', 'Raw'))
+    with open(pa.join(DBDir, 'SpecMaster.csv')) as f: Lines = f.readlines()
+    with open(pa.join(DBDir, 'SpecMaster.csv'), 'w') as f:
+        f.writelines(Lines[:2] + [Lines[2].replace('"Yes,VI"', '"No,VI"')])
+    for Spec_ID in [1, 2]:
+        with open(CSD_SpecStore.SpecFile(DBDir, 'Raw', 'SN0000', Spec_ID), 'w') as f:
+            f.write('wavelength,flux\n')
+            for w in WAVE: f.write('%d,1.0\n' %w)
+
+    DB = AccessDB('SN0000', DBDir)
+    SpecLst = DB.Retrieve_SpecObs_Batch([1, 2], 'Raw')
+    for Spec_ID, Spec in zip([1, 2], SpecLst):
+        assert np.allclose(Spec['wavelength'], DB.Retrieve_SpecObs(Spec_ID, 'Raw')['wavelength'])
+    assert np.allclose(SpecLst[0]['wavelength'], WAVE) and np.allclose(SpecLst[1]['wavelength'], WAVE / 1.01)
+    SpecLst = DB.Retrieve_SpecObs_Batch([1, 2], 'Raw', deredshift_rawspec=False)
+    assert np.allclose(SpecLst[1]['wavelength'], WAVE)
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from snail.utils import SyntheticPhot
+from snail.utils.SyntheticPhot import SynPhot, SynPhot_Weights
+trapz = getattr(np, 'trapezoid', None) or np.trapz
+
+def test_weights_dtype(monkeypatch):
+    # NOTE: the weights against a direct trapezoidal integral, for photon (λ T) & energy (T) filters
+    lamb_T = np.linspace(4000., 6000., 201)
+    T = np.exp(-0.5*((lamb_T - 5000.) / 300.)**2)
+    Wave = np.arange(3500., 6500., 7.)
+    Flux = 1.0 + 1e-4 * (Wave - 5000.) + 0.1 * np.sin(Wave / 200.)
+    ifT = np.interp(Wave, lamb_T, T, left=0., right=0.)
+    ind = ifT > 0.
+    for dtype, KERNEL in [('photon', Wave * ifT), ('energy', ifT)]:
+        monkeypatch.setitem(SyntheticPhot.PHOT_FILTERS, 'test-%s' %dtype, {'wavelength': lamb_T, \
+            'transmit': T, 'dtype': dtype, 'Vega_zero_mag': 0.0, 'AB_zero_mag': 0.0})
+        weights = SynPhot_Weights(Wave, 'test-%s' %dtype, cache=False)
+        flux_ref = trapz((KERNEL * Flux)[ind], Wave[ind]) / trapz(KERNEL[ind], Wave[ind])
+        assert abs(np.dot(Flux, weights) / flux_ref - 1.0) < 1e-12
+
+@pytest.mark.parametrize('filtname', ['B(Standard)', 'V(Standard)', 'B(CSP-Swope)', 'V(CSP-Swope-LC9844)'])
+def test_parity_pyphot(filtname):
+    pytest.importorskip('pyphot')
+    Wave = np.arange(2500., 11000., 2.)
+    Flux = 1e-15 * (1.0 + 0.3 * np.sin(Wave / 500.)) * (Wave / 5000.)**-2
+    for phot_system in ['Vega', 'AB']:
+        mag_native = SynPhot(Wave, Flux, filtname, phot_system, engine='native')
+        mag_pyphot = SynPhot(Wave, Flux, filtname, phot_system, engine='pyphot')
+        assert abs(mag_native - mag_pyphot) < 1e-6
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+def test_early_stopping_requires_validation():
+    pytest.importorskip('tensorflow')
+    from snail.Train import SNAIL_Train
+    paradict = SNAIL_Train.Config(early_stopping_patience=2)
+    with pytest.raises(ValueError):
+        SNAIL_Train.Callbacks(paradict, 100, validation=False)
+    # NOTE: the check runs before the model is built
+    XDATA = np.zeros((4, 2, 186))
+    YDATA, WEIGHT = np.zeros((4, 2, 184)), np.ones((4, 2, 184))
+    with pytest.raises(ValueError):
+        SNAIL_Train.SLT(XDATA, YDATA, WEIGHT, paradict=paradict)
+    with pytest.raises(ValueError):
+        SNAIL_Train.SLT_Stream(lambda: iter([]), steps_per_epoch=1, paradict=paradict)
+
+    paradict = SNAIL_Train.Config({'early_stopping_patience': 2, 'validation_split': 0.25})
+    callbacks = SNAIL_Train.Callbacks(paradict, 100, validation=True)
+    assert any(type(cb).__name__ == 'EarlyStopping' for cb in callbacks)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from snail.utils.TrainShards import Write_TrainShard, List_TrainShards, TrainShard_Batches, \
+    Count_TrainSamples, Count_TrainBatches
+
+def write_shards(ShardDir, SIZES):
+    rng = np.random.default_rng(0)
+    for N in SIZES:
+        Write_TrainShard(ShardDir, rng.normal(size=(N, 2, 186)), rng.normal(size=(N, 184)), np.ones(N))
+
+def test_count_batches(tmp_path):
+    # NOTE: the last batch of each shard is partial, so the epoch has more batches than ceil(N / batch_size)
+    ShardDir = str(tmp_path)
+    write_shards(ShardDir, [10, 7, 3])
+    assert len(List_TrainShards(ShardDir)) == 3
+    assert Count_TrainSamples(ShardDir) == 20
+    for batch_size in [1, 4, 5, 8, 32]:
+        BATCHES = list(TrainShard_Batches(ShardDir, batch_size, shuffle=True, seed=1))
+        assert len(BATCHES) == Count_TrainBatches(ShardDir, batch_size)
+        assert sum(len(WB) for XB, YB, WB in BATCHES) == 20
+    assert Count_TrainBatches(ShardDir, 4) == 3 + 2 + 1
+
+def test_stream_requires_steps():
+    tensorflow = pytest.importorskip('tensorflow')
+    from snail.Train import SNAIL_Train
+    def gen():
+        yield np.zeros((4, 2, 186), dtype=np.float32), np.zeros((4, 184), dtype=np.float32), np.ones(4, dtype=np.float32)
+    dataset = tensorflow.data.Dataset.from_generator(gen, \
+        output_types=(tensorflow.float32, tensorflow.float32, tensorflow.float32), \
+        output_shapes=((None, 2, 186), (None, 184), (None,)))
+    with pytest.raises(ValueError, match='steps_per_epoch'):
+        SNAIL_Train.SLT_Stream(dataset.repeat(), paradict={'n_units': 4, 'epochs': 1})
+    with pytest.raises(ValueError, match='steps_per_epoch'):
+        SNAIL_Train.SLT_Stream(gen, paradict={'n_units': 4, 'epochs': 1})